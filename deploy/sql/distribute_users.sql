@@ -0,0 +1,18 @@
+-- Перевод работающего кластера из режима reference в режим distributed:
+-- users распределяется по id и колоцируется с friends/posts,
+-- auth_tokens распределяется по token.
+-- Перед запуском удалите внешние ключи на users (drop_fk.sql).
+\c social_network
+
+SELECT undistribute_table('users');
+SELECT undistribute_table('auth_tokens');
+
+SELECT create_distributed_table('users', 'id');
+SELECT create_distributed_table('auth_tokens', 'token', colocate_with => 'none');
+
+-- friends и posts уже распределены, переносим их в группу колокации users
+SELECT alter_distributed_table('friends', colocate_with := 'users');
+SELECT alter_distributed_table('posts', colocate_with := 'users');
+
+-- Проверяем распределение таблиц
+SELECT logicalrelid, partmethod, colocationid, repmodel FROM pg_dist_partition;
@@ -5,10 +5,23 @@ WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = 'social_network');
 -- Переключаемся на базу данных social_network
 \c social_network
 
+-- Режим размещения users/auth_tokens:
+--   reference   - таблицы-справочники (каждая запись - 2PC на все узлы), по умолчанию
+--   distributed - users распределена по id и колоцирована с friends/posts,
+--                 auth_tokens распределена по token (поиск токена - router-запрос)
+-- Пример: psql -v users_mode=distributed -f fix_citus.sql
+-- Для distributed-режима внешние ключи на users должны быть удалены (drop_fk.sql)
+\if :{?users_mode}
+\else
+\set users_mode reference
+\endif
+SELECT set_config('app.users_mode', :'users_mode', false);
+
 -- Определяем, существуют ли таблицы
 DO $$
 DECLARE
     table_exists BOOLEAN;
+    users_distributed BOOLEAN := current_setting('app.users_mode') = 'distributed';
 BEGIN
     -- Проверяем существование таблицы users
     SELECT EXISTS (
@@ -16,7 +29,11 @@ BEGIN
         WHERE table_schema = 'public' AND table_name = 'users'
     ) INTO table_exists;
     
-    IF table_exists THEN
+    IF table_exists AND users_distributed THEN
+        -- Распределяем users по id: запись пользователя идет на один шард
+        PERFORM create_distributed_table('users', 'id');
+        RAISE NOTICE 'users распределена по id';
+    ELSIF table_exists THEN
         -- Делаем users таблицей-справочником
         PERFORM create_reference_table('users');
         RAISE NOTICE 'users стала таблицей-справочником';
@@ -30,7 +47,11 @@ BEGIN
         WHERE table_schema = 'public' AND table_name = 'auth_tokens'
     ) INTO table_exists;
     
-    IF table_exists THEN
+    IF table_exists AND users_distributed THEN
+        -- Распределяем auth_tokens по token: проверка токена на каждом запросе - router-запрос
+        PERFORM create_distributed_table('auth_tokens', 'token', colocate_with => 'none');
+        RAISE NOTICE 'auth_tokens распределена по token';
+    ELSIF table_exists THEN
         -- Делаем auth_tokens таблицей-справочником
         PERFORM create_reference_table('auth_tokens');
         RAISE NOTICE 'auth_tokens стала таблицей-справочником';
@@ -44,7 +65,11 @@ BEGIN
         WHERE table_schema = 'public' AND table_name = 'friends'
     ) INTO table_exists;
     
-    IF table_exists THEN
+    IF table_exists AND users_distributed THEN
+        -- Распределяем friends по user_id в одной группе колокации с users
+        PERFORM create_distributed_table('friends', 'user_id', colocate_with => 'users');
+        RAISE NOTICE 'friends распределена по user_id (колоцирована с users)';
+    ELSIF table_exists THEN
         -- Распределяем friends по user_id
         PERFORM create_distributed_table('friends', 'user_id');
         RAISE NOTICE 'friends распределена по user_id';
@@ -58,7 +83,11 @@ BEGIN
         WHERE table_schema = 'public' AND table_name = 'posts'
     ) INTO table_exists;
     
-    IF table_exists THEN
+    IF table_exists AND users_distributed THEN
+        -- Распределяем posts по author_user_id в одной группе колокации с users
+        PERFORM create_distributed_table('posts', 'author_user_id', colocate_with => 'users');
+        RAISE NOTICE 'posts распределена по author_user_id (колоцирована с users)';
+    ELSIF table_exists THEN
         -- Распределяем posts по author_user_id
         PERFORM create_distributed_table('posts', 'author_user_id');
         RAISE NOTICE 'posts распределена по author_user_id';
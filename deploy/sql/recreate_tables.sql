@@ -19,9 +19,12 @@ CREATE TABLE IF NOT EXISTS users (
     city VARCHAR,
     password VARCHAR NOT NULL,
     is_hot_user BOOLEAN DEFAULT FALSE,
-    post_count INT DEFAULT 0
+    post_count INT NOT NULL DEFAULT 0,
+    friends_count INT NOT NULL DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS idx_users_post_count_not_hot ON users(post_count) WHERE is_hot_user = false;
+
 CREATE TABLE IF NOT EXISTS auth_tokens (
     token VARCHAR(64) PRIMARY KEY,
     user_id UUID NOT NULL,
@@ -0,0 +1,18 @@
+-- Колонки-счетчики друзей и постов пользователей (инкрементальное обновление вместо GROUP BY)
+-- Применяется до запуска API с user_stats: сервис колонки не создает
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_hot_user BOOLEAN DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS post_count INT NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS friends_count INT NOT NULL DEFAULT 0;
+
+-- Первичное заполнение по исходным таблицам
+-- (если Citus не поддерживает такой UPDATE, значения выставит сверка user_stats при старте API)
+UPDATE users u SET friends_count = c.cnt
+FROM (SELECT user_id, COUNT(*) AS cnt FROM friends GROUP BY user_id) c
+WHERE u.id = c.user_id;
+
+UPDATE users u SET post_count = c.cnt
+FROM (SELECT author_user_id, COUNT(*) AS cnt FROM posts GROUP BY author_user_id) c
+WHERE u.id = c.author_user_id;
+
+-- Поиск кандидатов в "горячие" пользователи по счетчику постов
+CREATE INDEX IF NOT EXISTS idx_users_post_count_not_hot ON users(post_count) WHERE is_hot_user = false;
@@ -23,6 +23,12 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 FEED_MAX_SIZE = 1000
 FEED_CACHE_TTL = 3600  # 1 hour in seconds
 
+# User profile cache configuration
+USER_PROFILE_TTL = int(os.getenv("USER_PROFILE_TTL", 3600))
+
+# Friend suggestions configuration
+FRIEND_SUGGESTIONS_TTL = int(os.getenv("FRIEND_SUGGESTIONS_TTL", 2 * 24 * 3600))
+
 class RedisCache:
     """Redis cache service for the social network application."""
     
@@ -67,6 +73,11 @@ class RedisCache:
             await self._redis_client.close()
             logger.info("Redis connection closed")
     
+    @property
+    def client(self) -> Optional[redis.Redis]:
+        """Shared Redis client for modules that keep their own key structures."""
+        return self._redis_client
+    
     async def get_feed(self, user_id: str, offset: int = 0, limit: int = 10) -> List[Dict[str, Any]]:
         """
         Get a user's feed from the cache.
@@ -294,5 +305,89 @@ class RedisCache:
         logger.info(f"Post {post_id} removed from {success_count}/{len(user_ids)} feeds")
         return success_count
 
+    async def get_user_profile(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a cached user profile.
+        
+        Args:
+            user_id: The ID of the user
+            
+        Returns:
+            The profile dictionary or None on a cache miss
+        """
+        if not self._redis_client:
+            return None
+        
+        try:
+            raw = await self._redis_client.get(f"user:{user_id}:profile")
+            return json.loads(raw) if raw else None
+        except Exception as e:
+            logger.error(f"Error retrieving profile from cache for user {user_id}: {e}")
+            return None
+    
+    async def cache_user_profile(self, user_id: str, profile: Dict[str, Any]) -> bool:
+        """
+        Cache a user profile (without credentials).
+        
+        Args:
+            user_id: The ID of the user
+            profile: The profile dictionary
+            
+        Returns:
+            True if the profile was cached, False otherwise
+        """
+        if not self._redis_client:
+            return False
+        
+        try:
+            await self._redis_client.set(f"user:{user_id}:profile", json.dumps(profile, default=str), ex=USER_PROFILE_TTL)
+            return True
+        except Exception as e:
+            logger.error(f"Error caching profile for user {user_id}: {e}")
+            return False
+    
+    async def cache_friend_suggestions(self, suggestions: Dict[str, List[Dict[str, Any]]]) -> int:
+        """
+        Store precomputed friend suggestions for a batch of users.
+        
+        Args:
+            suggestions: Mapping of user ID to an ordered list of suggestion dictionaries
+            
+        Returns:
+            The number of users whose suggestions were stored
+        """
+        if not self._redis_client or not suggestions:
+            return 0
+        
+        try:
+            pipe = self._redis_client.pipeline(transaction=False)
+            for user_id, items in suggestions.items():
+                pipe.set(f"user:{user_id}:friend_suggestions", json.dumps(items), ex=FRIEND_SUGGESTIONS_TTL)
+            await pipe.execute()
+            return len(suggestions)
+        except Exception as e:
+            logger.error(f"Error caching friend suggestions for {len(suggestions)} users: {e}")
+            return 0
+    
+    async def get_friend_suggestions(self, user_id: str) -> List[Dict[str, Any]]:
+        """
+        Get precomputed friend suggestions for a user.
+        
+        Args:
+            user_id: The ID of the user
+            
+        Returns:
+            An ordered list of suggestion dictionaries or an empty list if none are cached
+        """
+        if not self._redis_client:
+            return []
+        
+        try:
+            raw = await self._redis_client.get(f"user:{user_id}:friend_suggestions")
+            return json.loads(raw) if raw else []
+        except Exception as e:
+            logger.error(f"Error retrieving friend suggestions for user {user_id}: {e}")
+            return []
+
 # Create a singleton instance
 redis_cache = RedisCache()
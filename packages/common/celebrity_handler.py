@@ -41,14 +41,13 @@ class CelebrityHandler:
             Статистика обработки
         """
         try:
-            # Получаем информацию о друзьях с проверкой на знаменитость
-            friends_info = await self.feed_processor.get_user_friends_with_celebrity_check(
-                author_user_id, self.celebrity_threshold
-            )
+            # Статус знаменитости берем из инкрементального счетчика вместо подсчета друзей на каждый пост
+            from packages.common.user_stats import user_stats
+            from packages.common.db import get_user_friends
             
-            friend_ids = friends_info["friend_ids"]
-            is_celebrity = friends_info["is_celebrity"]
-            friends_count = friends_info["friends_count"]
+            friends_count = await user_stats.get_friends_count(author_user_id)
+            is_celebrity = friends_count >= self.celebrity_threshold
+            friend_ids = await get_user_friends(author_user_id)
             
             logger.info(
                 f"Processing post from {'celebrity' if is_celebrity else 'regular user'} "
@@ -217,49 +216,37 @@ class CelebrityHandler:
         """
         Получить статистику по знаменитостям
         
+        Счетчики друзей поддерживаются инкрементально в sorted set'е Redis,
+        поэтому выборка знаменитостей - это ZRANGEBYSCORE вместо GROUP BY по friends.
+        
         Returns:
             Статистика знаменитостей
         """
         try:
-            from sqlalchemy import select, func
-            from models import Friendship
-            from db import get_slave_session
+            from packages.common.user_stats import user_stats, FRIENDS_COUNT_KEY
             
-            async with get_slave_session() as session:
-                # Запрос для получения пользователей с количеством друзей
-                query = (
-                    select(
-                        Friendship.user_id,
-                        func.count(Friendship.friend_id).label('friends_count')
-                    )
-                    .group_by(Friendship.user_id)
-                    .having(func.count(Friendship.friend_id) >= self.celebrity_threshold)
-                    .order_by(func.count(Friendship.friend_id).desc())
-                )
-                
-                result = await session.execute(query)
-                celebrities = result.fetchall()
-                
-                # Статистика
-                total_celebrities = len(celebrities)
-                max_friends = celebrities[0].friends_count if celebrities else 0
-                avg_friends = sum(c.friends_count for c in celebrities) / total_celebrities if celebrities else 0
-                
-                return {
-                    "celebrity_threshold": self.celebrity_threshold,
-                    "total_celebrities": total_celebrities,
-                    "max_friends": max_friends,
-                    "avg_celebrity_friends": round(avg_friends, 2),
-                    "batch_size": self.batch_size,
-                    "batch_delay": self.batch_delay,
-                    "celebrities": [
-                        {
-                            "user_id": str(c.user_id),
-                            "friends_count": c.friends_count
-                        }
-                        for c in celebrities[:10]  # Топ 10
-                    ]
-                }
+            total_celebrities = await user_stats.count_at_least(FRIENDS_COUNT_KEY, self.celebrity_threshold)
+            celebrities = await user_stats.top(FRIENDS_COUNT_KEY, total_celebrities, self.celebrity_threshold)
+            
+            # Статистика
+            max_friends = celebrities[0][1] if celebrities else 0
+            avg_friends = sum(count for _, count in celebrities) / len(celebrities) if celebrities else 0
+            
+            return {
+                "celebrity_threshold": self.celebrity_threshold,
+                "total_celebrities": total_celebrities,
+                "max_friends": max_friends,
+                "avg_celebrity_friends": round(avg_friends, 2),
+                "batch_size": self.batch_size,
+                "batch_delay": self.batch_delay,
+                "celebrities": [
+                    {
+                        "user_id": user_id,
+                        "friends_count": count
+                    }
+                    for user_id, count in celebrities[:10]  # Топ 10
+                ]
+            }
                 
         except Exception as e:
             logger.error(f"Error getting celebrity stats: {e}")
@@ -301,10 +288,8 @@ class CelebrityHandler:
             True если пользователь знаменитость, False иначе
         """
         try:
-            friends_info = await self.feed_processor.get_user_friends_with_celebrity_check(
-                user_id, self.celebrity_threshold
-            )
-            return friends_info["is_celebrity"]
+            from packages.common.user_stats import user_stats
+            return await user_stats.get_friends_count(user_id) >= self.celebrity_threshold
         except Exception as e:
             logger.error(f"Error checking celebrity status for user {user_id}: {e}")
             return False
@@ -69,6 +69,7 @@ class DialogBackend(Enum):
     """Типы бэкендов для диалогов"""
     POSTGRESQL = "postgresql"
     REDIS = "redis"
+    REDIS_STREAMS = "redis_streams"
 
 
 class Config:
@@ -138,6 +139,10 @@ class Config:
         """Проверка, используется ли Redis для диалогов"""
         return self.DIALOG_BACKEND == DialogBackend.REDIS
     
+    def is_redis_streams_backend(self) -> bool:
+        """Проверка, используются ли Redis Streams (поток на диалог) для диалогов"""
+        return self.DIALOG_BACKEND == DialogBackend.REDIS_STREAMS
+    
     def is_postgresql_backend(self) -> bool:
         """Проверка, используется ли PostgreSQL для диалогов"""
         return self.DIALOG_BACKEND == DialogBackend.POSTGRESQL
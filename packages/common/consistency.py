@@ -0,0 +1,99 @@
+"""
+Read-your-writes поверх чтений с реплик.
+
+После записи на мастер запоминается его текущая позиция WAL (LSN) - токен
+согласованности. Токен возвращается клиенту в заголовке X-Consistency-Token и
+сохраняется в Redis для пользователя. На чтении наибольший из двух токенов
+становится нижней границей для маршрутизатора сессий: реплика подходит, только
+если уже применила WAL до этой позиции, иначе чтение идет на мастер.
+
+Без настроенных реплик модуль ничего не делает: все чтения и так идут на мастер.
+"""
+
+import logging
+import os
+from typing import Optional
+
+from packages.common.cache import redis_cache
+from packages.common.database import (
+    current_wal_lsn,
+    format_lsn,
+    parse_lsn,
+    session_router,
+    set_read_min_lsn,
+)
+
+logger = logging.getLogger(__name__)
+
+CONSISTENCY_HEADER = "X-Consistency-Token"
+
+# Токен нужен, пока реплики могут не догнать запись; отстающие дольше DB_REPLICA_MAX_LAG_SEC
+# и так выводятся из ротации, поэтому TTL берется с запасом
+CONSISTENCY_TOKEN_TTL_SEC = int(os.getenv("CONSISTENCY_TOKEN_TTL_SEC", "60"))
+
+# Не понижаем сохраненный LSN, если параллельная запись успела сохранить больший
+SET_MAX_LSN_LUA = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+def _lsn_key(user_id: str) -> str:
+    return f"user:{user_id}:write_lsn"
+
+
+async def record_write(session, user_id: str) -> Optional[str]:
+    """
+    Зафиксировать запись пользователя после коммита
+
+    Args:
+        session: Сессия мастера, в которой закоммичена запись
+        user_id: ID пользователя-автора записи
+
+    Returns:
+        Токен согласованности для заголовка ответа или None, если реплик нет
+    """
+    if not session_router.replicas:
+        return None
+    lsn = await current_wal_lsn(session)
+    # Последующие чтения в этом же запросе тоже должны видеть запись
+    set_read_min_lsn(lsn)
+    client = redis_cache.client
+    if client:
+        try:
+            await client.eval(SET_MAX_LSN_LUA, 1, _lsn_key(user_id), lsn, CONSISTENCY_TOKEN_TTL_SEC)
+        except Exception as e:
+            logger.error(f"Error saving consistency token for user {user_id}: {e}")
+    return format_lsn(lsn)
+
+
+async def apply_read_consistency(user_id: str, token: Optional[str] = None):
+    """
+    Ограничить чтения текущего запроса репликами, применившими последнюю запись пользователя
+
+    Args:
+        user_id: ID пользователя
+        token: Значение заголовка X-Consistency-Token, если клиент его передал
+    """
+    if not session_router.replicas:
+        return
+    if token:
+        try:
+            set_read_min_lsn(parse_lsn(token))
+        except ValueError:
+            logger.warning(f"Malformed consistency token: {token}")
+    client = redis_cache.client
+    if not client:
+        return
+    try:
+        stored = await client.get(_lsn_key(user_id))
+    except Exception as e:
+        logger.error(f"Error reading consistency token for user {user_id}: {e}")
+        return
+    if stored:
+        set_read_min_lsn(int(stored))
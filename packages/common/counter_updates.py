@@ -0,0 +1,127 @@
+"""
+Push счетчиков непрочитанных в WebSocket-клиенты.
+
+Подписчик живет в процессе WebSocket-сервера, который владеет websocket_manager
+(этот сервер собирается вне дерева, как и feed_processor). Подключение в его lifespan:
+
+    from counter_updates import start_counter_update_forwarder, stop_counter_update_forwarder
+
+    @app.on_event("startup")
+    async def on_startup():
+        start_counter_update_forwarder()
+
+    @app.on_event("shutdown")
+    async def on_shutdown():
+        await stop_counter_update_forwarder()
+
+Без этого PUBLISH функций счетчиков никто не слушает.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+import redis.asyncio as redis
+from websocket_manager import websocket_manager
+
+logger = logging.getLogger(__name__)
+
+# Counter Redis и канал, куда функции счетчиков публикуют новые значения
+COUNTER_REDIS_URL = os.getenv("COUNTER_REDIS_URL", "redis://redis:6379/2")
+COUNTER_UPDATES_CHANNEL = os.getenv("COUNTER_UPDATES_CHANNEL", "counters:updates")
+COUNTER_UPDATES_RECONNECT_SEC = float(os.getenv("COUNTER_UPDATES_RECONNECT_SEC", "2"))
+
+
+class CounterUpdateForwarder:
+    """
+    Push счетчиков непрочитанных в WebSocket.
+
+    Подписан на канал Redis Pub/Sub, куда Counter Service публикует новые
+    значения счетчиков после каждого MessageSent/MessagesRead, и пересылает
+    обновление пользователю, если он подключен к этому инстансу.
+    Pub/Sub не хранит сообщения: обновления за время разрыва теряются,
+    поэтому клиент при (пере)подключении один раз запрашивает счетчики через API.
+    """
+
+    def __init__(self, redis_url: str = COUNTER_REDIS_URL, channel: str = COUNTER_UPDATES_CHANNEL):
+        self.redis_url = redis_url
+        self.channel = channel
+        self._task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.forwarded = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Counter update forwarder subscribed to '{self.channel}'")
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            client = redis.from_url(self.redis_url, decode_responses=True)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._forward(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Counter update subscription failed: {e}")
+            finally:
+                try:
+                    await pubsub.close()
+                    await client.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(COUNTER_UPDATES_RECONNECT_SEC)
+
+    async def _forward(self, raw: str):
+        self.received += 1
+        try:
+            update: Dict[str, Any] = json.loads(raw)
+            user_id = str(update["user_id"])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Invalid counter update {raw!r}: {e}")
+            return
+        # Обновления пользователей, подключенных к другим инстансам, пропускаем
+        if not websocket_manager.is_user_connected(user_id):
+            return
+        sent = await websocket_manager.send_counter_update(
+            user_id,
+            str(update["peer_user_id"]),
+            int(update["unread"]),
+            int(update["total_unread"]),
+            int(update["delta"])
+        )
+        if sent:
+            self.forwarded += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"received": self.received, "forwarded": self.forwarded}
+
+
+# Глобальный экземпляр
+counter_update_forwarder = CounterUpdateForwarder()
+
+
+def start_counter_update_forwarder():
+    """Подписаться на обновления счетчиков (startup WebSocket-сервера)"""
+    if os.getenv("COUNTER_PUSH_ENABLED", "true").lower() != "true":
+        return
+    counter_update_forwarder.start()
+
+
+async def stop_counter_update_forwarder():
+    """Отписаться от обновлений счетчиков (shutdown WebSocket-сервера)"""
+    await counter_update_forwarder.stop()
@@ -1,8 +1,18 @@
 from sqlalchemy.ext.declarative import declarative_base
 import os
+import asyncio
+import logging
+import itertools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from enum import Enum
+from typing import Dict, List, Optional, Any
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
+logger = logging.getLogger(__name__)
+
 # Create declarative base
 Base = declarative_base()
 
@@ -13,23 +23,268 @@ DB_NAME = os.getenv("DB_NAME", "social_network")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
 
+# Реплики для чтения: "host1:5432,host2:5432". Пусто - все чтения идут на мастер
+DB_REPLICA_HOSTS = os.getenv("DB_REPLICA_HOSTS", "")
+# Реплика с отставанием больше порога выводится из ротации
+DB_REPLICA_MAX_LAG_SEC = float(os.getenv("DB_REPLICA_MAX_LAG_SEC", "5"))
+DB_REPLICA_CHECK_INTERVAL_SEC = float(os.getenv("DB_REPLICA_CHECK_INTERVAL_SEC", "1"))
+DB_REPLICA_CHECK_TIMEOUT_SEC = float(os.getenv("DB_REPLICA_CHECK_TIMEOUT_SEC", "2"))
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", "10"))
+
+
+def _database_url(host: str, port: str) -> str:
+    return f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{host}:{port}/{DB_NAME}"
+
+
 # Create async engine for Citus coordinator
 # Все запросы теперь идут через координатор, который сам распределяет нагрузку между шардами
 citus_engine = create_async_engine(
-    f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
+    _database_url(DB_HOST, DB_PORT),
     echo=False
 )
 
 # Create session factory
 citus_session_factory = sessionmaker(citus_engine, class_=AsyncSession, expire_on_commit=False)
 
+# Отставание реплики: 0, если все принятые WAL уже применены (мастер простаивает),
+# иначе - время с момента последней примененной транзакции. Плюс позиция применения WAL в байтах
+# и статус приемника WAL (NULL - приемник не запущен). Без приемника принятое равно
+# примененному, и отставание выглядит нулевым, поэтому такая реплика выводится из ротации.
+REPLICA_LAG_SQL = """
+SELECT pg_is_in_recovery(),
+       CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END,
+       pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0'),
+       (SELECT status FROM pg_stat_wal_receiver)
+"""
+
+# Минимальная позиция WAL, которую должна применить реплика для чтений текущего запроса
+_read_min_lsn: ContextVar[Optional[int]] = ContextVar("read_min_lsn", default=None)
+
+
+def parse_lsn(value: str) -> int:
+    """'16/B374D848' -> позиция WAL в байтах"""
+    high, _, low = value.strip().partition("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def format_lsn(value: int) -> str:
+    return f"{value >> 32:X}/{value & 0xFFFFFFFF:X}"
+
+
+def set_read_min_lsn(lsn: Optional[int]):
+    """Требовать для чтений текущего контекста реплику, применившую WAL не ниже lsn"""
+    current = _read_min_lsn.get()
+    if lsn is not None and (current is None or lsn > current):
+        _read_min_lsn.set(lsn)
+
+
+async def current_wal_lsn(session: AsyncSession) -> int:
+    """Текущая позиция WAL мастера; после коммита она не меньше LSN коммита"""
+    result = await session.execute(text("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')"))
+    return int(result.scalar_one())
+
+
+class Durability(Enum):
+    """
+    Класс надежности записи - значение synchronous_commit для транзакции.
+    Глобальная настройка кластера (кворумная репликация) остается для операций,
+    которые не объявили свой класс. Под Citus класс действует и на транзакции
+    воркеров: SET LOCAL передается им через citus.propagate_set_commands.
+    """
+    OFF = "off"                    # подтверждение до сброса WAL на диск, потеря последних транзакций при падении
+    LOCAL = "local"                # сброс WAL на мастере, без ожидания реплик
+    REMOTE_WRITE = "remote_write"  # реплики получили WAL (в кэш ОС)
+    ON = "on"                      # реплики сбросили WAL на диск
+    REMOTE_APPLY = "remote_apply"  # реплики применили WAL, запись сразу видна при чтении с них
+
+
+def _apply_durability(session: AsyncSession, durability: Durability) -> AsyncSession:
+    # SET LOCAL действует до конца транзакции, поэтому выполняется в начале каждой транзакции сессии.
+    # Без propagate_set_commands Citus не передает SET LOCAL воркерам, и записи в шарды
+    # распределенных таблиц коммитятся с глобальной настройкой. Вне Citus параметр
+    # с точкой в имени - пользовательский и ни на что не влияет.
+    statements = [
+        "SET LOCAL citus.propagate_set_commands TO 'local'",
+        f"SET LOCAL synchronous_commit TO {durability.value}",
+    ]
+
+    @event.listens_for(session.sync_session, "after_begin")
+    def _set_synchronous_commit(sync_session, transaction, connection):
+        for statement in statements:
+            connection.exec_driver_sql(statement)
+
+    return session
+
+
+class Replica:
+    """Реплика для чтения и ее текущее состояние"""
+
+    def __init__(self, host: str, port: str):
+        self.name = f"{host}:{port}"
+        self.engine = create_async_engine(
+            _database_url(host, port),
+            echo=False,
+            pool_size=DB_REPLICA_POOL_SIZE,
+            pool_pre_ping=True,
+            connect_args={
+                "server_settings": {"application_name": "social_network_replica_reader"},
+                "command_timeout": 10
+            }
+        )
+        self.session_factory = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.in_rotation = False
+        self.lag_sec: Optional[float] = None
+        self.receiver_status: Optional[str] = None
+        self.replay_lsn = 0
+        self.outstanding = 0
+        self.last_error: Optional[str] = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "in_rotation": self.in_rotation,
+            "lag_sec": self.lag_sec,
+            "receiver_status": self.receiver_status,
+            "replay_lsn": format_lsn(self.replay_lsn),
+            "outstanding": self.outstanding,
+            "last_error": self.last_error
+        }
+
+
+class SessionRouter:
+    """
+    Маршрутизатор сессий: запись - на мастер, чтение - на наименее загруженную
+    из здоровых реплик (least outstanding requests). Фоновая проверка измеряет
+    отставание реплик и выводит отстающие из ротации. Если подходящих реплик нет,
+    чтение выполняется на мастере.
+    """
+
+    def __init__(self, master_factory, replicas: List[Replica]):
+        self.master_factory = master_factory
+        self.replicas = replicas
+        self._rr = itertools.count()
+        self._health_task: Optional[asyncio.Task] = None
+
+    def master_session(self, durability: Optional[Durability] = None) -> AsyncSession:
+        session = self.master_factory()
+        if durability is not None:
+            _apply_durability(session, durability)
+        return session
+
+    def pick_replica(self, min_lsn: Optional[int] = None) -> Optional[Replica]:
+        candidates = [
+            r for r in self.replicas
+            if r.in_rotation and (min_lsn is None or r.replay_lsn >= min_lsn)
+        ]
+        if not candidates:
+            return None
+        # Сдвиг начала обхода разводит равные по нагрузке реплики по кругу
+        shift = next(self._rr) % len(candidates)
+        candidates = candidates[shift:] + candidates[:shift]
+        return min(candidates, key=lambda r: r.outstanding)
+
+    @asynccontextmanager
+    async def read_session(self):
+        # Если пользователь недавно писал, подходит только реплика, применившая его запись
+        replica = self.pick_replica(_read_min_lsn.get())
+        if replica is None:
+            async with self.master_factory() as session:
+                yield session
+            return
+        replica.outstanding += 1
+        try:
+            async with replica.session_factory() as session:
+                yield session
+        finally:
+            replica.outstanding -= 1
+
+    async def _measure_lag(self, replica: Replica):
+        async with replica.engine.connect() as conn:
+            result = await conn.execute(text(REPLICA_LAG_SQL))
+            return result.one()
+
+    async def _check_replica(self, replica: Replica):
+        try:
+            in_recovery, lag, replay_lsn, receiver_status = await asyncio.wait_for(
+                self._measure_lag(replica), timeout=DB_REPLICA_CHECK_TIMEOUT_SEC
+            )
+            replica.lag_sec = float(lag) if lag is not None else None
+            replica.replay_lsn = int(replay_lsn) if replay_lsn is not None else 0
+            replica.receiver_status = receiver_status
+            replica.last_error = None if receiver_status == "streaming" else f"WAL receiver {receiver_status or 'down'}"
+            # Не в режиме восстановления - это уже не реплика (например, после failover)
+            in_rotation = (
+                bool(in_recovery)
+                and receiver_status == "streaming"
+                and replica.lag_sec is not None
+                and replica.lag_sec <= DB_REPLICA_MAX_LAG_SEC
+            )
+        except Exception as e:
+            replica.last_error = str(e)
+            in_rotation = False
+        if in_rotation != replica.in_rotation:
+            logger.warning(
+                f"Replica {replica.name} {'returned to' if in_rotation else 'removed from'} rotation "
+                f"(lag={replica.lag_sec}, error={replica.last_error})"
+            )
+        replica.in_rotation = in_rotation
+
+    async def check_replicas(self):
+        await asyncio.gather(*(self._check_replica(r) for r in self.replicas))
+
+    async def _health_loop(self):
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL_SEC)
+
+    async def start(self):
+        if not self.replicas:
+            return
+        if self._health_task is None or self._health_task.done():
+            await self.check_replicas()
+            self._health_task = asyncio.create_task(self._health_loop())
+            logger.info(f"Session router started with replicas: {[r.name for r in self.replicas]}")
+
+    async def stop(self):
+        if self._health_task and not self._health_task.done():
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._health_task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def get_status(self) -> List[Dict[str, Any]]:
+        return [r.status() for r in self.replicas]
+
+
+def _parse_replicas(spec: str) -> List[Replica]:
+    replicas = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, port = item.partition(":")
+        replicas.append(Replica(host, port or "5432"))
+    return replicas
+
+
+session_router = SessionRouter(citus_session_factory, _parse_replicas(DB_REPLICA_HOSTS))
+
 # Function to get a database session
 def get_db_session():
     return citus_session_factory()
 
 # Для обратной совместимости с существующим кодом
-def get_master_session():
-    return get_db_session()
+def get_master_session(durability: Optional[Durability] = None):
+    return session_router.master_session(durability)
 
 def get_slave_session():
-    return get_db_session()
+    return session_router.read_session()
+
+async def start_session_router():
+    await session_router.start()
+
+async def stop_session_router():
+    await session_router.stop()
@@ -1,19 +1,19 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from contextlib import contextmanager
-from sqlalchemy import select
+from sqlalchemy import select, text
 from datetime import datetime, timedelta
 import secrets
 import uuid
-from typing import List
+from typing import List, Optional
 import os
 
 # Стандартный режим для ДЗ-10
-from packages.common.database import get_slave_session, get_master_session
+from packages.common.database import get_slave_session, get_master_session, session_router, Durability
 print("🔧 Загружен модуль packages.common.database")
 
 def get_db_info():
-    return {"mode": "standard", "use_haproxy": False}
+    return {"mode": "standard", "use_haproxy": False, "replicas": session_router.get_status()}
 
 # Import models after database is initialized to avoid circular imports
 from packages.common.models import User, AuthToken, Friendship, DialogMessage
@@ -21,7 +21,47 @@ from packages.common.models import User, AuthToken, Friendship, DialogMessage
 async def get_user_by_id(user_id: str) -> User:
     async with get_slave_session() as session:
         result = await session.execute(select(User).where(User.id == user_id))
-        return result.scalar_one_or_none()
+        user = result.scalar_one_or_none()
+    if user is None and session_router.replicas:
+        # Только что зарегистрированный пользователь мог еще не доехать до реплики
+        async with get_master_session() as session:
+            result = await session.execute(select(User).where(User.id == user_id))
+            user = result.scalar_one_or_none()
+    return user
+
+async def get_user_profile(user_id: str) -> Optional[dict]:
+    """
+    Get a public user profile, cache first.
+    
+    With users distributed by id a miss is a single-shard router query,
+    so profile reads never fan out across workers.
+    
+    Args:
+        user_id: The ID of the user
+        
+    Returns:
+        Profile dictionary without credentials, or None if the user does not exist
+    """
+    from packages.common.cache import redis_cache
+    
+    profile = await redis_cache.get_user_profile(user_id)
+    if profile:
+        return profile
+    
+    user = await get_user_by_id(user_id)
+    if not user:
+        return None
+    
+    profile = {
+        "id": str(user.id),
+        "first_name": user.first_name,
+        "second_name": user.second_name,
+        "birthdate": user.birthdate.isoformat(),
+        "biography": user.biography,
+        "city": user.city
+    }
+    await redis_cache.cache_user_profile(str(user.id), profile)
+    return profile
 
 async def get_user_by_token(token: str) -> uuid.UUID:
     print(f"DEBUG: get_user_by_token called with token: {token}")
@@ -32,22 +72,28 @@ async def get_user_by_token(token: str) -> uuid.UUID:
             token_query = select(AuthToken).where(AuthToken.token == token)
             token_result = await session.execute(token_query)
             auth_token = token_result.scalar_one_or_none()
-            
-            if not auth_token:
-                print(f"DEBUG: Token not found in database")
-                return None
-            
-            # Token exists, now check if it's expired
-            current_time = datetime.now()
-            print(f"DEBUG: Token found. Expires at: {auth_token.expires_at}, Current time: {current_time}")
-            
-            # Force comparison without timezone info
-            if auth_token.expires_at.replace(tzinfo=None) > current_time.replace(tzinfo=None):
-                print(f"DEBUG: Token is valid")
-                return auth_token.user_id
-            else:
-                print(f"DEBUG: Token is expired")
-                return None
+        
+        if not auth_token and session_router.replicas:
+            # Токен, выданный только что, мог еще не доехать до реплики
+            async with get_master_session() as session:
+                token_result = await session.execute(token_query)
+                auth_token = token_result.scalar_one_or_none()
+        
+        if not auth_token:
+            print(f"DEBUG: Token not found in database")
+            return None
+        
+        # Token exists, now check if it's expired
+        current_time = datetime.now()
+        print(f"DEBUG: Token found. Expires at: {auth_token.expires_at}, Current time: {current_time}")
+        
+        # Force comparison without timezone info
+        if auth_token.expires_at.replace(tzinfo=None) > current_time.replace(tzinfo=None):
+            print(f"DEBUG: Token is valid")
+            return auth_token.user_id
+        else:
+            print(f"DEBUG: Token is expired")
+            return None
     except Exception as e:
         print(f"ERROR: Exception in get_user_by_token: {str(e)}")
         print(f"ERROR: Exception type: {type(e)}")
@@ -55,16 +101,83 @@ async def get_user_by_token(token: str) -> uuid.UUID:
         print(f"ERROR: Traceback: {traceback.format_exc()}")
         raise
 
+AUTH_TOKEN_TTL = timedelta(days=1)
+# Повторно выдавать еще действующий токен пользователя вместо вставки новой строки на каждый логин
+AUTH_TOKEN_REUSE = os.getenv("AUTH_TOKEN_REUSE", "false").lower() == "true"
+# Минимальный остаток срока жизни токена, при котором его можно выдать повторно
+AUTH_TOKEN_REUSE_MIN_REMAINING = timedelta(seconds=int(os.getenv("AUTH_TOKEN_REUSE_MIN_REMAINING_SEC", "3600")))
+
+AUTH_TOKEN_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_auth_tokens_expires_at ON auth_tokens(expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_auth_tokens_user_expires ON auth_tokens(user_id, expires_at)",
+]
+
+
+async def ensure_auth_token_indexes():
+    async with get_master_session() as session:
+        for statement in AUTH_TOKEN_INDEXES_SQL:
+            await session.execute(text(statement))
+        await session.commit()
+
+
 async def create_auth_token(user_id: uuid.UUID) -> str:
     async with get_master_session() as session:
+        if AUTH_TOKEN_REUSE:
+            # Индекс (user_id, expires_at) делает поиск действующего токена точечным
+            result = await session.execute(
+                select(AuthToken.token)
+                .where(
+                    AuthToken.user_id == user_id,
+                    AuthToken.expires_at > datetime.now() + AUTH_TOKEN_REUSE_MIN_REMAINING
+                )
+                .order_by(AuthToken.expires_at.desc())
+                .limit(1)
+            )
+            existing_token = result.scalar_one_or_none()
+            if existing_token:
+                return existing_token
+        
         token = secrets.token_hex(32)
-        expires_at = datetime.now() + timedelta(days=1)
+        expires_at = datetime.now() + AUTH_TOKEN_TTL
         auth_token = AuthToken(token=token, user_id=user_id, expires_at=expires_at)
         session.add(auth_token)
         await session.commit()
         return token
 
 
+async def purge_expired_tokens(batch_size: int = 1000, max_batches: int = 100) -> int:
+    """
+    Delete expired auth tokens in bounded batches
+    
+    Args:
+        batch_size: Maximum number of rows deleted per transaction
+        max_batches: Maximum number of batches per call
+        
+    Returns:
+        Number of deleted tokens
+    """
+    deleted_total = 0
+    for _ in range(max_batches):
+        async with get_master_session() as session:
+            result = await session.execute(
+                text("""
+                DELETE FROM auth_tokens
+                WHERE token IN (
+                    SELECT token FROM auth_tokens
+                    WHERE expires_at < :now
+                    ORDER BY expires_at
+                    LIMIT :batch_size
+                )
+                """),
+                {"now": datetime.now(), "batch_size": batch_size}
+            )
+            await session.commit()
+        deleted_total += result.rowcount
+        if result.rowcount < batch_size:
+            break
+    return deleted_total
+
+
 async def get_user_friends(user_id: str) -> List[str]:
     """
     Get a list of friend IDs for a user
@@ -82,7 +195,7 @@ async def get_user_friends(user_id: str) -> List[str]:
         friend_ids = [str(row[0]) for row in result.all()]
         return friend_ids
 
-async def save_dialog_message(from_user_id: str, to_user_id: str, text: str) -> str:
+async def save_dialog_message(from_user_id: str, to_user_id: str, text: str, session=None) -> str:
     """
     Save a new dialog message
     
@@ -90,20 +203,27 @@ async def save_dialog_message(from_user_id: str, to_user_id: str, text: str) ->
         from_user_id: ID of the message sender
         to_user_id: ID of the message recipient
         text: Message text
+        session: Open master session; when given, the message joins the caller's
+            transaction and the caller commits
         
     Returns:
         ID of the created message
     """
     message_id = uuid.uuid4()
-    async with get_master_session() as session:
-        message = DialogMessage(
-            id=message_id,
-            from_user_id=from_user_id,
-            to_user_id=to_user_id,
-            text=text
-        )
+    message = DialogMessage(
+        id=message_id,
+        from_user_id=from_user_id,
+        to_user_id=to_user_id,
+        text=text
+    )
+    if session is not None:
         session.add(message)
-        await session.commit()
+        return str(message_id)
+    
+    # Сообщение переживает падение мастера, но не ждет подтверждения реплик
+    async with get_master_session(Durability.LOCAL) as own_session:
+        own_session.add(message)
+        await own_session.commit()
     
     return str(message_id)
 
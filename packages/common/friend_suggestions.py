@@ -0,0 +1,155 @@
+"""
+Пакетный расчет рекомендаций "друзья друзей".
+
+Граф дружбы загружается из таблицы friends в разреженную матрицу смежности A
+(строка - пользователь, столбец - его друг). Произведение A[shard] @ A дает для
+каждого пользователя число путей длины 2 до кандидата, то есть количество общих
+друзей. Расчет ведется блоками строк, чтобы ограничить потребление памяти,
+а результаты (top-K кандидатов) сохраняются в Redis и отдаются эндпоинтом
+/friend/suggestions одним GET.
+"""
+
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+from packages.common.cache import redis_cache
+from packages.common.database import get_slave_session
+from packages.common.models import Friendship
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_K = 20
+DEFAULT_SHARD_SIZE = 5000
+LOAD_BATCH_SIZE = 50000
+
+
+async def load_friend_graph() -> Tuple[List[str], sparse.csr_matrix]:
+    """
+    Загрузить граф дружбы в разреженную матрицу
+
+    Returns:
+        Список ID пользователей (индекс строки -> ID) и CSR-матрица смежности
+    """
+    index: Dict[str, int] = {}
+    user_ids: List[str] = []
+    rows: List[int] = []
+    cols: List[int] = []
+
+    def _idx(user_id: str) -> int:
+        pos = index.get(user_id)
+        if pos is None:
+            pos = len(user_ids)
+            index[user_id] = pos
+            user_ids.append(user_id)
+        return pos
+
+    async with get_slave_session() as session:
+        result = await session.stream(
+            select(Friendship.user_id, Friendship.friend_id).execution_options(yield_per=LOAD_BATCH_SIZE)
+        )
+        async for partition in result.partitions(LOAD_BATCH_SIZE):
+            for user_id, friend_id in partition:
+                rows.append(_idx(str(user_id)))
+                cols.append(_idx(str(friend_id)))
+
+    n = len(user_ids)
+    data = np.ones(len(rows), dtype=np.int32)
+    adjacency = sparse.csr_matrix(
+        (data, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+        shape=(n, n),
+    )
+    # Дубликаты ребер (если есть) схлопываются в одно
+    adjacency.data[:] = 1
+    return user_ids, adjacency
+
+
+def compute_shard_suggestions(adjacency: sparse.csr_matrix, start: int, end: int,
+                              top_k: int) -> List[List[Tuple[int, int]]]:
+    """
+    Посчитать top-K кандидатов для строк [start, end)
+
+    Args:
+        adjacency: CSR-матрица смежности
+        start: Первая строка блока
+        end: Строка, следующая за последней строкой блока
+        top_k: Количество кандидатов на пользователя
+
+    Returns:
+        Для каждой строки блока список пар (индекс кандидата, число общих друзей)
+    """
+    shard = adjacency[start:end]
+    paths = shard @ adjacency
+
+    # Исключаем уже существующих друзей и самого пользователя
+    paths = paths - paths.multiply(shard)
+    self_mask = sparse.csr_matrix(
+        (np.ones(end - start, dtype=np.int32), (np.arange(end - start), np.arange(start, end))),
+        shape=paths.shape,
+    )
+    paths = paths - paths.multiply(self_mask)
+    paths = sparse.csr_matrix(paths)
+    paths.eliminate_zeros()
+
+    result: List[List[Tuple[int, int]]] = []
+    indptr, indices, data = paths.indptr, paths.indices, paths.data
+    for row in range(end - start):
+        lo, hi = indptr[row], indptr[row + 1]
+        if lo == hi:
+            result.append([])
+            continue
+        row_data = data[lo:hi]
+        row_indices = indices[lo:hi]
+        if hi - lo > top_k:
+            top = np.argpartition(-row_data, top_k - 1)[:top_k]
+        else:
+            top = np.arange(hi - lo)
+        # Сортируем по числу общих друзей, при равенстве - по индексу для стабильности
+        order = top[np.lexsort((row_indices[top], -row_data[top]))]
+        result.append([(int(row_indices[i]), int(row_data[i])) for i in order])
+    return result
+
+
+async def run_friend_suggestions_job(top_k: int = DEFAULT_TOP_K,
+                                     shard_size: int = DEFAULT_SHARD_SIZE) -> Dict[str, int]:
+    """
+    Полный прогон расчета рекомендаций с записью результатов в Redis
+
+    Args:
+        top_k: Количество кандидатов на пользователя
+        shard_size: Количество строк матрицы в одном блоке
+
+    Returns:
+        Статистика прогона
+    """
+    started = time.monotonic()
+    user_ids, adjacency = await load_friend_graph()
+    n = len(user_ids)
+    logger.info(f"Friend graph loaded: {n} users, {adjacency.nnz} edges")
+
+    users_written = 0
+    for start in range(0, n, shard_size):
+        end = min(start + shard_size, n)
+        shard_result = compute_shard_suggestions(adjacency, start, end, top_k)
+        suggestions = {
+            user_ids[start + row]: [
+                {"user_id": user_ids[candidate], "mutual_friends": mutual}
+                for candidate, mutual in candidates
+            ]
+            for row, candidates in enumerate(shard_result)
+        }
+        users_written += await redis_cache.cache_friend_suggestions(suggestions)
+        logger.info(f"Friend suggestions shard {start}-{end} of {n} written")
+
+    stats = {
+        "users": n,
+        "edges": int(adjacency.nnz),
+        "users_written": users_written,
+        "elapsed_ms": int((time.monotonic() - started) * 1000),
+    }
+    logger.info(f"Friend suggestions job finished: {stats}")
+    return stats
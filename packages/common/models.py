@@ -66,12 +66,18 @@ class DialogMessageRequest(BaseModel):
 
 
 class DialogMessageResponse(BaseModel):
+    id: Optional[str] = Field(None, description="Идентификатор сообщения (в Redis Streams - ID записи потока, курсор пагинации)")
     from_user_id: str = Field(..., description="Идентификатор отправителя")
     to_user_id: str = Field(..., description="Идентификатор получателя")
     text: str = Field(..., description="Текст сообщения")
     created_at: datetime = Field(..., description="Время создания сообщения")
 
 
+class FriendSuggestionResponse(BaseModel):
+    user_id: str = Field(..., description="Идентификатор рекомендуемого пользователя")
+    mutual_friends: int = Field(..., description="Количество общих друзей")
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -0,0 +1,52 @@
+"""
+Фоновая очистка просроченных токенов авторизации.
+
+auth_tokens - reference-таблица Citus, поэтому без очистки она растет на всех узлах.
+Удаление идет ограниченными батчами по индексу expires_at, чтобы не держать
+длинных транзакций и не создавать всплесков нагрузки на репликацию.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from packages.common.db import purge_expired_tokens
+
+logger = logging.getLogger(__name__)
+
+purge_task: Optional[asyncio.Task] = None
+
+
+async def _purge_loop():
+    interval = int(os.getenv("AUTH_TOKEN_PURGE_INTERVAL_SEC", "600"))
+    batch_size = int(os.getenv("AUTH_TOKEN_PURGE_BATCH_SIZE", "1000"))
+    max_batches = int(os.getenv("AUTH_TOKEN_PURGE_MAX_BATCHES", "100"))
+    while True:
+        try:
+            deleted = await purge_expired_tokens(batch_size=batch_size, max_batches=max_batches)
+            if deleted:
+                logger.info(f"Purged {deleted} expired auth tokens")
+        except Exception as e:
+            logger.error(f"Error purging expired auth tokens: {e}")
+        await asyncio.sleep(interval)
+
+
+async def start_token_purge():
+    global purge_task
+    if os.getenv("AUTH_TOKEN_PURGE_ENABLED", "true").lower() != "true":
+        return
+    if purge_task is None or purge_task.done():
+        purge_task = asyncio.create_task(_purge_loop())
+        logger.info("Auth token purge started")
+
+
+async def stop_token_purge():
+    global purge_task
+    if purge_task and not purge_task.done():
+        purge_task.cancel()
+        try:
+            await purge_task
+        except (asyncio.CancelledError, Exception):
+            pass
+    purge_task = None
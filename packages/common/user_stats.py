@@ -0,0 +1,286 @@
+"""
+Инкрементальные счетчики друзей и постов пользователей.
+
+Счетчики хранятся в двух местах:
+- колонки users.friends_count / users.post_count обновляются в той же транзакции,
+  что и вставка/удаление строки в friends/posts;
+- sorted set'ы Redis (stats:friends_count, stats:post_count) обновляются после коммита
+  и дают O(log n) проверку статуса знаменитости и top-N выборки.
+
+Периодическая сверка пересчитывает значения по исходным таблицам и исправляет расхождения.
+Сверку в каждый интервал выполняет один экземпляр API (аренда в Redis).
+
+Колонки создаются миграцией deploy/sql/user_counters.sql, а не при старте API.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from packages.common.cache import redis_cache
+from packages.common.database import get_master_session
+
+logger = logging.getLogger(__name__)
+
+FRIENDS_COUNT_KEY = "stats:friends_count"
+POST_COUNT_KEY = "stats:post_count"
+
+# Колонка в users -> ключ sorted set'а в Redis
+COUNTER_COLUMNS = {
+    "friends_count": FRIENDS_COUNT_KEY,
+    "post_count": POST_COUNT_KEY,
+}
+
+# Агрегаты по исходным таблицам для сверки
+SOURCE_QUERIES = {
+    "friends_count": "SELECT user_id, COUNT(*) FROM friends GROUP BY user_id",
+    "post_count": "SELECT author_user_id, COUNT(*) FROM posts GROUP BY author_user_id",
+}
+
+RECONCILE_CHUNK_SIZE = 1000
+RECONCILE_INTERVAL_SEC = int(os.getenv("USER_STATS_RECONCILE_INTERVAL_SEC", "3600"))
+# Аренда сверки не отпускается по окончании: остальные экземпляры пропускают этот интервал
+RECONCILE_LEASE_KEY = "stats:reconcile:lease"
+# Пауза перед исправлением sorted set'а: ZINCRBY выполняется после коммита,
+# и за это время отложенные инкременты успевают дойти до Redis
+RECONCILE_ZSET_GRACE_SEC = float(os.getenv("USER_STATS_RECONCILE_ZSET_GRACE_SEC", "5"))
+
+# Инкремент и удаление обнулившегося элемента одной операцией: между ZINCRBY
+# и ZREM не вклинится чужой инкремент, который ZREM бы стер
+# KEYS: sorted set; ARGV: user_id, delta
+# Возвращает новое значение (0, если элемент удален)
+ZSET_INCR_LUA = """
+local value = tonumber(redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1]))
+if value <= 0 then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    return 0
+end
+return value
+"""
+
+# Исправление счетчиков в sorted set'е только у тех, чье значение не менялось
+# с момента чтения (аналог UPDATE ... AND {column} = :stored): ZINCRBY,
+# прошедший во время сверки, не затирается.
+# KEYS: sorted set; ARGV: user_id_1, expected_1, value_1, user_id_2, ...
+# Возвращает число исправленных пользователей
+ZSET_CAS_LUA = """
+local applied = 0
+for i = 1, #ARGV, 3 do
+    local current = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[i]) or '0')
+    if current == tonumber(ARGV[i + 1]) then
+        if tonumber(ARGV[i + 2]) > 0 then
+            redis.call('ZADD', KEYS[1], ARGV[i + 2], ARGV[i])
+        else
+            redis.call('ZREM', KEYS[1], ARGV[i])
+        end
+        applied = applied + 1
+    end
+end
+return applied
+"""
+
+async def increment_counter_column(session, user_id: str, column: str, delta: int):
+    """
+    Изменить колонку-счетчик в рамках транзакции вызывающего кода
+
+    Args:
+        session: Открытая сессия, в которой выполняется основная запись
+        user_id: ID пользователя
+        column: Имя колонки (friends_count или post_count)
+        delta: Приращение
+    """
+    if column not in COUNTER_COLUMNS:
+        raise ValueError(f"Unknown counter column: {column}")
+    await session.execute(
+        text(f"UPDATE users SET {column} = GREATEST({column} + :delta, 0) WHERE id = :user_id"),
+        {"delta": delta, "user_id": user_id},
+    )
+
+
+class UserStats:
+    """Счетчики друзей и постов в sorted set'ах Redis"""
+
+    async def _incr(self, key: str, user_id: str, delta: int) -> Optional[int]:
+        client = redis_cache.client
+        if not client:
+            return None
+        try:
+            script = client.register_script(ZSET_INCR_LUA)
+            return int(await script(keys=[key], args=[str(user_id), delta]))
+        except Exception as e:
+            logger.error(f"Error updating {key} for user {user_id}: {e}")
+            return None
+
+    async def incr_friends(self, user_id: str, delta: int = 1) -> Optional[int]:
+        return await self._incr(FRIENDS_COUNT_KEY, user_id, delta)
+
+    async def incr_posts(self, user_id: str, delta: int = 1) -> Optional[int]:
+        return await self._incr(POST_COUNT_KEY, user_id, delta)
+
+    async def get_friends_count(self, user_id: str) -> int:
+        client = redis_cache.client
+        if not client:
+            return 0
+        score = await client.zscore(FRIENDS_COUNT_KEY, str(user_id))
+        return int(score) if score else 0
+
+    async def get_post_count(self, user_id: str) -> int:
+        client = redis_cache.client
+        if not client:
+            return 0
+        score = await client.zscore(POST_COUNT_KEY, str(user_id))
+        return int(score) if score else 0
+
+    async def count_at_least(self, key: str, threshold: int) -> int:
+        client = redis_cache.client
+        if not client:
+            return 0
+        return await client.zcount(key, threshold, "+inf")
+
+    async def top(self, key: str, limit: int, min_score: int = 0) -> List[Tuple[str, int]]:
+        """Top-N пользователей по счетчику (по убыванию) не ниже min_score"""
+        client = redis_cache.client
+        if not client:
+            return []
+        rows = await client.zrevrangebyscore(key, "+inf", min_score, start=0, num=limit, withscores=True)
+        return [(member, int(score)) for member, score in rows]
+
+    async def _acquire_reconcile_lease(self) -> bool:
+        client = redis_cache.client
+        if not client:
+            # Без Redis исправляются только колонки, а их UPDATE защищен условием
+            return True
+        token = uuid.uuid4().hex
+        return bool(await client.set(RECONCILE_LEASE_KEY, token, nx=True, ex=max(1, RECONCILE_INTERVAL_SEC - 1)))
+
+    async def reconcile(self, force: bool = False) -> Dict[str, int]:
+        """
+        Сверить счетчики с исходными таблицами
+
+        Args:
+            force: Не проверять аренду (ручной запуск)
+
+        Returns:
+            Количество исправленных строк users и элементов sorted set'ов по каждой колонке
+        """
+        fixed: Dict[str, int] = {}
+        if not force and not await self._acquire_reconcile_lease():
+            logger.debug("User stats reconcile is held by another instance")
+            return fixed
+        for column, key in COUNTER_COLUMNS.items():
+            # Агрегат и колонка читаются из одного снимка мастера: на реплике или в двух
+            # снимках запись между чтениями выглядела бы расхождением
+            async with get_master_session() as session:
+                # Уровень изоляции задается до BEGIN, чтобы не конфликтовать с SET LOCAL сессии
+                await session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+                result = await session.execute(text(SOURCE_QUERIES[column]))
+                actual = {str(row[0]): int(row[1]) for row in result.fetchall()}
+                result = await session.execute(
+                    text(f"SELECT id, {column} FROM users WHERE {column} <> 0")
+                )
+                stored = {str(row[0]): int(row[1]) for row in result.fetchall()}
+                await session.commit()
+
+            changes = [
+                {"user_id": user_id, "value": actual.get(user_id, 0), "stored": stored.get(user_id, 0)}
+                for user_id in set(actual) | set(stored)
+                if actual.get(user_id, 0) != stored.get(user_id, 0)
+            ]
+            for i in range(0, len(changes), RECONCILE_CHUNK_SIZE):
+                async with get_master_session() as session:
+                    # Условие на прочитанное значение не дает затереть инкременты, прошедшие во время сверки
+                    await session.execute(
+                        text(f"UPDATE users SET {column} = :value WHERE id = :user_id AND {column} = :stored"),
+                        changes[i:i + RECONCILE_CHUNK_SIZE],
+                    )
+                    await session.commit()
+            fixed[column] = len(changes)
+
+            fixed[f"{column}_redis"] = await self._sync_sorted_set(column, key)
+        logger.info(f"User stats reconciled: {fixed}")
+        return fixed
+
+    async def _sync_sorted_set(self, column: str, key: str) -> int:
+        """
+        Привести sorted set к колонке users на мастере, меняя только расходящиеся элементы
+
+        ZINCRBY выполняется после коммита колонки, поэтому расхождение может быть
+        инкрементом "в пути": колонка уже изменена, а score еще нет. Исправление
+        применяется только к расхождениям, которые дожили до повторного чтения
+        колонок через RECONCILE_ZSET_GRACE_SEC: дошедший за это время ZINCRBY
+        меняет score, и CAS его не затирает, а изменившаяся колонка откладывает
+        исправление до следующей сверки.
+
+        Returns:
+            Количество исправленных элементов
+        """
+        client = redis_cache.client
+        if not client:
+            return 0
+        cached: Dict[str, int] = {}
+        async for member, score in client.zscan_iter(key, count=RECONCILE_CHUNK_SIZE):
+            cached[str(member)] = int(score)
+        values = await self._read_column(column)
+
+        candidates = [
+            user_id for user_id in set(cached) | set(values)
+            if cached.get(user_id, 0) != values.get(user_id, 0)
+        ]
+        if not candidates:
+            return 0
+        await asyncio.sleep(RECONCILE_ZSET_GRACE_SEC)
+        rechecked = await self._read_column(column)
+        changes = [
+            (user_id, cached.get(user_id, 0), values.get(user_id, 0))
+            for user_id in candidates
+            if rechecked.get(user_id, 0) == values.get(user_id, 0)
+        ]
+        script = client.register_script(ZSET_CAS_LUA)
+        applied = 0
+        for i in range(0, len(changes), RECONCILE_CHUNK_SIZE):
+            args = [arg for change in changes[i:i + RECONCILE_CHUNK_SIZE] for arg in change]
+            applied += int(await script(keys=[key], args=args))
+        return applied
+
+    async def _read_column(self, column: str) -> Dict[str, int]:
+        async with get_master_session() as session:
+            result = await session.execute(text(f"SELECT id, {column} FROM users WHERE {column} <> 0"))
+            return {str(row[0]): int(row[1]) for row in result.fetchall()}
+
+
+user_stats = UserStats()
+
+reconcile_task: Optional[asyncio.Task] = None
+
+
+async def _reconcile_loop():
+    while True:
+        try:
+            await user_stats.reconcile()
+        except Exception as e:
+            logger.error(f"Error reconciling user stats: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL_SEC)
+
+
+async def start_user_stats_reconciler():
+    global reconcile_task
+    if os.getenv("USER_STATS_RECONCILE_ENABLED", "true").lower() != "true":
+        return
+    if reconcile_task is None or reconcile_task.done():
+        reconcile_task = asyncio.create_task(_reconcile_loop())
+        logger.info("User stats reconciler started")
+
+
+async def stop_user_stats_reconciler():
+    global reconcile_task
+    if reconcile_task and not reconcile_task.done():
+        reconcile_task.cancel()
+        try:
+            await reconcile_task
+        except (asyncio.CancelledError, Exception):
+            pass
+    reconcile_task = None
@@ -11,6 +11,8 @@ from websocket_models import (
     ErrorMessage,
     PostCreatedWebSocketMessage,
     PostCreatedEvent,
+    CounterUpdateEvent,
+    CounterUpdateWebSocketMessage,
     WebSocketMessageType
 )
 
@@ -204,6 +206,30 @@ class WebSocketManager:
         message = PostCreatedWebSocketMessage(data=event)
         return await self.send_to_multiple_users(user_ids, message.model_dump())
     
+    async def send_counter_update(self, user_id: str, peer_user_id: str, unread: int,
+                                  total_unread: int, delta: int) -> bool:
+        """
+        Отправить пользователю новые значения счетчиков непрочитанных
+        
+        Args:
+            user_id: ID пользователя, чьи счетчики изменились
+            peer_user_id: ID собеседника
+            unread: Непрочитанных от собеседника
+            total_unread: Всего непрочитанных
+            delta: Изменение счетчика собеседника
+            
+        Returns:
+            True если сообщение отправлено, False иначе
+        """
+        event = CounterUpdateEvent(
+            peer_user_id=peer_user_id,
+            unread=unread,
+            total_unread=total_unread,
+            delta=delta
+        )
+        message = CounterUpdateWebSocketMessage(data=event)
+        return await self.send_to_user(user_id, message.model_dump())
+    
     async def send_error_to_user(self, user_id: str, error_message: str) -> bool:
         """
         Отправить сообщение об ошибке пользователю
@@ -7,6 +7,7 @@ from enum import Enum
 class WebSocketMessageType(str, Enum):
     """Типы WebSocket сообщений"""
     POST_CREATED = "post_created"
+    COUNTER_UPDATE = "counter_update"
     CONNECTION_ACK = "connection_ack"
     ERROR = "error"
     PING = "ping"
@@ -36,6 +37,21 @@ class PostCreatedWebSocketMessage(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.now)
 
 
+class CounterUpdateEvent(BaseModel):
+    """Новые значения счетчиков непрочитанных по диалогу"""
+    peer_user_id: str = Field(..., description="Идентификатор собеседника")
+    unread: int = Field(..., description="Непрочитанных от собеседника")
+    total_unread: int = Field(..., description="Всего непрочитанных")
+    delta: int = Field(..., description="Изменение счетчика собеседника")
+
+
+class CounterUpdateWebSocketMessage(BaseModel):
+    """WebSocket сообщение об изменении счетчиков непрочитанных"""
+    type: WebSocketMessageType = Field(default=WebSocketMessageType.COUNTER_UPDATE)
+    data: CounterUpdateEvent = Field(..., description="Новые значения счетчиков")
+    timestamp: datetime = Field(default_factory=datetime.now)
+
+
 class ConnectionAckMessage(BaseModel):
     """Сообщение подтверждения подключения"""
     type: WebSocketMessageType = Field(default=WebSocketMessageType.CONNECTION_ACK)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Однократное заполнение индекса входящих (inbox:{to}:{from}) для диалогов
+Redis-бэкенда, записанных до появления индекса.
+
+Пока заполнение не выполнено, Counter Service пересчитывает непрочитанные по
+самому диалогу, если индекс начат позже маркера прочтения.
+
+Запуск из корня репозитория (REDIS_URL - Redis диалогов):
+    python scripts/backfill_inbox_index.py --batch-size 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.dialog.app.redis_adapter import RedisDialogAdapter
+
+
+async def main(batch_size: int):
+    adapter = RedisDialogAdapter(os.getenv("REDIS_URL", "redis://localhost:6379/1"))
+    await adapter.connect()
+    try:
+        stats = await adapter.backfill_inbox_index(batch_size)
+        print(f"✅ Индекс входящих заполнен: {stats}")
+    finally:
+        await adapter.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заполнение индекса входящих для существующих диалогов")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Сообщений на один pipeline")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
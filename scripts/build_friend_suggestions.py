@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Пакетный расчет рекомендаций друзей (друзья друзей) с записью в Redis.
+
+Запуск из корня репозитория:
+    python scripts/build_friend_suggestions.py --top-k 20 --shard-size 5000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from packages.common.cache import redis_cache
+from packages.common.friend_suggestions import (
+    DEFAULT_SHARD_SIZE,
+    DEFAULT_TOP_K,
+    run_friend_suggestions_job,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main(top_k: int, shard_size: int):
+    if not await redis_cache.ping():
+        print("❌ Redis недоступен, рекомендации некуда сохранять")
+        return
+    try:
+        stats = await run_friend_suggestions_job(top_k=top_k, shard_size=shard_size)
+        print(f"✅ Рекомендации рассчитаны: {stats}")
+    finally:
+        await redis_cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Расчет рекомендаций друзей")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K, help="Количество рекомендаций на пользователя")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE, help="Количество строк матрицы в одном блоке")
+    args = parser.parse_args()
+    asyncio.run(main(args.top_k, args.shard_size))
@@ -163,14 +163,13 @@ async def detect_hot_users(threshold: int = None) -> List[Dict[str, Any]]:
     
     try:
         async with get_session() as session:
-            # Находим пользователей с большим количеством постов, которые еще не отмечены как горячие
+            # Находим пользователей с большим количеством постов, которые еще не отмечены как горячие.
+            # post_count поддерживается инкрементально (см. packages/common/user_stats.py),
+            # поэтому вместо агрегации всех постов используется индекс по счетчику.
             query = text("""
-            SELECT u.id, u.first_name, u.second_name, COUNT(p.id) as post_count
-            FROM users u
-            JOIN posts p ON u.id = p.author_user_id
-            WHERE u.is_hot_user = false
-            GROUP BY u.id, u.first_name, u.second_name
-            HAVING COUNT(p.id) >= :threshold
+            SELECT id, first_name, second_name, post_count
+            FROM users
+            WHERE is_hot_user = false AND post_count >= :threshold
             """)
             
             result = await session.execute(query, {"threshold": threshold})
@@ -35,7 +35,26 @@ else
 fi
 
 # Дистрибуция таблиц
-echo "Создание распределенных таблиц..."
+# CITUS_USERS_MODE=reference (по умолчанию) - users/auth_tokens/friends/posts как reference-таблицы
+# CITUS_USERS_MODE=distributed - users распределена по id и колоцирована с friends/posts,
+#                                запись пользователя масштабируется с количеством воркеров
+CITUS_USERS_MODE="${CITUS_USERS_MODE:-reference}"
+echo "Создание распределенных таблиц (режим users: $CITUS_USERS_MODE)..."
+
+if [ "$CITUS_USERS_MODE" = "distributed" ]; then
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+    -- Внешние ключи между шардированными таблицами допустимы только по колонке распределения
+    ALTER TABLE auth_tokens DROP CONSTRAINT IF EXISTS auth_tokens_user_id_fkey;
+    ALTER TABLE friends DROP CONSTRAINT IF EXISTS friends_friend_id_fkey;
+    ALTER TABLE dialog_messages DROP CONSTRAINT IF EXISTS dialog_messages_to_user_id_fkey;
+
+    SELECT create_distributed_table('users', 'id');
+    SELECT create_distributed_table('friends', 'user_id', colocate_with => 'users');
+    SELECT create_distributed_table('posts', 'author_user_id', colocate_with => 'users');
+    -- Токен проверяется на каждом запросе, поэтому распределяем по token (router-запрос)
+    SELECT create_distributed_table('auth_tokens', 'token', colocate_with => 'none');
+EOSQL
+else
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
     -- Мы выбираем новую стратегию с использованием reference-таблиц для сохранения целостности данных
     
@@ -44,12 +63,17 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
     SELECT create_reference_table('auth_tokens');
     SELECT create_reference_table('friends');
     SELECT create_reference_table('posts');
+EOSQL
+fi
 
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
     -- Затем распределяем остальные таблицы
     SELECT create_distributed_table('dialog_messages', 'from_user_id');
     
     -- Создадим дополнительные индексы для улучшения производительности
     CREATE INDEX IF NOT EXISTS idx_auth_tokens_user_id ON auth_tokens(user_id);
+    CREATE INDEX IF NOT EXISTS idx_auth_tokens_expires_at ON auth_tokens(expires_at);
+    CREATE INDEX IF NOT EXISTS idx_auth_tokens_user_expires ON auth_tokens(user_id, expires_at);
     CREATE INDEX IF NOT EXISTS idx_dialog_messages_to_user ON dialog_messages(to_user_id);
     CREATE INDEX IF NOT EXISTS idx_dialog_messages_from_user ON dialog_messages(from_user_id);
     CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts(created_at);
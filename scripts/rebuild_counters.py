@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Полная пересборка счетчиков непрочитанных из хранилища диалогов.
+
+Запуск из корня репозитория (REDIS_URL - counter Redis, REDIS_DIALOG_URL - диалоги):
+    python scripts/rebuild_counters.py --source redis --workers 8 --pipeline-size 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.counter.app.main import CounterService
+from services.counter.app.rebuild import REBUILD_PIPELINE_SIZE, REBUILD_SOURCE, REBUILD_WORKERS, rebuild_counters
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main(source: str, workers: int, pipeline_size: int):
+    # Периодическая сверка на время пересборки не нужна
+    os.environ["RECONCILIATION_ENABLED"] = "false"
+    service = CounterService(os.getenv("REDIS_URL", "redis://localhost:6379/2"))
+    await service.connect()
+    try:
+        stats = await rebuild_counters(service, source, workers, pipeline_size)
+        if stats is None:
+            print("⚠️ Пересборка уже идет на другом экземпляре")
+        else:
+            print(f"✅ Счетчики пересобраны: {stats}")
+    finally:
+        await service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересборка счетчиков непрочитанных")
+    parser.add_argument("--source", choices=["redis", "postgres"], default=REBUILD_SOURCE, help="Хранилище диалогов")
+    parser.add_argument("--workers", type=int, default=REBUILD_WORKERS, help="Параллельных воркеров")
+    parser.add_argument("--pipeline-size", type=int, default=REBUILD_PIPELINE_SIZE, help="Пар на один pipeline записи")
+    args = parser.parse_args()
+    asyncio.run(main(args.source, args.workers, args.pipeline_size))
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Query, Header, Request
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Header, Request, Response
 import logging
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
@@ -11,10 +11,14 @@ import uuid
 import os
 from dotenv import load_dotenv
 from sqlalchemy import select
-from packages.common.models import User, AuthToken, Friendship, Post, PostCreateRequest, PostUpdateRequest, PostIdResponse, PostResponse, DialogMessageRequest, DialogMessageResponse
-from packages.common.db import get_master_session, get_slave_session, get_user_by_id, get_user_by_token, create_auth_token, get_user_friends, save_dialog_message, get_dialog_messages
+from packages.common.models import User, AuthToken, Friendship, Post, PostCreateRequest, PostUpdateRequest, PostIdResponse, PostResponse, DialogMessageRequest, DialogMessageResponse, FriendSuggestionResponse
+from packages.common.db import get_master_session, get_slave_session, get_user_by_id, get_user_by_token, create_auth_token, get_user_friends, save_dialog_message, get_dialog_messages, ensure_auth_token_indexes, get_user_profile
 from packages.common.cache import redis_cache
 from packages.common.dialog_wrapper import dialog_wrapper
+from packages.common.database import start_session_router, stop_session_router, Durability
+from packages.common.token_purge import start_token_purge, stop_token_purge
+from packages.common.consistency import CONSISTENCY_HEADER, record_write, apply_read_consistency
+from packages.common.user_stats import user_stats, increment_counter_column, start_user_stats_reconciler, stop_user_stats_reconciler
 from services.dialog.app.redis_adapter_udf import get_redis_dialog_adapter_udf, init_redis_adapter_udf, close_redis_adapter_udf
 from services.dialog.app.redis_adapter import init_redis_adapter, close_redis_adapter
 from services.api.app.middleware.request_id_middleware import RequestIdMiddleware, setup_logging_with_request_id
@@ -40,6 +44,22 @@ async def lifespan(app: FastAPI):
     if not is_redis_available:
         logger.warning("Redis cache is not available. Feed caching will be disabled.")
     
+    # Маршрутизация чтений по репликам с проверкой отставания
+    await start_session_router()
+    
+    # Индексы жизненного цикла токенов и фоновая очистка просроченных
+    try:
+        await ensure_auth_token_indexes()
+        await start_token_purge()
+    except Exception as e:
+        logger.error(f"Failed to start auth token purge: {e}")
+    
+    # Периодическая сверка счетчиков друзей/постов (колонки - deploy/sql/user_counters.sql)
+    try:
+        await start_user_stats_reconciler()
+    except Exception as e:
+        logger.error(f"Failed to start user stats reconciler: {e}")
+    
     # Инициализация dialog_wrapper и фонового паблишера событий диалогов
     await dialog_wrapper.init()
     try:
@@ -91,6 +111,9 @@ async def lifespan(app: FastAPI):
     
     # Close connections and cleanup on shutdown
     print(f"🔍 DEBUG: Начало завершения работы в lifespan")
+    await stop_user_stats_reconciler()
+    await stop_token_purge()
+    await stop_session_router()
     await redis_cache.close()
     await dialog_wrapper.close()
     try:
@@ -136,6 +159,9 @@ async def health():
             db_info = get_db_info()
         except (ImportError, AttributeError):
             db_info = {"error": "HAProxy database module not available"}
+    else:
+        from packages.common.db import get_db_info
+        db_info = get_db_info()
     
     instance_name = os.getenv("INSTANCE_NAME", "unknown")
     
@@ -179,7 +205,10 @@ def get_password_hash(password: str) -> str:
     """
     return hashlib.sha256(password.encode()).hexdigest()
 
-async def verify_token(authorization: str = Header(None)) -> str:
+async def verify_token(
+    authorization: str = Header(None),
+    x_consistency_token: Optional[str] = Header(None)
+) -> str:
     print(f"DEBUG: verify_token called with authorization: {authorization}")
     
     if not authorization:
@@ -201,6 +230,8 @@ async def verify_token(authorization: str = Header(None)) -> str:
             print(f"ERROR: No user found for token: {token}")
             raise HTTPException(status_code=401, detail="Invalid token")
         
+        # Чтения пользователя не должны уйти на реплику, еще не применившую его запись
+        await apply_read_consistency(str(user_id), x_consistency_token)
         return str(user_id)
     except Exception as e:
         print(f"ERROR: Exception in verify_token: {str(e)}")
@@ -240,10 +271,21 @@ async def register_user(user: UserCreate):
         password=get_password_hash(user.password)
     )
     
-    async with get_master_session() as session:
+    # Аккаунт должен быть виден на репликах сразу после ответа: следом идет логин
+    async with get_master_session(Durability.REMOTE_APPLY) as session:
         session.add(new_user)
         await session.commit()
     
+    # Прогреваем кэш профиля: дальнейшие чтения профиля не пойдут в БД
+    await redis_cache.cache_user_profile(user_id, {
+        "id": user_id,
+        "first_name": user.first_name,
+        "second_name": user.second_name,
+        "birthdate": user.birthdate.date().isoformat(),
+        "biography": user.biography,
+        "city": user.city
+    })
+    
     return UserResponse(
         id=user_id,
         first_name=user.first_name,
@@ -261,18 +303,11 @@ async def get_user(id: str, user_id: str = Depends(verify_token)):
     if id != user_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    user = await get_user_by_id(id)
-    if not user:
+    profile = await get_user_profile(id)
+    if not profile:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return UserResponse(
-        id=str(user.id),
-        first_name=user.first_name,
-        second_name=user.second_name,
-        birthdate=user.birthdate,
-        biography=user.biography,
-        city=user.city
-    )
+    return UserResponse(**profile)
 
 @app.get("/user/search", response_model=List[UserResponse], tags=["Users"])
 async def search_users(
@@ -313,7 +348,7 @@ async def search_users(
 
 
 @app.put("/friend/set/{user_id}", tags=["Friends"])
-async def add_friend(user_id: str, current_user_id: str = Depends(verify_token)):
+async def add_friend(user_id: str, response: Response, current_user_id: str = Depends(verify_token)):
     """
     Add a friend for the logged-in user
     
@@ -326,7 +361,7 @@ async def add_friend(user_id: str, current_user_id: str = Depends(verify_token))
         raise HTTPException(status_code=400, detail="Cannot add yourself as a friend")
     
     # Verify that the friend exists
-    friend_user = await get_user_by_id(user_id)
+    friend_user = await get_user_profile(user_id)
     if not friend_user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -345,7 +380,14 @@ async def add_friend(user_id: str, current_user_id: str = Depends(verify_token))
         # Create and add the new friendship row
         new_friendship = Friendship(user_id=current_user_id, friend_id=user_id)
         session.add(new_friendship)
+        await increment_counter_column(session, current_user_id, "friends_count", 1)
         await session.commit()
+        consistency_token = await record_write(session, current_user_id)
+    
+    if consistency_token:
+        response.headers[CONSISTENCY_HEADER] = consistency_token
+    
+    await user_stats.incr_friends(current_user_id, 1)
     
     # Invalidate the user's feed cache to rebuild it properly
     await redis_cache.invalidate_feed(current_user_id)
@@ -354,7 +396,7 @@ async def add_friend(user_id: str, current_user_id: str = Depends(verify_token))
 
 
 @app.put("/friend/delete/{user_id}", tags=["Friends"])
-async def delete_friend(user_id: str, current_user_id: str = Depends(verify_token)):
+async def delete_friend(user_id: str, response: Response, current_user_id: str = Depends(verify_token)):
     """
     Delete a friend for the logged-in user.
     
@@ -378,7 +420,14 @@ async def delete_friend(user_id: str, current_user_id: str = Depends(verify_toke
             raise HTTPException(status_code=404, detail="Friendship not found")
         
         await session.delete(friendship)
+        await increment_counter_column(session, current_user_id, "friends_count", -1)
         await session.commit()
+        consistency_token = await record_write(session, current_user_id)
+    
+    if consistency_token:
+        response.headers[CONSISTENCY_HEADER] = consistency_token
+    
+    await user_stats.incr_friends(current_user_id, -1)
     
     # Invalidate the user's feed cache to rebuild it properly
     await redis_cache.invalidate_feed(current_user_id)
@@ -386,8 +435,26 @@ async def delete_friend(user_id: str, current_user_id: str = Depends(verify_toke
     return {"detail": "Friend removed successfully"}
 
 
+@app.get("/friend/suggestions", response_model=List[FriendSuggestionResponse], tags=["Friends"])
+async def get_friend_suggestions(
+    limit: int = Query(10, ge=1, le=100, description="Лимит возвращаемых рекомендаций"),
+    current_user_id: str = Depends(verify_token)
+):
+    """
+    Get "friends of friends" suggestions for the logged-in user.
+    
+    Suggestions are precomputed by the batch job (scripts/build_friend_suggestions.py)
+    and served from Redis, ordered by the number of mutual friends.
+    """
+    suggestions = await redis_cache.get_friend_suggestions(current_user_id)
+    return [
+        FriendSuggestionResponse(user_id=item["user_id"], mutual_friends=item["mutual_friends"])
+        for item in suggestions[:limit]
+    ]
+
+
 @app.post("/post/create", response_model=PostIdResponse, tags=["Posts"])
-async def create_post(post: PostCreateRequest, current_user_id: str = Depends(verify_token)):
+async def create_post(post: PostCreateRequest, response: Response, current_user_id: str = Depends(verify_token)):
     """
     Create a new post with the given text for the logged-in user.
     The post will be added to the feeds of the user's friends.
@@ -410,10 +477,18 @@ async def create_post(post: PostCreateRequest, current_user_id: str = Depends(ve
             created_at=created_at
         )
         
-        async with get_master_session() as session:
+        # Пост не ждет подтверждения реплик: кворумный круг не нужен для ленты
+        async with get_master_session(Durability.LOCAL) as session:
             session.add(new_post)
+            await increment_counter_column(session, current_user_id, "post_count", 1)
             await session.commit()
             print(f"DEBUG: Post {new_post_id} successfully committed to database")
+            consistency_token = await record_write(session, current_user_id)
+        
+        if consistency_token:
+            response.headers[CONSISTENCY_HEADER] = consistency_token
+        
+        await user_stats.incr_posts(current_user_id, 1)
     except Exception as e:
         print(f"ERROR: Failed to create post: {str(e)}")
         print(f"ERROR: Exception type: {type(e)}")
@@ -440,7 +515,7 @@ async def create_post(post: PostCreateRequest, current_user_id: str = Depends(ve
 
 
 @app.put("/post/update", tags=["Posts"])
-async def update_post(post: PostUpdateRequest, current_user_id: str = Depends(verify_token)):
+async def update_post(post: PostUpdateRequest, response: Response, current_user_id: str = Depends(verify_token)):
     """
     Update an existing post.
     Only the author of the post (as determined by the token) is allowed to update it.
@@ -459,6 +534,10 @@ async def update_post(post: PostUpdateRequest, current_user_id: str = Depends(ve
         # Update the post
         existing_post.text = post.text
         await session.commit()
+        consistency_token = await record_write(session, current_user_id)
+    
+    if consistency_token:
+        response.headers[CONSISTENCY_HEADER] = consistency_token
     
     # Get the user's friends to update their feed caches
     friend_ids = await get_user_friends(current_user_id)
@@ -481,7 +560,7 @@ async def update_post(post: PostUpdateRequest, current_user_id: str = Depends(ve
 
 
 @app.put("/post/delete/{id}", tags=["Posts"])
-async def delete_post(id: str, current_user_id: str = Depends(verify_token)):
+async def delete_post(id: str, response: Response, current_user_id: str = Depends(verify_token)):
     """
     Delete a post.
     Only the author of the post (as determined by the token) may delete it.
@@ -498,7 +577,14 @@ async def delete_post(id: str, current_user_id: str = Depends(verify_token)):
         
         # Delete the post
         await session.delete(existing_post)
+        await increment_counter_column(session, current_user_id, "post_count", -1)
         await session.commit()
+        consistency_token = await record_write(session, current_user_id)
+    
+    if consistency_token:
+        response.headers[CONSISTENCY_HEADER] = consistency_token
+    
+    await user_stats.incr_posts(current_user_id, -1)
     
     # Get the user's friends to update their feed caches
     friend_ids = await get_user_friends(current_user_id)
@@ -611,7 +697,7 @@ async def send_dialog_message(
     request_id = request.headers.get("x-request-id", str(uuid.uuid4()))
     
     # Проверяем, существует ли получатель
-    recipient = await get_user_by_id(user_id)
+    recipient = await get_user_profile(user_id)
     if not recipient:
         raise HTTPException(status_code=404, detail="Получатель не найден")
     
@@ -639,7 +725,7 @@ async def list_dialog_messages(
     request_id = request.headers.get("x-request-id", str(uuid.uuid4()))
     
     # Проверяем, существует ли собеседник
-    interlocutor = await get_user_by_id(user_id)
+    interlocutor = await get_user_profile(user_id)
     if not interlocutor:
         raise HTTPException(status_code=404, detail="Пользователь для диалога не найден")
     
@@ -0,0 +1,216 @@
+#!lua name=counter_functions
+
+-- Мутации счетчиков непрочитанных. Каждая функция - одна атомарная операция:
+-- проверка дубля события, изменение счетчиков и маркера прочтения.
+-- Пары (пользователь, собеседник), чьи счетчики изменились, попадают в
+-- sorted set "грязных" пар (score - время изменения) для инкрементальной сверки.
+--
+-- Дедупликация по корзинам времени: ID событий хранятся в одном множестве на
+-- корзину, а не отдельным ключом с TTL на событие. Первые ключи каждой функции -
+-- корзины окна дедупликации, текущая корзина первой; первые три аргумента -
+-- число корзин, момент истечения текущей корзины (EXPIREAT) и канал PUBLISH
+-- для push-уведомлений о новых значениях счетчиков ('' - не публиковать).
+
+-- Пометить пару грязной; повторная пометка сдвигает время изменения
+local function mark_dirty(dirty_key, member)
+    redis.call('ZADD', dirty_key, redis.call('TIME')[1], member)
+end
+
+-- Опубликовать новые значения счетчиков пары (получатель, собеседник)
+local function publish_update(channel, user_id, peer_id, unread, total, delta)
+    if channel ~= '' then
+        redis.call('PUBLISH', channel, cjson.encode({
+            user_id = user_id,
+            peer_user_id = peer_id,
+            unread = unread,
+            total_unread = total,
+            delta = delta,
+        }))
+    end
+end
+
+-- Событие новое, если его нет ни в одной корзине окна; новое событие
+-- запоминается в текущей корзине
+local function first_seen(keys, nbuckets, expire_at, event_id)
+    for i = 2, nbuckets do
+        if redis.call('SISMEMBER', keys[i], event_id) == 1 then
+            return false
+        end
+    end
+    if redis.call('SADD', keys[1], event_id) == 0 then
+        return false
+    end
+    redis.call('EXPIREAT', keys[1], expire_at, 'NX')
+    return true
+end
+
+-- Событие MessageSent: +1 непрочитанное у получателя
+-- keys: dedup_buckets..., total, by_peer, dirty
+-- args: nbuckets, expire_at, channel, event_id, to_user_id, from_user_id
+local function counter_message_sent(keys, args)
+    local b = tonumber(args[1])
+    if not first_seen(keys, b, args[2], args[4]) then
+        return 0
+    end
+    local total = redis.call('INCR', keys[b + 1])
+    local unread = redis.call('HINCRBY', keys[b + 2], args[6], 1)
+    mark_dirty(keys[b + 3], args[5] .. ':' .. args[6])
+    publish_update(args[3], args[5], args[6], unread, total, 1)
+    return 1
+end
+
+-- Пачка событий MessageSent с объединением приращений (write-behind).
+-- Дубли отсекаются по каждому событию, а INCRBY/HINCRBY выполняются
+-- один раз на пару (получатель, отправитель).
+-- keys: dedup_buckets..., total_1, by_peer_1, total_2, by_peer_2, ..., dirty
+-- args: nbuckets, expire_at, channel, event_id_1, to_user_id_1, from_user_id_1, event_id_2, ...
+-- Возвращает массив 1/0 (применено/дубль) в порядке событий
+local function counter_message_sent_batch(keys, args)
+    local b = tonumber(args[1])
+    local channel = args[3]
+    local n = (#args - 3) / 3
+    local dirty_key = keys[#keys]
+    local totals = {}
+    local total_order = {}
+    -- "получатель:отправитель" -> {получатель, отправитель, by_peer, total, приращение}
+    local by_pair = {}
+    local pair_order = {}
+    local applied = {}
+    for i = 1, n do
+        local base = b + (i - 1) * 2
+        local a = 3 + (i - 1) * 3
+        local event_id, to_user_id, from_user_id = args[a + 1], args[a + 2], args[a + 3]
+        if first_seen(keys, b, args[2], event_id) then
+            applied[i] = 1
+            local total_key = keys[base + 1]
+            if totals[total_key] == nil then
+                totals[total_key] = 0
+                table.insert(total_order, total_key)
+            end
+            totals[total_key] = totals[total_key] + 1
+            local member = to_user_id .. ':' .. from_user_id
+            local pair = by_pair[member]
+            if pair == nil then
+                pair = {to_user_id, from_user_id, keys[base + 2], total_key, 0}
+                by_pair[member] = pair
+                table.insert(pair_order, member)
+            end
+            pair[5] = pair[5] + 1
+        else
+            applied[i] = 0
+        end
+    end
+    local new_totals = {}
+    for _, total_key in ipairs(total_order) do
+        new_totals[total_key] = redis.call('INCRBY', total_key, totals[total_key])
+    end
+    for _, member in ipairs(pair_order) do
+        local pair = by_pair[member]
+        local unread = redis.call('HINCRBY', pair[3], pair[2], pair[5])
+        mark_dirty(dirty_key, member)
+        publish_update(channel, pair[1], pair[2], unread, new_totals[pair[4]], pair[5])
+    end
+    return applied
+end
+
+-- Событие MessagesRead: декремент без ухода в минус и сдвиг маркера прочтения
+-- keys: dedup_buckets..., total, by_peer, last_read (hash собеседник -> ts), dirty
+-- args: nbuckets, expire_at, channel, event_id, user_id, peer_id, delta, last_read_ts ('' - не менять)
+local function counter_messages_read(keys, args)
+    local b = tonumber(args[1])
+    if not first_seen(keys, b, args[2], args[4]) then
+        return 0
+    end
+    local user_id = args[5]
+    local peer_id = args[6]
+    local delta = math.max(0, tonumber(args[7]) or 0)
+    local peer = tonumber(redis.call('HGET', keys[b + 2], peer_id) or '0')
+    local removed = math.min(peer, delta)
+    if removed > 0 then
+        redis.call('HINCRBY', keys[b + 2], peer_id, -removed)
+        -- Общий счетчик уменьшается ровно на снятое с собеседника, поэтому остается суммой по собеседникам
+        local total = math.max(0, tonumber(redis.call('GET', keys[b + 1]) or '0') - removed)
+        redis.call('SET', keys[b + 1], total)
+        publish_update(args[3], user_id, peer_id, peer - removed, total, -removed)
+    end
+    if args[8] ~= '' then
+        -- Маркер прочтения только двигается вперед
+        local current = tonumber(redis.call('HGET', keys[b + 3], peer_id) or '0')
+        if tonumber(args[8]) > current then
+            redis.call('HSET', keys[b + 3], peer_id, args[8])
+        end
+    end
+    mark_dirty(keys[b + 4], user_id .. ':' .. peer_id)
+    return 1
+end
+
+-- Забрать из множества грязных пар не больше limit пар, измененных не позже cutoff.
+-- Пары, которые изменятся после выборки, будут помечены заново.
+-- keys: dirty
+-- args: cutoff_ts, limit
+local function counter_pop_dirty(keys, args)
+    local members = redis.call('ZRANGE', keys[1], '-inf', args[1], 'BYSCORE', 'LIMIT', 0, args[2])
+    if #members > 0 then
+        redis.call('ZREM', keys[1], unpack(members))
+    end
+    return members
+end
+
+-- Исправить счетчик пары по результату сверки. Если счетчик изменился после
+-- того, как сверка его прочитала, исправление не применяется (пара уже снова грязная).
+-- keys: total, by_peer
+-- args: peer_id, expected ('' - поля не было), actual, user_id, channel
+-- Возвращает {1, поправка} или {0, 0}, если счетчик изменился
+local function counter_reconcile_pair(keys, args)
+    local current = redis.call('HGET', keys[2], args[1])
+    if (current or '') ~= args[2] then
+        return {0, 0}
+    end
+    local diff = tonumber(args[3]) - tonumber(current or '0')
+    if diff ~= 0 then
+        redis.call('HSET', keys[2], args[1], args[3])
+        local total = math.max(0, tonumber(redis.call('GET', keys[1]) or '0') + diff)
+        redis.call('SET', keys[1], total)
+        publish_update(args[5], args[4], args[1], tonumber(args[3]), total, diff)
+    end
+    return {1, diff}
+end
+
+-- Пересчитать общие счетчики пользователей как сумму счетчиков по собеседникам.
+-- Сумма и запись атомарны: инкремент события не теряется между HVALS и SET.
+-- keys: total_1, by_peer_1, total_2, by_peer_2, ...
+local function counter_recompute_totals(keys, args)
+    for i = 1, #keys, 2 do
+        local total = 0
+        for _, v in ipairs(redis.call('HVALS', keys[i + 1])) do
+            total = total + tonumber(v)
+        end
+        redis.call('SET', keys[i], total)
+    end
+    return #keys / 2
+end
+
+-- Перенести старый маркер прочтения (отдельный ключ на пару) в hash пользователя.
+-- Маркер в hash только двигается вперед, старый ключ удаляется.
+-- keys: legacy_last_read, last_read
+-- args: peer_id
+local function counter_migrate_last_read(keys, args)
+    local legacy = redis.call('GET', keys[1])
+    if legacy == false then
+        return 0
+    end
+    local current = tonumber(redis.call('HGET', keys[2], args[1]) or '0')
+    if tonumber(legacy) > current then
+        redis.call('HSET', keys[2], args[1], legacy)
+    end
+    redis.call('DEL', keys[1])
+    return 1
+end
+
+redis.register_function('counter_message_sent', counter_message_sent)
+redis.register_function('counter_messages_read', counter_messages_read)
+redis.register_function('counter_message_sent_batch', counter_message_sent_batch)
+redis.register_function('counter_pop_dirty', counter_pop_dirty)
+redis.register_function('counter_reconcile_pair', counter_reconcile_pair)
+redis.register_function('counter_migrate_last_read', counter_migrate_last_read)
+redis.register_function('counter_recompute_totals', counter_recompute_totals)
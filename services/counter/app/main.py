@@ -1,15 +1,136 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 import os
 import uuid
 import asyncio
+import time
 import redis.asyncio as redis
 import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+DEDUP_TTL_SEC = 24 * 3600
+# Ширина корзины дедупликации: событие проверяется по корзинам, покрывающим DEDUP_TTL_SEC
+DEDUP_BUCKET_SEC = int(os.getenv("COUNTER_DEDUP_BUCKET_SEC", str(4 * 3600)))
+# Канал Redis Pub/Sub, куда функции счетчиков публикуют новые значения для push по WebSocket
+COUNTER_UPDATES_CHANNEL = os.getenv("COUNTER_UPDATES_CHANNEL", "counters:updates")
+COUNTER_PUSH_ENABLED = os.getenv("COUNTER_PUSH_ENABLED", "true").lower() == "true"
+# Перенос старых ключей (маркер прочтения и дедупликация на ключ) в компактные структуры при старте
+MIGRATE_LEGACY_KEYS = os.getenv("COUNTER_MIGRATE_LEGACY_KEYS", "true").lower() == "true"
+# Отчет о памяти по умолчанию сэмплирует: MEMORY USAGE ... SAMPLES 0 на больших
+# множествах дедупликации - O(элементов) и блокирует Redis
+MEMORY_REPORT_SAMPLES = 5
+MEMORY_REPORT_MAX_KEYS = int(os.getenv("COUNTER_MEMORY_REPORT_MAX_KEYS", "10000"))
+
+# Библиотека Redis Functions с атомарными мутациями счетчиков
+COUNTER_FUNCTIONS_PATH = os.path.join(os.path.dirname(__file__), "counter_functions.lua")
+
+# Write-behind: события MessageSent копятся в памяти и применяются одной пачкой,
+# приращения по одной паре (получатель, отправитель) объединяются
+WRITE_BEHIND_ENABLED = os.getenv("COUNTER_WRITE_BEHIND_ENABLED", "false").lower() == "true"
+WRITE_BEHIND_WINDOW_MS = float(os.getenv("COUNTER_WRITE_BEHIND_WINDOW_MS", "5"))
+WRITE_BEHIND_MAX_EVENTS = int(os.getenv("COUNTER_WRITE_BEHIND_MAX_EVENTS", "1000"))
+
+# Инкрементальная сверка: проверяются только пары (пользователь, собеседник),
+# которые изменили недавние события
+DIRTY_PAIRS_KEY = "counters:dirty"
+# Флаг в Redis диалогов: индекс входящих заполнен для диалогов, записанных до его появления
+INBOX_BACKFILLED_KEY = "dialogs:inbox_backfilled"
+RECONCILIATION_INTERVAL_SEC = float(os.getenv("RECONCILIATION_INTERVAL_SEC", "10"))
+# Пара сверяется не раньше, чем через столько секунд после последнего изменения,
+# чтобы событие и запись сообщения в хранилище диалогов успели сойтись
+RECONCILIATION_SETTLE_SEC = float(os.getenv("RECONCILIATION_SETTLE_SEC", "5"))
+RECONCILIATION_BATCH_SIZE = int(os.getenv("RECONCILIATION_BATCH_SIZE", "100"))
+RECONCILIATION_CONCURRENCY = int(os.getenv("RECONCILIATION_CONCURRENCY", "8"))
+# Бюджет сверки: не больше стольких пар в секунду
+RECONCILIATION_MAX_PAIRS_PER_SEC = float(os.getenv("RECONCILIATION_MAX_PAIRS_PER_SEC", "500"))
+# Полный обход всех счетчиков (0 - выключен); пары только ставятся в очередь грязных
+RECONCILIATION_FULL_SWEEP_INTERVAL_SEC = float(os.getenv("RECONCILIATION_FULL_SWEEP_INTERVAL_SEC", "0"))
+
+# Полная пересборка счетчиков из хранилища диалогов при старте:
+# never, if_missing (нет отметки о пересборке - данные Redis потеряны), always
+REBUILD_ON_STARTUP = os.getenv("COUNTER_REBUILD_ON_STARTUP", "never").lower()
+
+# Максимум пользователей и пар в одном запросе /api/v1/counters/batch
+COUNTERS_BATCH_MAX_ITEMS = int(os.getenv("COUNTERS_BATCH_MAX_ITEMS", "1000"))
+
+
+class WriteBehindAggregator:
+    """
+    Накопитель событий MessageSent на окно в несколько миллисекунд.
+
+    Вызывающий ждет future до сброса пачки, поэтому ответ "применено/дубль"
+    остается точным: дубли по-прежнему отсекаются по каждому event_id
+    внутри функции counter_message_sent_batch.
+    """
+
+    def __init__(self, service: "CounterService", window_ms: float, max_events: int):
+        self.service = service
+        self.window_sec = window_ms / 1000.0
+        self.max_events = max_events
+        self._pending: List[Tuple[str, str, str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.Task] = None
+        # Цикл событий держит задачи слабыми ссылками: без них сброс может собрать GC
+        self._flush_tasks: Set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()
+        self.flushes = 0
+        self.events = 0
+
+    async def add(self, event_id: str, to_user_id: str, from_user_id: str) -> bool:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((event_id, to_user_id, from_user_id, future))
+        if len(self._pending) >= self.max_events:
+            self._spawn(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._flush_later())
+        return await future
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_done)
+        return task
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Write-behind flush failed: {task.exception()}")
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window_sec)
+        await self.flush()
+
+    async def flush(self):
+        # Пачки сбрасываются строго по очереди, чтобы не нарушить порядок относительно прочтений
+        async with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                applied = await self.service._apply_message_sent_batch(
+                    [(event_id, to_user_id, from_user_id) for event_id, to_user_id, from_user_id, _ in pending]
+                )
+            except Exception as e:
+                for *_, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            self.flushes += 1
+            self.events += len(pending)
+            for (*_, future), ok in zip(pending, applied):
+                if not future.done():
+                    future.set_result(ok)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window_sec * 1000,
+            "flushes": self.flushes,
+            "events": self.events,
+            "avg_batch": round(self.events / self.flushes, 2) if self.flushes else 0,
+        }
+
 
 class CounterService:
     def __init__(self, redis_url: str):
@@ -18,10 +139,19 @@ class CounterService:
         # Отдельное подключение к Redis, где лежат диалоги (для сверки)
         self.redis_dialogs: Optional[redis.Redis] = None
         self.reconcile_task: Optional[asyncio.Task] = None
+        self.migrate_task: Optional[asyncio.Task] = None
+        self.reconcile_stats: Dict[str, Any] = {"passes": 0, "pairs": 0, "corrected": 0, "skipped": 0, "errors": 0}
+        self.write_behind: Optional[WriteBehindAggregator] = (
+            WriteBehindAggregator(self, WRITE_BEHIND_WINDOW_MS, WRITE_BEHIND_MAX_EVENTS)
+            if WRITE_BEHIND_ENABLED else None
+        )
 
     async def connect(self):
         self.redis_counters = redis.from_url(self.redis_url, decode_responses=True)
         await self.redis_counters.ping()
+        await self._load_functions()
+        if MIGRATE_LEGACY_KEYS:
+            self.migrate_task = asyncio.create_task(self._migrate_legacy_keys_safe())
         dialog_url = os.getenv("REDIS_DIALOG_URL", "redis://redis:6379/1")
         self.redis_dialogs = redis.from_url(dialog_url, decode_responses=True)
         await self.redis_dialogs.ping()
@@ -29,13 +159,21 @@ class CounterService:
         if os.getenv("RECONCILIATION_ENABLED", "true").lower() == "true":
             self.reconcile_task = asyncio.create_task(self._reconcile_loop())
 
+    async def _load_functions(self):
+        # REPLACE: новая версия библиотеки заменяет загруженную ранее
+        with open(COUNTER_FUNCTIONS_PATH, "r", encoding="utf-8") as f:
+            await self.redis_counters.function_load(f.read(), replace=True)
+
     async def close(self):
-        if self.reconcile_task and not self.reconcile_task.done():
-            self.reconcile_task.cancel()
-            try:
-                await self.reconcile_task
-            except Exception:
-                pass
+        if self.write_behind:
+            await self.write_behind.flush()
+        for task in (self.reconcile_task, self.migrate_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
         if self.redis_counters:
             await self.redis_counters.close()
         if self.redis_dialogs:
@@ -47,127 +185,463 @@ class CounterService:
     def _key_by_peer(self, user_id: str) -> str:
         return f"user:{user_id}:unread_by_peer"
 
-    def _key_last_read(self, user_id: str, peer_id: str) -> str:
+    def _key_last_read(self, user_id: str) -> str:
+        # Hash собеседник -> timestamp маркера прочтения
+        return f"user:{user_id}:last_read"
+
+    def _key_last_read_legacy(self, user_id: str, peer_id: str) -> str:
         return f"user:{user_id}:last_read:{peer_id}"
 
-    def _key_dedup(self, event_id: str) -> str:
+    def _key_dedup_legacy(self, event_id: str) -> str:
         return f"event_dedup:{event_id}"
 
+    def _key_dedup_bucket(self, bucket: int) -> str:
+        return f"event_dedup_bucket:{bucket}"
+
+    def _updates_channel(self) -> str:
+        return COUNTER_UPDATES_CHANNEL if COUNTER_PUSH_ENABLED else ""
+
+    def _call_prefix(self) -> Tuple[List[str], List[Any]]:
+        """
+        Общее начало вызова функций событий: ключи корзин окна дедупликации
+        (текущая первой) и аргументы nbuckets, expire_at, channel
+        """
+        bucket = int(time.time()) // DEDUP_BUCKET_SEC
+        nbuckets = -(-DEDUP_TTL_SEC // DEDUP_BUCKET_SEC) + 1
+        keys = [self._key_dedup_bucket(bucket - i) for i in range(nbuckets)]
+        # Текущая корзина нужна, пока ее события не выйдут из окна
+        expire_at = (bucket + 1) * DEDUP_BUCKET_SEC + DEDUP_TTL_SEC
+        return keys, [nbuckets, expire_at, self._updates_channel()]
+
     def _dialog_key(self, user_id1: str, user_id2: str) -> str:
         # такой же алгоритм, как в dialog_service: отсортированные ID
         ids = sorted([str(user_id1), str(user_id2)])
         return f"dialog:{ids[0]}:{ids[1]}"
 
+    def _inbox_key(self, user_id: str, peer_id: str) -> str:
+        # Индекс входящих, который ведет RedisDialogAdapter: message_id -> timestamp
+        return f"inbox:{user_id}:{peer_id}"
+
+    @staticmethod
+    def _inbox_complete(oldest: List[Tuple[str, float]], backfilled: bool, last_ts: float) -> bool:
+        """
+        Индекс входящих покрывает все сообщения после маркера: он заполнен
+        задним числом или начат не позже маркера прочтения. Иначе в старом
+        диалоге часть непрочитанных записана до появления индекса.
+        """
+        return backfilled or (bool(oldest) and float(oldest[0][1]) <= last_ts)
+
+    def _dirty_member(self, user_id: str, peer_id: str) -> str:
+        return f"{user_id}:{peer_id}"
+
+    async def _flush_pending(self):
+        # Чтения и декременты должны видеть все принятые ранее приращения
+        if self.write_behind:
+            await self.write_behind.flush()
+
     async def get_counters(self, user_id: str) -> Dict:
-        total = await self.redis_counters.get(self._key_total(user_id))
-        by_peer = await self.redis_counters.hgetall(self._key_by_peer(user_id))
-        return {
-            "user_id": user_id,
-            "total_unread": int(total) if total is not None else 0,
-            "by_peer": {k: int(v) for k, v in by_peer.items()},
-        }
+        result = await self.get_counters_batch([user_id], [])
+        return result["users"][0]
 
     async def get_counter_for_peer(self, user_id: str, peer_id: str) -> Dict:
-        count = await self.redis_counters.hget(self._key_by_peer(user_id), peer_id)
-        last_read = await self.redis_counters.get(self._key_last_read(user_id, peer_id))
-        return {
-            "user_id": user_id,
-            "peer_user_id": peer_id,
-            "unread": int(count) if count is not None else 0,
-            "last_read_ts": float(last_read) if last_read is not None else None,
-        }
+        result = await self.get_counters_batch([], [(user_id, peer_id)])
+        return result["peers"][0]
+
+    async def get_counters_batch(self, user_ids: List[str], pairs: List[Tuple[str, str]]) -> Dict[str, List[Dict]]:
+        """
+        Счетчики многих пользователей и пар (пользователь, собеседник) одним pipeline
+
+        Args:
+            user_ids: Пользователи, для которых нужны total и by_peer
+            pairs: Пары (user_id, peer_id), для которых нужны unread и last_read_ts
+
+        Returns:
+            {"users": [...], "peers": [...]} в порядке запроса
+        """
+        await self._flush_pending()
+        pipe = self.redis_counters.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.get(self._key_total(user_id))
+            pipe.hgetall(self._key_by_peer(user_id))
+        for user_id, peer_id in pairs:
+            pipe.hget(self._key_by_peer(user_id), peer_id)
+            pipe.hget(self._key_last_read(user_id), peer_id)
+        replies = await pipe.execute() if user_ids or pairs else []
+
+        users = []
+        for i, user_id in enumerate(user_ids):
+            total, by_peer = replies[2 * i], replies[2 * i + 1]
+            users.append({
+                "user_id": user_id,
+                "total_unread": int(total) if total is not None else 0,
+                "by_peer": {k: int(v) for k, v in by_peer.items()},
+            })
+        offset = 2 * len(user_ids)
+        peers = []
+        for i, (user_id, peer_id) in enumerate(pairs):
+            count, last_read = replies[offset + 2 * i], replies[offset + 2 * i + 1]
+            peers.append({
+                "user_id": user_id,
+                "peer_user_id": peer_id,
+                "unread": int(count) if count is not None else 0,
+                "last_read_ts": float(last_read) if last_read is not None else None,
+            })
+        return {"users": users, "peers": peers}
+
+    def _message_sent_call(self, event_id: str, to_user_id: str, from_user_id: str):
+        keys, args = self._call_prefix()
+        keys += [self._key_total(to_user_id), self._key_by_peer(to_user_id), DIRTY_PAIRS_KEY]
+        args += [event_id, to_user_id, from_user_id]
+        return keys, args
+
+    def _messages_read_call(self, event_id: str, user_id: str, peer_id: str, delta: int, last_read_ts: Optional[float]):
+        keys, args = self._call_prefix()
+        keys += [
+            self._key_total(user_id),
+            self._key_by_peer(user_id),
+            self._key_last_read(user_id),
+            DIRTY_PAIRS_KEY,
+        ]
+        args += [event_id, user_id, peer_id, delta, "" if last_read_ts is None else last_read_ts]
+        return keys, args
+
+    def _message_sent_batch_call(self, events: List[Tuple[str, str, str]]):
+        keys, args = self._call_prefix()
+        for event_id, to_user_id, from_user_id in events:
+            keys.extend([self._key_total(to_user_id), self._key_by_peer(to_user_id)])
+            args.extend([event_id, to_user_id, from_user_id])
+        keys.append(DIRTY_PAIRS_KEY)
+        return keys, args
+
+    async def _apply_message_sent_batch(self, events: List[Tuple[str, str, str]]) -> List[bool]:
+        keys, args = self._message_sent_batch_call(events)
+        replies = await self.redis_counters.fcall("counter_message_sent_batch", len(keys), *keys, *args)
+        return [bool(reply) for reply in replies]
 
     async def apply_message_sent(self, event_id: str, to_user_id: str, from_user_id: str) -> bool:
-        # идемпотентность
-        if await self.redis_counters.setnx(self._key_dedup(event_id), "1"):
-            await self.redis_counters.expire(self._key_dedup(event_id), 24 * 3600)
-        else:
-            return False
-        pipe = self.redis_counters.pipeline()
-        pipe.incr(self._key_total(to_user_id))
-        pipe.hincrby(self._key_by_peer(to_user_id), from_user_id, 1)
-        await pipe.execute()
-        return True
+        if self.write_behind:
+            return await self.write_behind.add(event_id, to_user_id, from_user_id)
+        keys, args = self._message_sent_call(event_id, to_user_id, from_user_id)
+        return bool(await self.redis_counters.fcall("counter_message_sent", len(keys), *keys, *args))
 
     async def apply_messages_read(self, event_id: str, user_id: str, peer_id: str, delta: int, last_read_ts: Optional[float]) -> bool:
-        if await self.redis_counters.setnx(self._key_dedup(event_id), "1"):
-            await self.redis_counters.expire(self._key_dedup(event_id), 24 * 3600)
-        else:
-            return False
-        # корректный декремент без ухода в минус
-        by_peer_key = self._key_by_peer(user_id)
-        total_key = self._key_total(user_id)
-        current_peer = await self.redis_counters.hget(by_peer_key, peer_id)
-        current_total = await self.redis_counters.get(total_key)
-        peer_val = max(0, (int(current_peer) if current_peer else 0) - max(0, delta))
-        total_val = max(0, (int(current_total) if current_total else 0) - max(0, delta))
-        pipe = self.redis_counters.pipeline()
-        pipe.hset(by_peer_key, peer_id, peer_val)
-        pipe.set(total_key, total_val)
-        if last_read_ts is not None:
-            pipe.set(self._key_last_read(user_id, peer_id), last_read_ts)
-        await pipe.execute()
-        return True
+        await self._flush_pending()
+        keys, args = self._messages_read_call(event_id, user_id, peer_id, delta, last_read_ts)
+        return bool(await self.redis_counters.fcall("counter_messages_read", len(keys), *keys, *args))
+
+    async def apply_events(self, events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Применить пачку событий разных типов одним pipeline
+
+        Args:
+            events: Список {"event_type": ..., "payload": {...}}
+
+        Returns:
+            Результат по каждому событию в исходном порядке: event_id, applied
+            (False - дубль) и error для событий, которые не удалось разобрать
+        """
+        await self._flush_pending()
+        results: List[Dict[str, Any]] = []
+        pipe = self.redis_counters.pipeline(transaction=False)
+        # Индексы событий для каждой команды pipeline
+        queued: List[List[int]] = []
+        # Подряд идущие MessageSent объединяются в одну пачку (порядок с прочтениями сохраняется)
+        sent_run: List[Tuple[str, str, str]] = []
+        sent_indices: List[int] = []
+
+        def _flush_sent_run():
+            if sent_run:
+                keys, args = self._message_sent_batch_call(sent_run)
+                pipe.fcall("counter_message_sent_batch", len(keys), *keys, *args)
+                queued.append(list(sent_indices))
+                sent_run.clear()
+                sent_indices.clear()
+
+        for event in events:
+            event_type = event.get("event_type")
+            payload = event.get("payload") or {}
+            event_id = payload.get("event_id")
+            result = {"event_id": event_id, "applied": False, "error": None}
+            results.append(result)
+            try:
+                if not event_id:
+                    raise ValueError("event_id is required")
+                if event_type == "MessageSent":
+                    sent_run.append((event_id, str(payload["to_user_id"]), str(payload["from_user_id"])))
+                    sent_indices.append(len(results) - 1)
+                elif event_type == "MessagesRead":
+                    keys, args = self._messages_read_call(
+                        event_id, str(payload["user_id"]), str(payload["peer_user_id"]),
+                        int(payload.get("delta", 0)), payload.get("last_read_ts")
+                    )
+                    _flush_sent_run()
+                    pipe.fcall("counter_messages_read", len(keys), *keys, *args)
+                    queued.append([len(results) - 1])
+                else:
+                    raise ValueError(f"Unknown event type: {event_type}")
+            except (KeyError, TypeError, ValueError) as e:
+                result["error"] = f"Invalid event: {e}"
+        _flush_sent_run()
+
+        if queued:
+            replies = await pipe.execute(raise_on_error=False)
+            for indices, reply in zip(queued, replies):
+                if isinstance(reply, Exception):
+                    for index in indices:
+                        results[index]["error"] = str(reply)
+                    continue
+                applied = reply if isinstance(reply, list) else [reply]
+                for index, ok in zip(indices, applied):
+                    results[index]["applied"] = bool(ok)
+        return results
 
     async def _reconcile_loop(self):
-        interval = int(os.getenv("RECONCILIATION_INTERVAL_SEC", "60"))
+        last_sweep = time.time()
         while True:
             try:
-                await self.reconcile_all()
+                if RECONCILIATION_FULL_SWEEP_INTERVAL_SEC > 0 and time.time() - last_sweep >= RECONCILIATION_FULL_SWEEP_INTERVAL_SEC:
+                    last_sweep = time.time()
+                    await self.reconcile_all()
+                await self.reconcile_dirty()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Counter reconciliation failed: {e}")
+            await asyncio.sleep(RECONCILIATION_INTERVAL_SEC)
+
+    async def reconcile_dirty(self) -> Dict[str, int]:
+        """
+        Сверить пары, помеченные грязными, с хранилищем диалогов
+
+        Пары забираются пачками, внутри пачки сверяются параллельно (не больше
+        RECONCILIATION_CONCURRENCY одновременно), общий темп ограничен
+        RECONCILIATION_MAX_PAIRS_PER_SEC. Стоимость прохода зависит от числа
+        измененных пар, а не от числа пользователей.
+        """
+        stats = {"pairs": 0, "corrected": 0, "skipped": 0, "errors": 0}
+        cutoff = time.time() - RECONCILIATION_SETTLE_SEC
+        semaphore = asyncio.Semaphore(max(1, RECONCILIATION_CONCURRENCY))
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while True:
+            members = await self.redis_counters.fcall(
+                "counter_pop_dirty", 1, DIRTY_PAIRS_KEY, cutoff, RECONCILIATION_BATCH_SIZE
+            )
+            if not members:
+                break
+            await asyncio.gather(*(self._reconcile_member(member, cutoff, semaphore, stats) for member in members))
+            stats["pairs"] += len(members)
+            if RECONCILIATION_MAX_PAIRS_PER_SEC > 0:
+                delay = started + stats["pairs"] / RECONCILIATION_MAX_PAIRS_PER_SEC - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if len(members) < RECONCILIATION_BATCH_SIZE:
+                break
+        self.reconcile_stats["passes"] += 1
+        for name, value in stats.items():
+            self.reconcile_stats[name] += value
+        return stats
+
+    async def _reconcile_member(self, member: str, cutoff: float, semaphore: asyncio.Semaphore, stats: Dict[str, int]):
+        user_id, _, peer_id = member.partition(":")
+        async with semaphore:
+            try:
+                outcome = await self.reconcile_pair(user_id, peer_id)
+            except Exception as e:
+                logger.error(f"Failed to reconcile counters {member}: {e}")
+                stats["errors"] += 1
+                # Вернуть пару в очередь на следующий проход, не сдвигая более позднюю пометку
+                await self.redis_counters.zadd(DIRTY_PAIRS_KEY, {member: cutoff}, nx=True)
+                return
+        if outcome is None:
+            stats["skipped"] += 1
+        elif outcome:
+            stats["corrected"] += 1
+
+    async def reconcile_pair(self, user_id: str, peer_id: str) -> Optional[int]:
+        """
+        Сверить счетчик непрочитанных одной пары
+
+        Returns:
+            Примененная поправка или None, если сверить не удалось (нет данных
+            в хранилище диалогов или счетчик изменился во время сверки)
+        """
+        pipe = self.redis_counters.pipeline(transaction=False)
+        pipe.hget(self._key_last_read(user_id), peer_id)
+        pipe.hget(self._key_by_peer(user_id), peer_id)
+        last_read, current = await pipe.execute()
+        actual = await self._count_unread(user_id, peer_id, float(last_read) if last_read is not None else 0.0)
+        if actual is None:
+            return None
+        keys = [self._key_total(user_id), self._key_by_peer(user_id)]
+        applied, diff = await self.redis_counters.fcall(
+            "counter_reconcile_pair", len(keys), *keys, peer_id, "" if current is None else current, actual,
+            user_id, self._updates_channel()
+        )
+        return int(diff) if applied else None
+
+    async def _count_unread(self, user_id: str, peer_id: str, last_ts: float) -> Optional[int]:
+        """Число сообщений от peer_id к user_id новее last_ts (None - диалога нет в Redis)"""
+        inbox_key = self._inbox_key(user_id, peer_id)
+        pipe = self.redis_dialogs.pipeline(transaction=False)
+        pipe.exists(inbox_key)
+        pipe.zcount(inbox_key, f"({last_ts}", "+inf")
+        pipe.zrange(inbox_key, 0, 0, withscores=True)
+        pipe.exists(INBOX_BACKFILLED_KEY)
+        exists, count, oldest, backfilled = await pipe.execute()
+        if exists and self._inbox_complete(oldest, bool(backfilled), last_ts):
+            return int(count)
+        # Индекса нет или он начат после маркера: диалог записан до его появления,
+        # разбираем сообщения диалога
+        dialog_key = self._dialog_key(user_id, peer_id)
+        if not await self.redis_dialogs.exists(dialog_key):
+            if exists:
+                # Потоковый диалог: индекс ведется с первого сообщения
+                return int(count)
+            # Диалог хранится не в Redis (PostgreSQL-бэкенд) - сверять не с чем
+            return None
+        raw_msgs = await self.redis_dialogs.zrangebyscore(dialog_key, min=f"({last_ts}", max="+inf")
+        cnt = 0
+        for m in raw_msgs:
+            try:
+                obj = json.loads(m)
+                if str(obj.get("to_user_id")) == str(user_id):
+                    cnt += 1
             except Exception:
-                pass
-            await asyncio.sleep(interval)
+                continue
+        return cnt
 
-    async def reconcile_all(self):
-        """Сверка счетчиков для всех пользователей, у кого есть hash unread_by_peer."""
-        # Ищем ключи вида user:*:unread_by_peer
+    async def reconcile_all(self) -> int:
+        """
+        Полный обход: пометить грязными все пары, у которых есть счетчик
+
+        Сама сверка выполняется reconcile_dirty с тем же ограничением темпа.
+
+        Returns:
+            Число поставленных в очередь пар
+        """
+        queued = 0
         cursor = 0
         pattern = "user:*:unread_by_peer"
-        users_pairs = []
         while True:
             cursor, keys = await self.redis_counters.scan(cursor=cursor, match=pattern, count=100)
             for key in keys:
                 # key = user:{uid}:unread_by_peer
-                try:
-                    user_id = key.split(":")[1]
-                except Exception:
-                    continue
-                users_pairs.append((user_id, key))
+                user_id = key.split(":")[1]
+                peers = await self.redis_counters.hkeys(key)
+                if peers:
+                    # Score 0: пары сразу доступны сверке, более свежие пометки не затираются
+                    await self.redis_counters.zadd(
+                        DIRTY_PAIRS_KEY, {self._dirty_member(user_id, peer_id): 0 for peer_id in peers}, nx=True
+                    )
+                    queued += len(peers)
             if cursor == 0:
                 break
-        # Для каждого пользователя сверяем по собеседникам
-        for user_id, by_peer_key in users_pairs:
-            by_peer = await self.redis_counters.hgetall(by_peer_key)
-            corrected_by_peer: Dict[str, int] = {}
-            for peer_id, current_count_str in by_peer.items():
-                try:
-                    last_read = await self.redis_counters.get(self._key_last_read(user_id, peer_id))
-                    last_ts = float(last_read) if last_read is not None else 0.0
-                    dialog_key = self._dialog_key(user_id, peer_id)
-                    # Получаем все сообщения после last_ts и фильтруем по to_user_id == user_id
-                    raw_msgs = await self.redis_dialogs.zrangebyscore(dialog_key, min=last_ts, max="+inf")
-                    cnt = 0
-                    for m in raw_msgs:
-                        try:
-                            obj = json.loads(m)
-                            if str(obj.get("to_user_id")) == str(user_id):
-                                cnt += 1
-                        except Exception:
-                            continue
-                    corrected_by_peer[peer_id] = cnt
-                except Exception:
-                    # В случае ошибки оставляем текущее значение
-                    try:
-                        corrected_by_peer[peer_id] = int(current_count_str)
-                    except Exception:
-                        corrected_by_peer[peer_id] = 0
-            # Обновляем hash и total
-            pipe = self.redis_counters.pipeline()
-            total_val = sum(corrected_by_peer.values())
-            if corrected_by_peer:
-                pipe.hset(by_peer_key, mapping={k: str(v) for k, v in corrected_by_peer.items()})
-            pipe.set(self._key_total(user_id), total_val)
-            await pipe.execute()
+        return queued
+
+    async def _migrate_legacy_keys_safe(self):
+        try:
+            migrated = await self.migrate_legacy_keys()
+            if any(migrated.values()):
+                logger.info(f"Migrated legacy counter keys: {migrated}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Legacy counter key migration failed: {e}")
+
+    async def migrate_legacy_keys(self) -> Dict[str, int]:
+        """
+        Перенести ключи старого формата в компактные структуры
+
+        user:{u}:last_read:{peer} -> поле peer в hash user:{u}:last_read;
+        event_dedup:{event_id} -> текущая корзина дедупликации (событие остается
+        дублем не меньше прежнего TTL). Повторный запуск безопасен.
+        """
+        migrated = {"last_read": 0, "dedup": 0}
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis_counters.scan(cursor=cursor, match="user:*:last_read:*", count=1000)
+            if keys:
+                pipe = self.redis_counters.pipeline(transaction=False)
+                for key in keys:
+                    _, user_id, _, peer_id = key.split(":", 3)
+                    pipe.fcall("counter_migrate_last_read", 2, key, self._key_last_read(user_id), peer_id)
+                migrated["last_read"] += sum(1 for reply in await pipe.execute() if reply)
+            if cursor == 0:
+                break
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis_counters.scan(cursor=cursor, match="event_dedup:*", count=1000)
+            if keys:
+                bucket_keys, (_, expire_at, _) = self._call_prefix()
+                pipe = self.redis_counters.pipeline(transaction=True)
+                pipe.sadd(bucket_keys[0], *(key.split(":", 1)[1] for key in keys))
+                pipe.expireat(bucket_keys[0], expire_at, nx=True)
+                pipe.delete(*keys)
+                await pipe.execute()
+                migrated["dedup"] += len(keys)
+            if cursor == 0:
+                break
+        return migrated
+
+    async def memory_report(self, samples: int = MEMORY_REPORT_SAMPLES, max_keys: int = MEMORY_REPORT_MAX_KEYS,
+                            full: bool = False) -> Dict[str, Any]:
+        """
+        Память counter Redis по структурам: число ключей и байты (MEMORY USAGE)
+
+        Args:
+            samples: Сколько элементов вложенных структур сэмплировать (0 - все)
+            max_keys: Сколько ключей просмотреть, если не full
+            full: Обойти все ключи (явный выбор оператора)
+        """
+        structures = {
+            name: {"keys": 0, "bytes": 0}
+            for name in ("unread_total", "unread_by_peer", "last_read", "last_read_legacy",
+                         "dedup_buckets", "dedup_legacy", "dirty", "other")
+        }
+        scanned = 0
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis_counters.scan(cursor=cursor, count=1000)
+            if not full:
+                keys = keys[:max(0, max_keys - scanned)]
+            scanned += len(keys)
+            if keys:
+                pipe = self.redis_counters.pipeline(transaction=False)
+                for key in keys:
+                    pipe.memory_usage(key, samples=samples)
+                for key, used in zip(keys, await pipe.execute()):
+                    entry = structures[self._structure_of(key)]
+                    entry["keys"] += 1
+                    entry["bytes"] += int(used or 0)
+            if cursor == 0 or (not full and scanned >= max_keys):
+                break
+        info = await self.redis_counters.info("memory")
+        return {
+            "used_memory": info.get("used_memory"),
+            "used_memory_human": info.get("used_memory_human"),
+            "total_keys": await self.redis_counters.dbsize(),
+            "scanned_keys": scanned,
+            "complete": cursor == 0,
+            "samples": samples,
+            "structures": structures,
+        }
+
+    @staticmethod
+    def _structure_of(key: str) -> str:
+        if key == DIRTY_PAIRS_KEY:
+            return "dirty"
+        if key.startswith("event_dedup_bucket:"):
+            return "dedup_buckets"
+        if key.startswith("event_dedup:"):
+            return "dedup_legacy"
+        if key.startswith("user:"):
+            parts = key.split(":")
+            if len(parts) == 3 and parts[2] in ("unread_total", "unread_by_peer", "last_read"):
+                return parts[2]
+            if len(parts) == 4 and parts[2] == "last_read":
+                return "last_read_legacy"
+        return "other"
 
 
 class MarkReadRequest(BaseModel):
@@ -192,6 +666,16 @@ async def on_startup():
     service = CounterService(redis_url)
     counter_service = service  # Update alias
     await service.connect()
+
+    # Пересборка идет до подключения потребителя событий, чтобы не гоняться с ним
+    if REBUILD_ON_STARTUP in ("always", "if_missing"):
+        from .rebuild import needs_rebuild, rebuild_counters
+        if REBUILD_ON_STARTUP == "always" or await needs_rebuild(service):
+            logger.info("Rebuilding counters from the dialog store")
+            try:
+                await rebuild_counters(service)
+            except Exception as e:
+                logger.error(f"Counter rebuild failed: {e}")
     
     # Initialize RabbitMQ consumer if configured
     events_transport = os.getenv('EVENTS_TRANSPORT', 'http').lower()
@@ -202,6 +686,10 @@ async def on_startup():
             await init_rabbitmq_consumer()
         except Exception as e:
             logger.error(f"Failed to initialize RabbitMQ consumer: {e}")
+    elif events_transport == 'redis_streams':
+        logger.info("Initializing Redis Streams consumer")
+        from .redis_streams_consumer import init_redis_streams_consumer
+        await init_redis_streams_consumer(service.redis_counters)
 
 
 @app.on_event("shutdown")
@@ -215,6 +703,10 @@ async def on_shutdown():
             await close_rabbitmq_consumer()
         except Exception as e:
             logger.error(f"Error closing RabbitMQ consumer: {e}")
+    elif events_transport == 'redis_streams':
+        logger.info("Closing Redis Streams consumer")
+        from .redis_streams_consumer import close_redis_streams_consumer
+        await close_redis_streams_consumer()
     
     if service:
         await service.close()
@@ -222,7 +714,43 @@ async def on_shutdown():
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    status = {"status": "ok"}
+    if service and service.write_behind:
+        status["write_behind"] = service.write_behind.get_stats()
+    if service:
+        status["reconciliation"] = service.reconcile_stats
+    from . import redis_streams_consumer
+    if redis_streams_consumer.redis_streams_consumer:
+        status["redis_streams"] = redis_streams_consumer.redis_streams_consumer.get_stats()
+    return status
+
+
+class PeerCounterQuery(BaseModel):
+    user_id: str
+    peer_user_id: str
+
+
+class CountersBatchRequest(BaseModel):
+    user_ids: List[str] = []
+    peers: List[PeerCounterQuery] = []
+
+
+@app.post("/api/v1/counters/batch")
+async def get_counters_batch(req: CountersBatchRequest):
+    """Totals for user_ids and per-peer counters for peers in one Redis round trip."""
+    if len(req.user_ids) + len(req.peers) > COUNTERS_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items, max {COUNTERS_BATCH_MAX_ITEMS}")
+    return await service.get_counters_batch(req.user_ids, [(p.user_id, p.peer_user_id) for p in req.peers])
+
+
+@app.get("/internal/memory")
+async def memory_report(samples: int = MEMORY_REPORT_SAMPLES, max_keys: int = MEMORY_REPORT_MAX_KEYS,
+                        full: bool = False):
+    """
+    Counter Redis memory per structure, meant for operators. Samples the first
+    max_keys keys of a SCAN; full=true walks every key.
+    """
+    return await service.memory_report(max(0, samples), max(0, max_keys), full)
 
 
 @app.get("/api/v1/counters/{user_id}")
@@ -268,3 +796,19 @@ async def messages_read(event: MessagesReadEvent):
     return {"applied": ok}
 
 
+class EventEnvelope(BaseModel):
+    event_type: str
+    payload: Dict[str, Any]
+
+
+class EventBatch(BaseModel):
+    events: List[EventEnvelope]
+
+
+@app.post("/internal/events/batch")
+async def events_batch(batch: EventBatch):
+    """Apply a batch of mixed events in one Redis round trip; results are per event."""
+    results = await service.apply_events([event.dict() for event in batch.events])
+    return {"results": results}
+
+
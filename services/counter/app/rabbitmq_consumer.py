@@ -1,211 +1,258 @@
 """
 RabbitMQ Event Consumer for Counter Service
+
+asyncio-native (aio-pika). Prefetched messages are processed concurrently:
+events are routed to partitions by the user whose counters they change, so
+events of one user are applied in order while different users are processed
+in parallel. Each partition applies what it has accumulated with one
+CounterService.apply_events call (one Redis pipeline). Acks are batched:
+the consumer acknowledges the longest contiguous prefix of processed
+deliveries with a single ack(multiple=True).
 """
-import pika
+import asyncio
+import collections
 import json
 import logging
 import os
-import asyncio
-from typing import Dict, Any, Optional, Callable
-from concurrent.futures import ThreadPoolExecutor
+import zlib
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import aio_pika
 
 logger = logging.getLogger(__name__)
 
+EXCHANGE_NAME = 'counter_events'
+QUEUE_NAME = 'counter_service_events'
+BATCH_EVENT_TYPE = 'Batch'
+
+RABBITMQ_PREFETCH = int(os.getenv("RABBITMQ_PREFETCH", "200"))
+RABBITMQ_CONSUMER_PARTITIONS = int(os.getenv("RABBITMQ_CONSUMER_PARTITIONS", "16"))
+# Сколько событий партиция применяет одним pipeline
+RABBITMQ_APPLY_BATCH = int(os.getenv("RABBITMQ_APPLY_BATCH", "100"))
+RABBITMQ_ACK_INTERVAL_MS = float(os.getenv("RABBITMQ_ACK_INTERVAL_MS", "20"))
+
+
+def _event_owner(event_type: str, event_data: Dict[str, Any]) -> str:
+    """User whose counters the event changes"""
+    if event_type == 'MessageSent':
+        return str(event_data.get('to_user_id') or '')
+    return str(event_data.get('user_id') or '')
+
+
+def _normalize_event(event_type: str, event_data: Dict[str, Any]) -> Dict[str, Any]:
+    payload = dict(event_data)
+    # Старые паблишеры передавали собеседника как peer_id
+    if event_type == 'MessagesRead' and 'peer_user_id' not in payload and 'peer_id' in payload:
+        payload['peer_user_id'] = payload['peer_id']
+    return {"event_type": event_type, "payload": payload}
+
+
+class _Delivery:
+    """Одно сообщение AMQP и число его событий, которые еще не применены"""
+    __slots__ = ("message", "remaining", "failed")
+
+    def __init__(self, message: aio_pika.abc.AbstractIncomingMessage, events: int):
+        self.message = message
+        self.remaining = events
+        self.failed = False
+
+
+class AckTracker:
+    """
+    Пакетное подтверждение: сообщения завершаются в произвольном порядке,
+    подтверждается непрерывный префикс доставок одним ack(multiple=True).
+    """
+
+    def __init__(self):
+        self._channel = None
+        self._outstanding: Deque[_Delivery] = collections.deque()
+        self._done: Set[int] = set()
+        self._ack_upto: Optional[_Delivery] = None
+
+    def track(self, delivery: _Delivery):
+        channel = delivery.message.channel
+        if channel is not self._channel:
+            # Канал переоткрыт после разрыва: старые доставки брокер переотправит сам
+            self._channel = channel
+            self._outstanding.clear()
+            self._done.clear()
+            self._ack_upto = None
+        self._outstanding.append(delivery)
+
+    def complete(self, delivery: _Delivery):
+        if delivery.message.channel is not self._channel:
+            return
+        self._done.add(delivery.message.delivery_tag)
+        while self._outstanding and self._outstanding[0].message.delivery_tag in self._done:
+            head = self._outstanding.popleft()
+            self._done.discard(head.message.delivery_tag)
+            # Отклоненные сообщения уже сняты с подтверждения, multiple-ack их не затрагивает
+            if not head.failed:
+                self._ack_upto = head
+
+    async def flush(self):
+        delivery, self._ack_upto = self._ack_upto, None
+        if delivery is None:
+            return
+        try:
+            await delivery.message.ack(multiple=True)
+        except Exception as e:
+            logger.error(f"Failed to ack deliveries up to {delivery.message.delivery_tag}: {e}")
+
+
 class RabbitMQEventConsumer:
-    def __init__(self, rabbitmq_url: str, event_handler: Callable, event_loop: asyncio.AbstractEventLoop):
+    def __init__(self, rabbitmq_url: str, partitions: int = RABBITMQ_CONSUMER_PARTITIONS,
+                 prefetch: int = RABBITMQ_PREFETCH):
         self.rabbitmq_url = rabbitmq_url
-        self.event_handler = event_handler
-        self.event_loop = event_loop  # Store the main event loop
-        self.connection: Optional[pika.BlockingConnection] = None
-        self.channel: Optional[pika.channel.Channel] = None
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.running = False
-        
-    def connect(self):
-        """Establish connection to RabbitMQ"""
+        self.partitions = max(1, partitions)
+        self.prefetch = prefetch
+        self.connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self.channel: Optional[aio_pika.abc.AbstractChannel] = None
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._acks = AckTracker()
+        self.processed = 0
+
+    async def connect(self):
+        """Establish connection to RabbitMQ and start consuming"""
         try:
             logger.info(f"Connecting to RabbitMQ: {self.rabbitmq_url}")
-            
-            # Parse connection parameters
-            params = pika.URLParameters(self.rabbitmq_url)
-            self.connection = pika.BlockingConnection(params)
-            self.channel = self.connection.channel()
-            
+            self.connection = await aio_pika.connect_robust(self.rabbitmq_url)
+            self.channel = await self.connection.channel()
+            await self.channel.set_qos(prefetch_count=self.prefetch)
+
             # Declare exchange (should match publisher)
-            self.channel.exchange_declare(
-                exchange='counter_events',
-                exchange_type='topic',
-                durable=True
-            )
-            
-            # Declare queue for counter service
-            queue_result = self.channel.queue_declare(
-                queue='counter_service_events',
-                durable=True
+            exchange = await self.channel.declare_exchange(
+                EXCHANGE_NAME, aio_pika.ExchangeType.TOPIC, durable=True
             )
-            queue_name = queue_result.method.queue
-            
-            # Bind queue to exchange with routing patterns
-            self.channel.queue_bind(
-                exchange='counter_events',
-                queue=queue_name,
-                routing_key='counter.*'
-            )
-            
-            # Set up consumer
-            self.channel.basic_qos(prefetch_count=10)  # Process up to 10 messages at a time
-            self.channel.basic_consume(
-                queue=queue_name,
-                on_message_callback=self._on_message
+            queue = await self.channel.declare_queue(QUEUE_NAME, durable=True)
+            await queue.bind(exchange, routing_key='counter.*')
+
+            self._queues = [asyncio.Queue() for _ in range(self.partitions)]
+            self._tasks = [asyncio.create_task(self._partition_worker(q)) for q in self._queues]
+            self._tasks.append(asyncio.create_task(self._ack_loop()))
+            await queue.consume(self._on_message, no_ack=False)
+
+            logger.info(
+                f"Successfully connected to RabbitMQ and set up consumer "
+                f"(prefetch={self.prefetch}, partitions={self.partitions})"
             )
-            
-            logger.info("Successfully connected to RabbitMQ and set up consumer")
-            
         except Exception as e:
             logger.error(f"Failed to connect to RabbitMQ: {e}")
             raise
-    
-    def disconnect(self):
+
+    async def disconnect(self):
         """Close RabbitMQ connection"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
         try:
-            self.running = False
-            if self.channel and not self.channel.is_closed:
-                self.channel.stop_consuming()
-                self.channel.close()
+            await self._acks.flush()
             if self.connection and not self.connection.is_closed:
-                self.connection.close()
+                await self.connection.close()
             logger.info("Disconnected from RabbitMQ")
         except Exception as e:
             logger.error(f"Error disconnecting from RabbitMQ: {e}")
-    
-    def _on_message(self, channel, method, properties, body):
-        """Handle incoming message"""
+        finally:
+            self.connection = None
+            self.channel = None
+
+    def _partition_of(self, user_id: str) -> asyncio.Queue:
+        return self._queues[zlib.crc32(user_id.encode()) % self.partitions]
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        """Route events of the message to user partitions (does not wait for processing)"""
         try:
-            # Parse message
-            message = json.loads(body.decode('utf-8'))
-            event_type = message.get('event_type')
-            event_data = message.get('data', {})
-            
+            body = json.loads(message.body.decode('utf-8'))
+            event_type = body.get('event_type')
+            event_data = body.get('data', {})
+            if event_type == BATCH_EVENT_TYPE:
+                events = [(item.get('event_type'), item.get('data', {})) for item in event_data.get('events', [])]
+            else:
+                events = [(event_type, event_data)]
+        except Exception as e:
+            logger.error(f"Error parsing message: {e}")
+            # Reject message and don't requeue (dead letter or discard)
+            await message.nack(requeue=False)
+            return
+
+        delivery = _Delivery(message, len(events))
+        self._acks.track(delivery)
+        if not events:
+            self._acks.complete(delivery)
+            return
+        for event_type, event_data in events:
             logger.debug(f"Received event: {event_type} -> {event_data}")
-            
-            # Process event in async context using the stored event loop
-            future = asyncio.run_coroutine_threadsafe(
-                self.event_handler(event_type, event_data),
-                self.event_loop
+            self._partition_of(_event_owner(event_type, event_data)).put_nowait(
+                (delivery, _normalize_event(event_type, event_data))
             )
-            # Optional: wait for completion to handle errors
+
+    async def _partition_worker(self, queue: asyncio.Queue):
+        # События партиции применяются строго по порядку получения
+        while True:
+            batch: List[Tuple[_Delivery, Dict[str, Any]]] = [await queue.get()]
+            while len(batch) < RABBITMQ_APPLY_BATCH and not queue.empty():
+                batch.append(queue.get_nowait())
             try:
-                future.result(timeout=30)  # 30 second timeout
+                from .main import counter_service
+                results = await counter_service.apply_events([event for _, event in batch])
+                errors = [result.get("error") for result in results]
             except Exception as e:
                 logger.error(f"Event handler failed: {e}")
-                raise
-            
-            # Acknowledge message
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-            
-        except Exception as e:
-            logger.error(f"Error processing message: {e}")
-            # Reject message and don't requeue (dead letter or discard)
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-    
-    def start_consuming(self):
-        """Start consuming messages (blocking)"""
-        try:
-            if not self.channel:
-                self.connect()
-            
-            self.running = True
-            logger.info("Starting to consume messages...")
-            self.channel.start_consuming()
-            
-        except KeyboardInterrupt:
-            logger.info("Consumer interrupted")
-            self.disconnect()
-        except Exception as e:
-            logger.error(f"Error in consumer: {e}")
-            self.disconnect()
-            raise
+                errors = [str(e)] * len(batch)
+            for (delivery, event), error in zip(batch, errors):
+                if error:
+                    logger.error(f"Error processing event {event['event_type']}: {error}")
+                    delivery.failed = True
+                await self._finish_event(delivery)
+            self.processed += len(batch)
+
+    async def _finish_event(self, delivery: _Delivery):
+        delivery.remaining -= 1
+        if delivery.remaining > 0:
+            return
+        if delivery.failed:
+            try:
+                await delivery.message.nack(requeue=False)
+            except Exception as e:
+                logger.error(f"Failed to nack delivery {delivery.message.delivery_tag}: {e}")
+        self._acks.complete(delivery)
+
+    async def _ack_loop(self):
+        while True:
+            await asyncio.sleep(RABBITMQ_ACK_INTERVAL_MS / 1000.0)
+            await self._acks.flush()
 
 # Global consumer instance
 rabbitmq_consumer: Optional[RabbitMQEventConsumer] = None
-consumer_task: Optional[asyncio.Task] = None
-
-async def handle_counter_event(event_type: str, event_data: Dict[str, Any]):
-    """Handle counter events from RabbitMQ"""
-    try:
-        # Import here to avoid circular imports
-        from .main import counter_service
-        
-        if event_type == 'MessageSent':
-            # Extract event data
-            event_id = event_data.get('event_id')
-            to_user_id = event_data.get('to_user_id')
-            from_user_id = event_data.get('from_user_id')
-            
-            if event_id and to_user_id and from_user_id:
-                await counter_service.apply_message_sent(event_id, to_user_id, from_user_id)
-            else:
-                logger.error(f"Invalid MessageSent event data: {event_data}")
-                
-        elif event_type == 'MessagesRead':
-            # Extract event data
-            event_id = event_data.get('event_id')
-            user_id = event_data.get('user_id')
-            peer_id = event_data.get('peer_id')
-            delta = event_data.get('delta', 0)
-            last_read_ts = event_data.get('last_read_ts')
-            
-            if event_id and user_id and peer_id and delta > 0:
-                await counter_service.apply_messages_read(event_id, user_id, peer_id, delta, last_read_ts)
-            else:
-                logger.error(f"Invalid MessagesRead event data: {event_data}")
-        else:
-            logger.warning(f"Unknown event type: {event_type}")
-            
-    except Exception as e:
-        logger.error(f"Error handling event {event_type}: {e}")
 
 async def init_rabbitmq_consumer():
     """Initialize RabbitMQ consumer"""
-    global rabbitmq_consumer, consumer_task
-    
+    global rabbitmq_consumer
+
     rabbitmq_url = os.getenv("RABBITMQ_URL")
     if not rabbitmq_url:
         logger.warning("RABBITMQ_URL not configured, skipping RabbitMQ consumer initialization")
         return
-    
+
     try:
-        # Get the current event loop and pass it to the consumer
-        loop = asyncio.get_event_loop()
-        rabbitmq_consumer = RabbitMQEventConsumer(rabbitmq_url, handle_counter_event, loop)
-        
-        # Start consumer in background thread
-        consumer_task = loop.run_in_executor(None, rabbitmq_consumer.start_consuming)
-        
+        rabbitmq_consumer = RabbitMQEventConsumer(rabbitmq_url)
+        await rabbitmq_consumer.connect()
         logger.info("RabbitMQ consumer initialized successfully")
-        
     except Exception as e:
         logger.error(f"Failed to initialize RabbitMQ consumer: {e}")
         rabbitmq_consumer = None
 
 async def close_rabbitmq_consumer():
     """Close RabbitMQ consumer"""
-    global rabbitmq_consumer, consumer_task
-    
+    global rabbitmq_consumer
+
     if rabbitmq_consumer:
         try:
-            rabbitmq_consumer.disconnect()
+            await rabbitmq_consumer.disconnect()
             logger.info("RabbitMQ consumer closed successfully")
         except Exception as e:
             logger.error(f"Error closing RabbitMQ consumer: {e}")
         finally:
             rabbitmq_consumer = None
-    
-    if consumer_task:
-        try:
-            consumer_task.cancel()
-            await consumer_task
-        except Exception:
-            pass
-        finally:
-            consumer_task = None
@@ -0,0 +1,262 @@
+"""
+Full rebuild of unread counters from the dialog store
+
+Used after the counter Redis lost its data: counters are recomputed from the
+dialogs and the read markers kept by the dialog service, and written back
+with large pipelines. Sources:
+
+- redis: dialog:{a}:{b} sorted sets (RedisDialogAdapter) or dialog_stream:{a}:{b}
+  streams (RedisStreamDialogAdapter), the inbox:{to}:{from} index and the
+  read:{user}:{peer} markers;
+- postgres: dialog_messages and dialog_read_markers, one streaming query per
+  worker over a hash partition of recipients.
+
+Per-peer counters are written with HSET and zero counters are removed with
+HDEL, so a rerun over a non-empty Redis also clears stale values; totals are recomputed atomically
+from the per-peer hashes at the end. Only one instance rebuilds at a time
+(a SET NX lease).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .main import INBOX_BACKFILLED_KEY
+
+logger = logging.getLogger(__name__)
+
+REBUILD_WORKERS = int(os.getenv("COUNTER_REBUILD_WORKERS", "8"))
+# Пар (получатель, отправитель) на один pipeline записи
+REBUILD_PIPELINE_SIZE = int(os.getenv("COUNTER_REBUILD_PIPELINE_SIZE", "2000"))
+REBUILD_SOURCE = os.getenv("COUNTER_REBUILD_SOURCE", "redis").lower()
+# Ключ с временем последней полной пересборки: его нет - данные counter Redis потеряны
+REBUILT_AT_KEY = "counters:rebuilt_at"
+# Аренда пересборки: реплики, стартующие одновременно, не пересобирают параллельно
+REBUILD_LEASE_KEY = "counters:rebuild:lease"
+REBUILD_LEASE_SEC = int(os.getenv("COUNTER_REBUILD_LEASE_SEC", "3600"))
+
+# Удалить аренду, только если она наша
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Непрочитанные по парам для одной хеш-секции получателей
+PG_UNREAD_SQL = """
+SELECT m.to_user_id::text, m.from_user_id::text, r.last_read_at,
+       count(*) FILTER (WHERE m.created_at > coalesce(r.last_read_at, '-infinity'::timestamp)) AS unread
+FROM dialog_messages m
+LEFT JOIN dialog_read_markers r ON r.user_id = m.to_user_id AND r.peer_user_id = m.from_user_id
+WHERE (hashtext(m.to_user_id::text) & 2147483647) % $1 = $2
+GROUP BY m.to_user_id, m.from_user_id, r.last_read_at
+"""
+
+# (получатель, отправитель, непрочитано, маркер прочтения или None)
+PairCount = Tuple[str, str, int, Optional[float]]
+
+
+class CounterRebuilder:
+    def __init__(self, service, workers: int = REBUILD_WORKERS, pipeline_size: int = REBUILD_PIPELINE_SIZE):
+        self.service = service
+        self.workers = max(1, workers)
+        self.pipeline_size = max(1, pipeline_size)
+        self.users: Set[str] = set()
+        self.stats = {"dialogs": 0, "pairs": 0, "users": 0}
+
+    async def run(self, source: str = REBUILD_SOURCE) -> Dict[str, Any]:
+        started = time.monotonic()
+        if source == "redis":
+            await self._rebuild_from_redis()
+        elif source in ("postgres", "postgresql"):
+            await self._rebuild_from_postgres()
+        else:
+            raise ValueError(f"Unknown rebuild source: {source}")
+        await self._write_totals()
+        await self.service.redis_counters.set(REBUILT_AT_KEY, time.time())
+        self.stats["users"] = len(self.users)
+        self.stats["seconds"] = round(time.monotonic() - started, 2)
+        logger.info(f"Counter rebuild from {source} finished: {self.stats}")
+        return self.stats
+
+    async def _write_pairs(self, pairs: List[PairCount]):
+        service = self.service
+        pipe = service.redis_counters.pipeline(transaction=False)
+        for to_user_id, from_user_id, unread, last_read_ts in pairs:
+            if unread:
+                pipe.hset(service._key_by_peer(to_user_id), from_user_id, unread)
+            else:
+                # Отсутствующее поле читается как 0: удаляем, а не храним нули
+                pipe.hdel(service._key_by_peer(to_user_id), from_user_id)
+            if last_read_ts is not None:
+                pipe.hset(service._key_last_read(to_user_id), from_user_id, last_read_ts)
+            self.users.add(to_user_id)
+        await pipe.execute()
+        self.stats["pairs"] += len(pairs)
+
+    async def _write_totals(self):
+        users = list(self.users)
+        service = self.service
+        for start in range(0, len(users), self.pipeline_size):
+            chunk = users[start:start + self.pipeline_size]
+            keys = []
+            for user_id in chunk:
+                keys += [service._key_total(user_id), service._key_by_peer(user_id)]
+            await service.redis_counters.fcall("counter_recompute_totals", len(keys), *keys)
+
+    async def _run_workers(self, producer, worker):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        tasks = [asyncio.create_task(worker(queue)) for _ in range(self.workers)]
+        try:
+            await producer(queue)
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # --- Redis ---
+
+    async def _rebuild_from_redis(self):
+        dialogs = self.service.redis_dialogs
+
+        async def producer(queue: asyncio.Queue):
+            for pattern in ("dialog:*", "dialog_stream:*"):
+                cursor = 0
+                while True:
+                    cursor, keys = await dialogs.scan(cursor=cursor, match=pattern, count=self.pipeline_size)
+                    if keys:
+                        await queue.put(keys)
+                    if cursor == 0:
+                        break
+
+        async def worker(queue: asyncio.Queue):
+            while True:
+                keys = await queue.get()
+                if keys is None:
+                    return
+                pairs = await self._count_redis_dialogs(keys)
+                if pairs:
+                    await self._write_pairs(pairs)
+                self.stats["dialogs"] += len(keys)
+
+        await self._run_workers(producer, worker)
+
+    async def _count_redis_dialogs(self, dialog_keys: List[str]) -> List[PairCount]:
+        service = self.service
+        directions: List[Tuple[str, str, str]] = []
+        for dialog_key in dialog_keys:
+            parts = dialog_key.split(":")
+            if len(parts) != 3:
+                continue
+            _, a, b = parts
+            directions.append((a, b, dialog_key))
+            directions.append((b, a, dialog_key))
+
+        # Маркеры хранилища диалогов, маркеры counter Redis (если уцелели) и наличие индекса входящих
+        pipe = service.redis_dialogs.pipeline(transaction=False)
+        for to_user_id, from_user_id, _ in directions:
+            pipe.get(f"read:{to_user_id}:{from_user_id}")
+            pipe.exists(service._inbox_key(to_user_id, from_user_id))
+            pipe.zrange(service._inbox_key(to_user_id, from_user_id), 0, 0, withscores=True)
+        pipe.exists(INBOX_BACKFILLED_KEY)
+        replies = await pipe.execute()
+        backfilled = bool(replies.pop())
+        counters_pipe = service.redis_counters.pipeline(transaction=False)
+        for to_user_id, from_user_id, _ in directions:
+            counters_pipe.hget(service._key_last_read(to_user_id), from_user_id)
+        counter_markers = await counters_pipe.execute()
+
+        markers: List[Optional[float]] = []
+        pipe = service.redis_dialogs.pipeline(transaction=False)
+        for i, (to_user_id, from_user_id, dialog_key) in enumerate(directions):
+            marker, indexed, oldest = replies[3 * i], replies[3 * i + 1], replies[3 * i + 2]
+            if marker is None:
+                marker = counter_markers[i]
+            last_ts = float(marker) if marker is not None else None
+            markers.append(last_ts)
+            low = f"({last_ts}" if last_ts is not None else "-inf"
+            # Потоковый диалог всегда пишется с индексом: индекса нет - нет и входящих.
+            # Индекс старого диалога, начатый после маркера, неполон: считаем по диалогу
+            complete = indexed and service._inbox_complete(oldest, backfilled, last_ts or 0.0)
+            if complete or dialog_key.startswith("dialog_stream:"):
+                pipe.zcount(service._inbox_key(to_user_id, from_user_id), low, "+inf")
+            else:
+                # Диалог записан до появления индекса входящих (или индекс еще не заполнен)
+                pipe.zrangebyscore(dialog_key, min=low, max="+inf")
+        counts = await pipe.execute()
+
+        pairs: List[PairCount] = []
+        for (to_user_id, from_user_id, _), last_ts, count in zip(directions, markers, counts):
+            if isinstance(count, list):
+                count = sum(1 for raw in count if _is_message_to(raw, to_user_id))
+            # Пары без непрочитанных тоже пишутся: их устаревший счетчик обнуляется
+            pairs.append((to_user_id, from_user_id, int(count), last_ts))
+        return pairs
+
+    # --- PostgreSQL ---
+
+    async def _rebuild_from_postgres(self):
+        import asyncpg
+
+        dsn = os.getenv("COUNTER_REBUILD_PG_DSN") or "postgresql://{user}:{password}@{host}:{port}/{name}".format(
+            user=os.getenv("DB_USER", "postgres"),
+            password=os.getenv("DB_PASSWORD", "postgres"),
+            host=os.getenv("DB_HOST", "citus-coordinator"),
+            port=os.getenv("DB_PORT", "5432"),
+            name=os.getenv("DB_NAME", "social_network"),
+        )
+
+        async def partition_worker(partition: int):
+            conn = await asyncpg.connect(dsn)
+            try:
+                batch: List[PairCount] = []
+                async with conn.transaction():
+                    # Курсор отдает строки порциями, не материализуя весь результат в памяти
+                    async for row in conn.cursor(PG_UNREAD_SQL, self.workers, partition, prefetch=self.pipeline_size):
+                        last_read_at = row["last_read_at"]
+                        last_ts = (
+                            last_read_at.replace(tzinfo=timezone.utc).timestamp()
+                            if last_read_at is not None and last_read_at.year > 1 else None
+                        )
+                        batch.append((row["to_user_id"], row["from_user_id"], int(row["unread"]), last_ts))
+                        if len(batch) >= self.pipeline_size:
+                            await self._write_pairs(batch)
+                            batch = []
+                if batch:
+                    await self._write_pairs(batch)
+            finally:
+                await conn.close()
+
+        await asyncio.gather(*(partition_worker(i) for i in range(self.workers)))
+
+
+def _is_message_to(raw: str, user_id: str) -> bool:
+    try:
+        return str(json.loads(raw).get("to_user_id")) == str(user_id)
+    except Exception:
+        return False
+
+
+async def rebuild_counters(service, source: str = REBUILD_SOURCE, workers: int = REBUILD_WORKERS,
+                           pipeline_size: int = REBUILD_PIPELINE_SIZE) -> Optional[Dict[str, Any]]:
+    """Rebuild under the lease; None if another instance is rebuilding"""
+    token = uuid.uuid4().hex
+    if not await service.redis_counters.set(REBUILD_LEASE_KEY, token, nx=True, ex=REBUILD_LEASE_SEC):
+        logger.warning("Counter rebuild is already running on another instance, skipping")
+        return None
+    try:
+        return await CounterRebuilder(service, workers, pipeline_size).run(source)
+    finally:
+        await service.redis_counters.eval(RELEASE_LEASE_LUA, 1, REBUILD_LEASE_KEY, token)
+
+
+async def needs_rebuild(service) -> bool:
+    """The rebuilt_at marker is gone: the counter Redis was flushed or lost its data"""
+    return not await service.redis_counters.exists(REBUILT_AT_KEY)
@@ -0,0 +1,245 @@
+"""
+Redis Streams Event Consumer for Counter Service
+
+Events are spread over COUNTER_EVENTS_STREAMS streams (counter:events:{n}) by
+dialog, like outbox shards. Each stream has a single owner at a time: a
+replica reads a stream only while it holds the stream's lease, and always as
+the same consumer of the group (shard-{n}). Events of one dialog are therefore
+applied in order even with several counter replicas: a MessagesRead is never
+applied before the MessageSent it reads. When a replica dies, its lease
+expires; the next owner reads the same consumer's pending entries first, in
+order, before new ones, so no XAUTOCLAIM is needed.
+
+A read is XREADGROUP with a large COUNT, one CounterService.apply_events call
+(one Redis pipeline), then XACK + XDEL of the whole batch in one pipeline.
+Events the service rejects go to a dead-letter stream. The lease is renewed
+again before the ack: if it was lost while the batch was applied, the batch is
+left pending for the new owner instead of being acked under its feet.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+COUNTER_EVENTS_STREAM = os.getenv("COUNTER_EVENTS_STREAM", "counter:events")
+# Должно совпадать с COUNTER_EVENTS_STREAMS dialog-service
+COUNTER_EVENTS_STREAMS = int(os.getenv("COUNTER_EVENTS_STREAMS", "16"))
+COUNTER_EVENTS_DEAD_STREAM = os.getenv("COUNTER_EVENTS_DEAD_STREAM", "counter:events:dead")
+COUNTER_EVENTS_GROUP = os.getenv("COUNTER_EVENTS_GROUP", "counter-service")
+
+REDIS_STREAMS_READ_COUNT = int(os.getenv("REDIS_STREAMS_READ_COUNT", "1000"))
+REDIS_STREAMS_BLOCK_MS = int(os.getenv("REDIS_STREAMS_BLOCK_MS", "1000"))
+# Аренда потока: владелец продлевает ее перед каждым чтением; упавший владелец
+# теряет поток через REDIS_STREAMS_LEASE_MS
+REDIS_STREAMS_LEASE_MS = int(os.getenv("REDIS_STREAMS_LEASE_MS", "15000"))
+REDIS_STREAMS_DEAD_MAXLEN = 100000
+
+# Взять или продлить аренду, если она свободна или уже наша
+# KEYS: lease; ARGV: owner, lease_ms
+LEASE_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Отпустить аренду, только если она наша
+# KEYS: lease; ARGV: owner
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# (ID записи, поля записи)
+StreamEntry = Tuple[str, Dict[str, str]]
+
+
+def stream_name(shard: int) -> str:
+    return f"{COUNTER_EVENTS_STREAM}:{shard}"
+
+
+def _parse_entry(fields: Dict[str, str]) -> Dict[str, Any]:
+    event_type = fields["event_type"]
+    payload = json.loads(fields["payload"])
+    # Старые паблишеры передавали собеседника как peer_id
+    if event_type == 'MessagesRead' and 'peer_user_id' not in payload and 'peer_id' in payload:
+        payload['peer_user_id'] = payload['peer_id']
+    return {"event_type": event_type, "payload": payload}
+
+
+class RedisStreamsEventConsumer:
+    def __init__(self, client: redis.Redis, streams: int = COUNTER_EVENTS_STREAMS):
+        self.client = client
+        self.streams = max(1, streams)
+        # Уникальный токен экземпляра: им помечаются аренды потоков
+        self.owner = f"counter-{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self._lease = client.register_script(LEASE_LUA)
+        self._release = client.register_script(RELEASE_LUA)
+        self._tasks: List[asyncio.Task] = []
+        self.owned: Set[int] = set()
+        self.processed = 0
+        self.dead_lettered = 0
+
+    async def start(self):
+        for shard in range(self.streams):
+            try:
+                await self.client.xgroup_create(stream_name(shard), COUNTER_EVENTS_GROUP, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                # BUSYGROUP: группа уже создана
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._tasks = [asyncio.create_task(self._shard_loop(shard)) for shard in range(self.streams)]
+        logger.info(
+            f"Consuming {COUNTER_EVENTS_STREAM}:0..{self.streams - 1} as {COUNTER_EVENTS_GROUP} "
+            f"(owner={self.owner}, count={REDIS_STREAMS_READ_COUNT})"
+        )
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Отпускаем аренды сразу, чтобы другие реплики не ждали их истечения
+        for shard in list(self.owned):
+            try:
+                await self._release(keys=[self._lease_key(shard)], args=[self.owner])
+            except Exception as e:
+                logger.error(f"Error releasing lease of {stream_name(shard)}: {e}")
+        self.owned.clear()
+
+    def _lease_key(self, shard: int) -> str:
+        return f"{stream_name(shard)}:lease"
+
+    async def _hold_lease(self, shard: int) -> bool:
+        return bool(await self._lease(keys=[self._lease_key(shard)], args=[self.owner, REDIS_STREAMS_LEASE_MS]))
+
+    async def _shard_loop(self, shard: int):
+        stream = stream_name(shard)
+        # Имя потребителя принадлежит потоку, а не реплике: новый владелец видит pending прежнего
+        consumer = f"shard-{shard}"
+        start_id = "0"
+        while True:
+            try:
+                if not await self._hold_lease(shard):
+                    if shard in self.owned:
+                        logger.warning(f"Lost lease of {stream}")
+                        self.owned.discard(shard)
+                    await asyncio.sleep(REDIS_STREAMS_LEASE_MS / 3000)
+                    continue
+                if shard not in self.owned:
+                    logger.info(f"Acquired lease of {stream}")
+                    self.owned.add(shard)
+                    # "0" - доставленные, но не подтвержденные записи; ">" - новые
+                    start_id = "0"
+                response = await self.client.xreadgroup(
+                    COUNTER_EVENTS_GROUP, consumer, {stream: start_id},
+                    count=REDIS_STREAMS_READ_COUNT,
+                    block=None if start_id == "0" else REDIS_STREAMS_BLOCK_MS
+                )
+                entries = response[0][1] if response else []
+                if start_id == "0" and not entries:
+                    start_id = ">"
+                    continue
+                if entries and not await self._process(shard, entries):
+                    logger.warning(f"Lost lease of {stream} before ack, batch left pending")
+                    self.owned.discard(shard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reading {stream}: {e}")
+                # Прочитанная пачка осталась pending: перечитаем ее первой
+                start_id = "0"
+                await asyncio.sleep(1)
+
+    async def _process(self, shard: int, entries: List[StreamEntry]) -> bool:
+        """Apply a batch and ack it; False if the lease was lost before the ack"""
+        from .main import counter_service
+
+        stream = stream_name(shard)
+        events: List[Dict[str, Any]] = []
+        event_ids: List[str] = []
+        dead: List[Tuple[str, Dict[str, str], str]] = []
+        for entry_id, fields in entries:
+            # Запись, удаленная обрезкой потока до подтверждения, приходит без полей
+            if not fields:
+                continue
+            try:
+                events.append(_parse_entry(fields))
+                event_ids.append(entry_id)
+            except (KeyError, TypeError, ValueError) as e:
+                dead.append((entry_id, fields, f"Invalid entry: {e}"))
+
+        # Ошибка применения пачки целиком пробрасывается: записи остаются pending
+        results = await counter_service.apply_events(events) if events else []
+        for entry_id, event, result in zip(event_ids, events, results):
+            if result.get("error"):
+                dead.append((entry_id, {"event_type": event["event_type"], "payload": json.dumps(event["payload"])},
+                             result["error"]))
+
+        # Пока пачка применялась, аренда могла истечь и уйти другой реплике:
+        # ее pending-записи теперь принадлежат новому владельцу
+        if not await self._hold_lease(shard):
+            return False
+
+        pipe = self.client.pipeline(transaction=False)
+        for entry_id, fields, error in dead:
+            logger.error(f"Dead-lettering {stream} entry {entry_id}: {error}")
+            pipe.xadd(
+                COUNTER_EVENTS_DEAD_STREAM, {**fields, "stream": stream, "entry_id": entry_id, "error": error},
+                maxlen=REDIS_STREAMS_DEAD_MAXLEN, approximate=True
+            )
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe.xack(stream, COUNTER_EVENTS_GROUP, *entry_ids)
+        pipe.xdel(stream, *entry_ids)
+        await pipe.execute()
+        self.processed += len(events)
+        self.dead_lettered += len(dead)
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "owner": self.owner,
+            "owned_streams": sorted(self.owned),
+            "processed": self.processed,
+            "dead_lettered": self.dead_lettered,
+        }
+
+
+# Global consumer instance
+redis_streams_consumer: Optional[RedisStreamsEventConsumer] = None
+
+async def init_redis_streams_consumer(client: redis.Redis):
+    """Initialize Redis Streams consumer"""
+    global redis_streams_consumer
+
+    try:
+        redis_streams_consumer = RedisStreamsEventConsumer(client)
+        await redis_streams_consumer.start()
+        logger.info("Redis Streams consumer initialized successfully")
+    except Exception as e:
+        logger.error(f"Failed to initialize Redis Streams consumer: {e}")
+        redis_streams_consumer = None
+
+async def close_redis_streams_consumer():
+    """Close Redis Streams consumer"""
+    global redis_streams_consumer
+
+    if redis_streams_consumer:
+        try:
+            await redis_streams_consumer.stop()
+            logger.info("Redis Streams consumer closed successfully")
+        except Exception as e:
+            logger.error(f"Error closing Redis Streams consumer: {e}")
+        finally:
+            redis_streams_consumer = None
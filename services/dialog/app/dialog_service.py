@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import List
+from typing import List, Optional
 from packages.common.models import DialogMessageResponse
 from .outbox import add_outbox_event, ensure_outbox_table
+from .group_commit import dialog_group_commit, GROUP_COMMIT_ENABLED
+from .read_markers import advance_read_marker, ensure_read_markers_table
+from packages.common.database import Durability, get_master_session
 import uuid
 from datetime import datetime
 
@@ -11,7 +14,7 @@ from datetime import datetime
 class DialogService:
     """
     Универсальный сервис для работы с диалогами.
-    Автоматически выбирает между PostgreSQL и Redis в зависимости от конфигурации.
+    Автоматически выбирает между PostgreSQL, Redis и Redis Streams в зависимости от конфигурации.
     """
     
     def __init__(self):
@@ -26,8 +29,11 @@ class DialogService:
         # ensure outbox table exists
         try:
             await ensure_outbox_table()
-        except Exception:
-            pass
+        except Exception as e:
+            # Без outbox PostgreSQL-бэкенд не может сохранять сообщения: недоделанную миграцию не скрываем
+            if config.is_postgresql_backend():
+                raise
+            print(f"❌ Не удалось подготовить таблицу outbox: {e}")
         
         if config.is_redis_backend():
             from services.dialog.app.redis_adapter import init_redis_adapter
@@ -35,16 +41,32 @@ class DialogService:
             print(f"🔍 Отладка dialog_service: config.get_redis_url() = {redis_url}")
             await init_redis_adapter(redis_url)
             print(f"🔴 Диалоги: используется Redis ({redis_url})")
+        elif config.is_redis_streams_backend():
+            from services.dialog.app.redis_stream_adapter import init_redis_stream_adapter
+            redis_url = config.get_redis_url()
+            await init_redis_stream_adapter(redis_url)
+            print(f"🔴 Диалоги: используются Redis Streams ({redis_url})")
         else:
             print("🐘 Диалоги: используется PostgreSQL")
+            try:
+                await ensure_read_markers_table()
+            except Exception:
+                pass
+            if GROUP_COMMIT_ENABLED:
+                await dialog_group_commit.start()
     
     async def close(self):
         """Закрытие соединений"""
-        from config import Config
+        # Дописываем накопленную пачку сообщений до закрытия соединений
+        await dialog_group_commit.stop()
+        from packages.common.config import Config
         config = Config()
         if config.is_redis_backend():
             from services.dialog.app.redis_adapter import close_redis_adapter
             await close_redis_adapter()
+        elif config.is_redis_streams_backend():
+            from services.dialog.app.redis_stream_adapter import close_redis_stream_adapter
+            await close_redis_stream_adapter()
     
     async def save_dialog_message(self, from_user_id: str, to_user_id: str, text: str) -> str:
         """
@@ -62,43 +84,80 @@ class DialogService:
         config = Config()
         if config.is_redis_backend():
             from services.dialog.app.redis_adapter import redis_dialog_adapter
-            message_id = await redis_dialog_adapter.save_dialog_message(from_user_id, to_user_id, text)
-            # add outbox event
-            await add_outbox_event('MessageSent', {
-                'event_id': str(uuid.uuid4()),
-                'from_user_id': from_user_id,
-                'to_user_id': to_user_id,
-                'message_id': message_id
-            })
-            return message_id
+            message_id = str(uuid.uuid4())
+            # Сообщение и событие outbox попадают в Redis одной MULTI/EXEC
+            return await redis_dialog_adapter.save_dialog_message(
+                from_user_id, to_user_id, text,
+                message_id=message_id,
+                outbox_event=('MessageSent', {
+                    'event_id': str(uuid.uuid4()),
+                    'from_user_id': from_user_id,
+                    'to_user_id': to_user_id,
+                    'message_id': message_id
+                })
+            )
+        elif config.is_redis_streams_backend():
+            from services.dialog.app.redis_stream_adapter import redis_stream_dialog_adapter
+            # ID сообщения назначает XADD; скрипт дописывает его в payload события
+            return await redis_stream_dialog_adapter.save_dialog_message(
+                from_user_id, to_user_id, text,
+                outbox_event=('MessageSent', {
+                    'event_id': str(uuid.uuid4()),
+                    'from_user_id': from_user_id,
+                    'to_user_id': to_user_id
+                })
+            )
+        elif dialog_group_commit.running:
+            # Сообщение и его событие outbox записываются одной транзакцией вместе с попутчиками
+            return await dialog_group_commit.submit(from_user_id, to_user_id, text)
         else:
             from packages.common.db import save_dialog_message
-            message_id = await save_dialog_message(from_user_id, to_user_id, text)
-            await add_outbox_event('MessageSent', {
-                'event_id': str(uuid.uuid4()),
-                'from_user_id': from_user_id,
-                'to_user_id': to_user_id,
-                'message_id': message_id
-            })
+            # Сообщение и событие outbox - одна транзакция и один коммит
+            async with get_master_session(Durability.LOCAL) as session:
+                message_id = await save_dialog_message(from_user_id, to_user_id, text, session=session)
+                await add_outbox_event('MessageSent', {
+                    'event_id': str(uuid.uuid4()),
+                    'from_user_id': from_user_id,
+                    'to_user_id': to_user_id,
+                    'message_id': message_id
+                }, session=session)
+                await session.commit()
             return message_id
     
-    async def get_dialog_messages(self, user_id1: str, user_id2: str) -> List[DialogMessageResponse]:
+    async def get_dialog_messages(self, user_id1: str, user_id2: str,
+                                  after_id: Optional[str] = None, before_id: Optional[str] = None,
+                                  limit: Optional[int] = None) -> List[DialogMessageResponse]:
         """
         Получение сообщений диалога
         
         Args:
             user_id1: ID первого пользователя
             user_id2: ID второго пользователя
+            after_id: Курсор - сообщения после этого ID (только Redis Streams)
+            before_id: Курсор - последние сообщения до этого ID (только Redis Streams)
+            limit: Количество сообщений (по умолчанию DIALOG_MESSAGES_LIMIT)
             
         Returns:
             Список сообщений диалога
         """
         from packages.common.config import Config
         config = Config()
+        limit = limit or config.DIALOG_MESSAGES_LIMIT
+        if config.is_redis_streams_backend():
+            from services.dialog.app.redis_stream_adapter import redis_stream_dialog_adapter
+            if after_id:
+                return await redis_stream_dialog_adapter.get_dialog_messages(
+                    user_id1, user_id2, limit=limit, after_id=after_id
+                )
+            return await redis_stream_dialog_adapter.get_recent_dialog_messages(
+                user_id1, user_id2, limit=limit, before_id=before_id
+            )
+        if after_id or before_id:
+            raise ValueError("Курсорная пагинация поддерживается только бэкендом redis_streams")
         if config.is_redis_backend():
             from services.dialog.app.redis_adapter import redis_dialog_adapter
             return await redis_dialog_adapter.get_dialog_messages(
-                user_id1, user_id2, limit=config.DIALOG_MESSAGES_LIMIT
+                user_id1, user_id2, limit=limit
             )
         else:
             from packages.common.db import get_dialog_messages
@@ -112,6 +171,7 @@ class DialogService:
             for msg in messages:
                 response_messages.append(
                     DialogMessageResponse(
+                        id=str(msg.id),
                         from_user_id=str(msg.from_user_id),
                         to_user_id=str(msg.to_user_id),
                         text=msg.text,
@@ -120,20 +180,36 @@ class DialogService:
                 )
             
             # Ограничиваем количество сообщений
-            return response_messages[-config.DIALOG_MESSAGES_LIMIT:]
+            return response_messages[-limit:]
 
     async def mark_read(self, user_id: str, peer_user_id: str, up_to_created_at: datetime) -> str:
-        """Фиксируем факт прочтения сообщений до указанного времени и публикуем событие."""
-        # В реальном сервисе здесь должна быть фиксация маркера прочтения в БД/Redis.
-        # Для MVP формируем событие с оценочным delta=0 (пересчетом займется Counter Service через сверку/будущий апгрейд).
+        """
+        Фиксируем маркер прочтения сообщений собеседника до указанного времени и публикуем событие.
+        
+        Маркер хранится в хранилище диалогов, поэтому событие MessagesRead несет точное
+        число прочитанных сообщений (delta): счетчик в Counter Service верен сразу, без сверки.
+        Маркер, событие и подсчет delta фиксируются атомарно.
+        """
+        from packages.common.config import Config
+        config = Config()
         event_id = str(uuid.uuid4())
-        await add_outbox_event('MessagesRead', {
+        payload = {
             'event_id': event_id,
             'user_id': user_id,
             'peer_user_id': peer_user_id,
-            'delta': 0,
             'last_read_ts': up_to_created_at.timestamp()
-        })
+        }
+        if config.is_redis_backend():
+            from services.dialog.app.redis_adapter import redis_dialog_adapter
+            await redis_dialog_adapter.mark_read(user_id, peer_user_id, payload['last_read_ts'], payload)
+        elif config.is_redis_streams_backend():
+            from services.dialog.app.redis_stream_adapter import redis_stream_dialog_adapter
+            await redis_stream_dialog_adapter.mark_read(user_id, peer_user_id, payload['last_read_ts'], payload)
+        else:
+            async with get_master_session(Durability.LOCAL) as session:
+                delta, _ = await advance_read_marker(session, user_id, peer_user_id, up_to_created_at)
+                await add_outbox_event('MessagesRead', {**payload, 'delta': delta}, session=session)
+                await session.commit()
         return event_id
     
     async def get_dialog_stats(self) -> dict:
@@ -150,13 +226,19 @@ class DialogService:
             stats = await redis_dialog_adapter.get_dialog_stats()
             stats["backend"] = "Redis"
             return stats
+        elif config.is_redis_streams_backend():
+            from services.dialog.app.redis_stream_adapter import redis_stream_dialog_adapter
+            stats = await redis_stream_dialog_adapter.get_dialog_stats()
+            stats["backend"] = "Redis Streams"
+            return stats
         else:
             # Для PostgreSQL можно добавить аналогичную статистику
             return {
                 "backend": "PostgreSQL",
                 "total_dialogs": "N/A",
                 "total_messages": "N/A",
-                "avg_messages_per_dialog": "N/A"
+                "avg_messages_per_dialog": "N/A",
+                "group_commit": dialog_group_commit.get_stats()
             }
 
 
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+
+from packages.common.database import Durability, get_master_session
+from packages.common.models import DialogMessage
+from .outbox import build_outbox_row, insert_outbox_rows
+
+logger = logging.getLogger(__name__)
+
+
+GROUP_COMMIT_ENABLED = os.getenv("DIALOG_GROUP_COMMIT_ENABLED", "true").lower() == "true"
+# Сколько ждать попутчиков после первого сообщения в пачке
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("DIALOG_GROUP_COMMIT_WINDOW_MS", "5"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("DIALOG_GROUP_COMMIT_MAX_BATCH", "500"))
+
+
+class _PendingMessage:
+    __slots__ = ("row", "outbox_row", "future")
+
+    def __init__(self, row: dict, outbox_row: dict, future: asyncio.Future):
+        self.row = row
+        self.outbox_row = outbox_row
+        self.future = future
+
+
+class GroupCommitWriter:
+    """
+    Групповая фиксация сообщений диалогов (PostgreSQL-бэкенд).
+
+    Конкурентные отправки копятся в очереди в течение окна в несколько миллисекунд
+    (или до max_batch сообщений) и записываются одной транзакцией: multi-row INSERT
+    в dialog_messages и multi-row INSERT событий MessageSent в outbox_messages.
+    Вызывающий ждет future, который получает ID сообщения после коммита пачки.
+    Пока идет запись одной пачки, следующая набирается в очереди.
+    Если пачку отклонили из-за данных одного сообщения (например, FK на
+    to_user_id), она делится пополам и записывается по частям: ошибку
+    получает только отправитель плохого сообщения.
+    """
+
+    def __init__(self, window_ms: float = GROUP_COMMIT_WINDOW_MS, max_batch: int = GROUP_COMMIT_MAX_BATCH):
+        self.window_sec = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.messages = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Dialog group commit started (window={self.window_sec * 1000:.1f}ms, max_batch={self.max_batch})")
+
+    async def stop(self):
+        if not self.running:
+            return
+        # Маркер остановки встает в очередь после уже принятых сообщений: они будут записаны
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        self._task = None
+        logger.info("Dialog group commit stopped")
+
+    async def submit(self, from_user_id: str, to_user_id: str, text: str) -> str:
+        """
+        Поставить сообщение в ближайшую пачку и дождаться ее коммита
+
+        Returns:
+            ID сохраненного сообщения
+        """
+        message_id = str(uuid.uuid4())
+        row = {
+            "id": message_id,
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "text": text,
+            "created_at": datetime.utcnow(),
+        }
+        outbox_row = build_outbox_row('MessageSent', {
+            'event_id': str(uuid.uuid4()),
+            'from_user_id': from_user_id,
+            'to_user_id': to_user_id,
+            'message_id': message_id
+        })
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_PendingMessage(row, outbox_row, future))
+        return await future
+
+    async def _collect(self) -> Tuple[List[_PendingMessage], bool]:
+        """Набрать пачку; второй элемент - получен ли маркер остановки"""
+        first = await self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window_sec
+        while len(batch) < self.max_batch:
+            # Сначала забираем все, что уже лежит в очереди, без ожидания
+            if not self._queue.empty():
+                item = self._queue.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: List[_PendingMessage]):
+        try:
+            async with get_master_session(Durability.LOCAL) as session:
+                await session.execute(insert(DialogMessage.__table__).values([item.row for item in batch]))
+                await insert_outbox_rows(session, [item.outbox_row for item in batch])
+                await session.commit()
+        except (IntegrityError, DataError) as e:
+            if len(batch) > 1:
+                # Ошибка в данных одного из сообщений: ищем его делением пачки пополам
+                middle = len(batch) // 2
+                await self._flush(batch[:middle])
+                await self._flush(batch[middle:])
+                return
+            self._fail(batch, e)
+            return
+        except Exception as e:
+            # Ошибка соединения или базы касается всей пачки: повторять по частям бессмысленно
+            self._fail(batch, e)
+            return
+        self.batches += 1
+        self.messages += len(batch)
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(item.row["id"])
+
+    def _fail(self, batch: List[_PendingMessage], error: Exception):
+        logger.error(f"Dialog group commit of {len(batch)} messages failed: {error}")
+        for item in batch:
+            if not item.future.done():
+                item.future.set_exception(error)
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.running,
+            "window_ms": self.window_sec * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": round(self.messages / self.batches, 2) if self.batches else 0,
+        }
+
+
+dialog_group_commit = GroupCommitWriter()
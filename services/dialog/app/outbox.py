@@ -1,64 +1,470 @@
+import logging
+import os
 import uuid
-from datetime import datetime
-from typing import Any, Dict
+import zlib
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
 from sqlalchemy import text
 from packages.common.db import get_master_session
+from packages.common.database import Durability
 
+logger = logging.getLogger(__name__)
+
+
+# Логические шарды outbox: события одного диалога всегда попадают в один шард,
+# а шард в каждый момент разбирает только один воркер релея - так сохраняется порядок
+OUTBOX_SHARDS = int(os.getenv("OUTBOX_SHARDS", "64"))
+# Пространство ключей advisory-блокировок шардов outbox
+OUTBOX_LOCK_NAMESPACE = 7301
+# Канал LISTEN/NOTIFY: payload - номер шарда, в который добавлено событие
+OUTBOX_NOTIFY_CHANNEL = "outbox_events"
+
+# Таблица секционирована по дням (created_at, UTC): завершенные события удаляются
+# целыми секциями (DETACH + DROP), без построчного DELETE
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "3"))
+OUTBOX_PRECREATE_DAYS = int(os.getenv("OUTBOX_PRECREATE_DAYS", "3"))
+PARTITION_PREFIX = "outbox_messages_p"
+# Секция для строк, чья дневная секция еще не создана (обслуживание отстало):
+# запись в outbox не падает, строки переносятся в дневную секцию при ее создании
+DEFAULT_PARTITION = "outbox_messages_default"
+# Несекционированная таблица после миграции остается под этим именем
+LEGACY_TABLE = "outbox_messages_legacy"
+# Ключи advisory-блокировок обслуживания секций и миграции (вне диапазона шардов)
+MAINTENANCE_LOCK_KEY = -1
+MIGRATION_LOCK_KEY = -2
 
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS outbox_messages (
-  id UUID PRIMARY KEY,
+  id UUID NOT NULL,
   event_type TEXT NOT NULL,
   payload JSONB NOT NULL,
   status TEXT NOT NULL DEFAULT 'pending',
   created_at TIMESTAMP NOT NULL,
-  last_error TEXT
-);
+  last_error TEXT,
+  shard SMALLINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
 """
 
+# Частичный индекс содержит только неотправленные события и остается маленьким
+CREATE_PENDING_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox_messages (shard, created_at) WHERE status = 'pending'"
+)
+
+CREATE_DEFAULT_PARTITION_SQL = (
+    f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF outbox_messages DEFAULT"
+)
+
+TABLE_KIND_SQL = "SELECT relkind FROM pg_class WHERE oid = to_regclass('outbox_messages')"
+
+LIST_PARTITIONS_SQL = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'outbox_messages'::regclass
+ORDER BY c.relname
+"""
 
-async def ensure_outbox_table():
-    async with get_master_session() as session:
-        await session.execute(text(CREATE_TABLE_SQL))
-        await session.commit()
 
+def _partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
 
-async def add_outbox_event(event_type: str, payload: Dict[str, Any]) -> str:
-    """Add event to outbox within existing transaction boundary (separate call for simplicity)."""
-    event_id = str(uuid.uuid4())
-    now = datetime.utcnow()
+
+def _partition_day(name: str) -> Optional[date]:
+    try:
+        return datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+async def _create_partition(session, day: date):
+    """
+    Create the partition of one day. Rows of that day that landed in the
+    DEFAULT partition are moved into it before it is attached.
+    """
+    name = _partition_name(day)
+    res = await session.execute(text("SELECT to_regclass(:name)"), {"name": name})
+    if res.scalar_one_or_none() is not None:
+        return
+    low, high = day.isoformat(), (day + timedelta(days=1)).isoformat()
+    await session.execute(text(f"CREATE TABLE {name} (LIKE outbox_messages INCLUDING DEFAULTS)"))
+    await session.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+            WHERE created_at >= '{low}' AND created_at < '{high}'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """))
+    await session.execute(text(
+        f"ALTER TABLE outbox_messages ATTACH PARTITION {name} FOR VALUES FROM ('{low}') TO ('{high}')"
+    ))
+
+
+async def _migrate_legacy_table(session):
+    """
+    Заменить несекционированную таблицу outbox_messages секционированной.
+    Переносятся незавершенные события (pending/error); таблица с историей 'done'
+    остается как outbox_messages_legacy и удаляется вручную.
+    """
+    await session.execute(text(f"ALTER TABLE outbox_messages RENAME TO {LEGACY_TABLE}"))
+    # Имена индексов общие для схемы: освобождаем их для новой таблицы
+    await session.execute(text("ALTER INDEX IF EXISTS outbox_messages_pkey RENAME TO outbox_messages_legacy_pkey"))
+    await session.execute(text("ALTER INDEX IF EXISTS idx_outbox_pending RENAME TO idx_outbox_pending_legacy"))
+    await session.execute(text(CREATE_TABLE_SQL))
+    await session.execute(text(CREATE_DEFAULT_PARTITION_SQL))
+    res = await session.execute(text(
+        f"SELECT DISTINCT CAST(created_at AS DATE) FROM {LEGACY_TABLE} WHERE status <> 'done'"
+    ))
+    for (day,) in res.fetchall():
+        await _create_partition(session, day)
+    await session.execute(text(f"""
+        INSERT INTO outbox_messages(id, event_type, payload, status, created_at, last_error, shard)
+        SELECT id, event_type, payload, status, created_at, last_error,
+               COALESCE(CAST(to_jsonb(l) ->> 'shard' AS SMALLINT), 0)
+        FROM {LEGACY_TABLE} l
+        WHERE status <> 'done'
+    """))
+    logger.warning(f"Outbox migrated to a partitioned table; the old rows are kept in {LEGACY_TABLE}")
+
+
+async def ensure_outbox_table():
     async with get_master_session() as session:
+        # Реплики стартуют одновременно: миграцию выполняет одна, остальные ждут
+        # блокировку и уже видят секционированную таблицу
         await session.execute(
-            text("""
-            INSERT INTO outbox_messages(id, event_type, payload, status, created_at)
-            VALUES (:id, :event_type, CAST(:payload AS JSONB), 'pending', :created_at)
-            """),
-            {"id": event_id, "event_type": event_type, "payload": json_dumps(payload), "created_at": now}
+            text("SELECT pg_advisory_xact_lock(:ns, :key)"),
+            {"ns": OUTBOX_LOCK_NAMESPACE, "key": MIGRATION_LOCK_KEY}
         )
+        res = await session.execute(text(TABLE_KIND_SQL))
+        kind = res.scalar_one_or_none()
+        if kind == "r":
+            await _migrate_legacy_table(session)
+        else:
+            await session.execute(text(CREATE_TABLE_SQL))
+            await session.execute(text(CREATE_DEFAULT_PARTITION_SQL))
+        await session.execute(text(CREATE_PENDING_INDEX_SQL))
         await session.commit()
-    return event_id
+    await maintain_outbox_partitions()
 
 
-async def fetch_pending_events(limit: int = 100):
-    async with get_master_session() as session:
-        res = await session.execute(text("SELECT id, event_type, payload FROM outbox_messages WHERE status='pending' ORDER BY created_at LIMIT :lim"), {"lim": limit})
-        return res.fetchall()
+async def _try_maintenance_lock(session) -> bool:
+    res = await session.execute(
+        text("SELECT pg_try_advisory_xact_lock(:ns, :key)"),
+        {"ns": OUTBOX_LOCK_NAMESPACE, "key": MAINTENANCE_LOCK_KEY}
+    )
+    return bool(res.scalar_one())
+
+
+async def maintain_outbox_partitions() -> Dict[str, List[str]]:
+    """
+    Create partitions for the coming days and drop partitions older than the
+    retention window. Rows that landed in the DEFAULT partition are moved
+    into partitions of their days. A partition still holding pending or
+    error events is kept.
 
+    Returns:
+        Names of created and dropped partitions
+    """
+    created: List[str] = []
+    dropped: List[str] = []
+    today = datetime.utcnow().date()
 
-async def mark_event_done(event_id: str):
     async with get_master_session() as session:
-        await session.execute(text("UPDATE outbox_messages SET status='done' WHERE id=:id"), {"id": event_id})
+        if not await _try_maintenance_lock(session):
+            # Обслуживанием уже занимается другой процесс
+            return {"created": created, "dropped": dropped}
+        res = await session.execute(text(LIST_PARTITIONS_SQL))
+        existing = [row[0] for row in res.fetchall() if row[0] != DEFAULT_PARTITION]
+        days = {today + timedelta(days=offset) for offset in range(OUTBOX_PRECREATE_DAYS + 1)}
+        res = await session.execute(text(f"SELECT DISTINCT CAST(created_at AS DATE) FROM {DEFAULT_PARTITION}"))
+        days.update(row[0] for row in res.fetchall())
+        for day in sorted(days):
+            if _partition_name(day) not in existing:
+                await _create_partition(session, day)
+                created.append(_partition_name(day))
+                existing.append(_partition_name(day))
         await session.commit()
 
+    cutoff = today - timedelta(days=OUTBOX_RETENTION_DAYS)
+    expired = [name for name in existing if (_partition_day(name) or cutoff) < cutoff]
+    if not expired:
+        return {"created": created, "dropped": dropped}
 
-async def mark_event_error(event_id: str, error: str):
+    # Отдельная транзакция: неудачный DETACH не должен откатить создание будущих секций
     async with get_master_session() as session:
-        await session.execute(text("UPDATE outbox_messages SET status='error', last_error=:err WHERE id=:id"), {"id": event_id, "err": error[:1000]})
+        if not await _try_maintenance_lock(session):
+            return {"created": created, "dropped": dropped}
+        # DETACH берет эксклюзивную блокировку родителя: не ждем ее долго за длинными транзакциями
+        await session.execute(text("SET LOCAL lock_timeout = '2s'"))
+        for name in expired:
+            # Строки 'error' видны в /internal/outbox/stats: секцию с ними не удаляем
+            res = await session.execute(
+                text(f"SELECT 1 FROM {name} WHERE status IN ('pending', 'error') LIMIT 1")
+            )
+            if res.scalar_one_or_none():
+                logger.warning(f"Outbox partition {name} still has pending or error events, keeping it")
+                continue
+            await session.execute(text(f"ALTER TABLE outbox_messages DETACH PARTITION {name}"))
+            await session.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
         await session.commit()
 
+    if created or dropped:
+        logger.info(f"Outbox partitions maintained: created={created}, dropped={dropped}")
+    return {"created": created, "dropped": dropped}
+
+
+async def get_outbox_stats() -> Dict[str, Any]:
+    """Backlog size, oldest pending event age and partition sizes."""
+    async with get_master_session() as session:
+        res = await session.execute(text("""
+            SELECT count(*), EXTRACT(EPOCH FROM (now() AT TIME ZONE 'utc') - min(created_at))
+            FROM outbox_messages WHERE status = 'pending'
+        """))
+        pending, oldest_age = res.one()
+        res = await session.execute(text("SELECT count(*) FROM outbox_messages WHERE status = 'error'"))
+        errors = res.scalar_one()
+        res = await session.execute(text("""
+            SELECT c.relname, c.reltuples::BIGINT
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'outbox_messages'::regclass
+            ORDER BY c.relname
+        """))
+        partitions = [{"name": name, "estimated_rows": max(int(rows), 0)} for name, rows in res.fetchall()]
+    return {
+        "pending": int(pending),
+        "oldest_pending_age_sec": float(oldest_age) if oldest_age is not None else 0.0,
+        "errors": int(errors),
+        "retention_days": OUTBOX_RETENTION_DAYS,
+        "partitions": partitions,
+    }
+
+
+def event_dialog(payload: Dict[str, Any]) -> str:
+    """Dialog (unordered pair of users) an event belongs to."""
+    first = payload.get("from_user_id") or payload.get("user_id") or ""
+    second = payload.get("to_user_id") or payload.get("peer_user_id") or ""
+    return ":".join(sorted([str(first), str(second)]))
+
+
+def outbox_shard(payload: Dict[str, Any]) -> int:
+    """Shard of an event: derived from the dialog it belongs to."""
+    return zlib.crc32(event_dialog(payload).encode()) % OUTBOX_SHARDS
+
+
+def build_outbox_row(event_type: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Row of outbox_messages for batch inserts (see insert_outbox_rows)."""
+    return {
+        "id": str(uuid.uuid4()),
+        "event_type": event_type,
+        "payload": json_dumps(payload),
+        "created_at": datetime.utcnow(),
+        "shard": outbox_shard(payload),
+    }
+
+
+async def notify_outbox(session, shards):
+    """
+    Wake the relay workers owning the shards. NOTIFY is transactional:
+    it is delivered on commit and dropped on rollback.
+    """
+    await session.execute(
+        text("SELECT pg_notify(:channel, s) FROM unnest(CAST(:shards AS TEXT[])) AS s"),
+        {"channel": OUTBOX_NOTIFY_CHANNEL, "shards": [str(shard) for shard in sorted(set(shards))]}
+    )
+
+
+async def insert_outbox_rows(session, rows: List[Dict[str, Any]]):
+    """Insert outbox rows with one multi-row INSERT in the caller's transaction."""
+    if not rows:
+        return
+    values = []
+    params: Dict[str, Any] = {}
+    for i, row in enumerate(rows):
+        values.append(f"(:id_{i}, :event_type_{i}, CAST(:payload_{i} AS JSONB), 'pending', :created_at_{i}, :shard_{i})")
+        for key, value in row.items():
+            params[f"{key}_{i}"] = value
+    await session.execute(
+        text(
+            "INSERT INTO outbox_messages(id, event_type, payload, status, created_at, shard) VALUES "
+            + ", ".join(values)
+        ),
+        params
+    )
+    await notify_outbox(session, [row["shard"] for row in rows])
+
+
+INSERT_EVENT_SQL = """
+INSERT INTO outbox_messages(id, event_type, payload, status, created_at, shard)
+VALUES (:id, :event_type, CAST(:payload AS JSONB), 'pending', :created_at, :shard)
+"""
+
+
+async def add_outbox_event(event_type: str, payload: Dict[str, Any], session=None) -> str:
+    """
+    Add event to outbox.
+
+    With a session the row joins the caller's transaction and is committed
+    together with the business write; without one the event is committed
+    in its own transaction.
+    """
+    row = build_outbox_row(event_type, payload)
+    if session is not None:
+        await session.execute(text(INSERT_EVENT_SQL), row)
+        await notify_outbox(session, [row["shard"]])
+        return row["id"]
+    # Событие не должно пропасть после подтверждения вызывающему: ждем сброса WAL
+    # на мастере, но не реплик - их догонит сверка
+    async with get_master_session(Durability.LOCAL) as own_session:
+        await own_session.execute(text(INSERT_EVENT_SQL), row)
+        await notify_outbox(own_session, [row["shard"]])
+        await own_session.commit()
+    return row["id"]
+
+
+# Шарды, которые в этой транзакции удалось захватить (остальные сейчас разбирает другой релей)
+LOCK_SHARDS_SQL = """
+SELECT s FROM unnest(CAST(:shards AS INT[])) AS s
+WHERE pg_try_advisory_xact_lock(:ns, s)
+"""
+
+CLAIM_EVENTS_SQL = """
+SELECT id, event_type, payload
+FROM outbox_messages
+WHERE status = 'pending' AND shard = ANY(:shards)
+ORDER BY created_at
+LIMIT :lim
+FOR UPDATE SKIP LOCKED
+"""
+
+
+async def claim_pending_events(session, shards: List[int], limit: int = 100):
+    """
+    Claim a batch of pending events of the given shards in the caller's transaction.
+
+    Row locks (SKIP LOCKED) and per-shard advisory locks are held until the
+    caller commits, so concurrent relays never publish the same event and
+    events of one dialog are never published out of order.
+    """
+    res = await session.execute(text(LOCK_SHARDS_SQL), {"shards": shards, "ns": OUTBOX_LOCK_NAMESPACE})
+    locked = [row[0] for row in res.fetchall()]
+    if not locked:
+        return []
+    res = await session.execute(text(CLAIM_EVENTS_SQL), {"shards": locked, "lim": limit})
+    return res.fetchall()
+
+
+async def mark_events_done(session, event_ids: List[str]):
+    if event_ids:
+        await session.execute(
+            text("UPDATE outbox_messages SET status='done' WHERE id = ANY(CAST(:ids AS UUID[]))"),
+            {"ids": [str(event_id) for event_id in event_ids]}
+        )
+
+
+async def mark_event_error(session, event_id: str, error: str):
+    await session.execute(text("UPDATE outbox_messages SET status='error', last_error=:err WHERE id=:id"), {"id": event_id, "err": error[:1000]})
+
 
 def json_dumps(obj: Dict[str, Any]) -> str:
     import json
     return json.dumps(obj)
 
 
+# Redis-бэкенд диалогов: события outbox пишутся в поток в той же MULTI/EXEC, что и сообщение
+REDIS_OUTBOX_STREAM = "outbox:events"
+REDIS_OUTBOX_DEAD_STREAM = "outbox:events:dead"
+REDIS_OUTBOX_GROUP = "outbox-relay"
+# Поток outbox не обрезается по длине: неотправленное событие не должно пропасть,
+# подтвержденные записи релей удаляет сам (XDEL). Обрезается только dead-letter поток.
+REDIS_OUTBOX_DEAD_MAXLEN = 1000000
+# Запись без подтверждения дольше этого времени забирается у пропавшего релея
+REDIS_OUTBOX_CLAIM_IDLE_MS = int(os.getenv("REDIS_OUTBOX_CLAIM_IDLE_MS", "60000"))
+
+
+def redis_outbox_fields(event_type: str, payload: Dict[str, Any]) -> Dict[str, str]:
+    """Fields of a Redis outbox stream entry (XADD in the caller's MULTI)."""
+    return {
+        "event_type": event_type,
+        "payload": json_dumps(payload),
+        "created_at": datetime.utcnow().isoformat(),
+    }
+
+
+async def ensure_redis_outbox_group(client):
+    try:
+        await client.xgroup_create(REDIS_OUTBOX_STREAM, REDIS_OUTBOX_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        # BUSYGROUP: группа уже создана
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def fetch_pending_redis_events(client, consumer: str, limit: int = 100):
+    """
+    Read Redis outbox entries for the relay: first ones delivered earlier
+    but not acknowledged (relay restart), then new ones.
+
+    Returns:
+        List of (entry_id, event_type, payload)
+    """
+    events = []
+    for start_id in ("0", ">"):
+        response = await client.xreadgroup(
+            REDIS_OUTBOX_GROUP, consumer, {REDIS_OUTBOX_STREAM: start_id}, count=limit
+        )
+        for _stream, entries in response or []:
+            events.extend(_redis_event(entry_id, fields) for entry_id, fields in entries)
+        if events:
+            break
+    return events
+
+
+async def claim_idle_redis_events(client, consumer: str, limit: int = 100):
+    """
+    Take over entries delivered to another relay and not acknowledged for
+    REDIS_OUTBOX_CLAIM_IDLE_MS (a relay that died or came back under a new
+    hostname never reads its old pending entries again).
+
+    Returns:
+        List of (entry_id, event_type, payload)
+    """
+    reply = await client.xautoclaim(
+        REDIS_OUTBOX_STREAM, REDIS_OUTBOX_GROUP, consumer,
+        min_idle_time=REDIS_OUTBOX_CLAIM_IDLE_MS, start_id="0-0", count=limit
+    )
+    return [_redis_event(entry_id, fields) for entry_id, fields in reply[1]]
+
+
+def _redis_event(entry_id, fields):
+    # Запись удалена из потока, пока была неподтвержденной: XREADGROUP отдает ее без полей
+    if not fields:
+        return _decode(entry_id), None, None
+    fields = {_decode(k): _decode(v) for k, v in fields.items()}
+    return _decode(entry_id), fields.get("event_type"), fields.get("payload")
+
+
+async def ack_redis_events(client, entry_ids: List[str]):
+    if not entry_ids:
+        return
+    pipe = client.pipeline(transaction=False)
+    pipe.xack(REDIS_OUTBOX_STREAM, REDIS_OUTBOX_GROUP, *entry_ids)
+    pipe.xdel(REDIS_OUTBOX_STREAM, *entry_ids)
+    await pipe.execute()
+
+
+async def dead_letter_redis_event(client, entry_id: str, event_type: str, payload: str, error: str):
+    """Move an entry that failed to publish out of the stream, like status='error' in PostgreSQL."""
+    await client.xadd(
+        REDIS_OUTBOX_DEAD_STREAM,
+        {"entry_id": entry_id, "event_type": event_type or "", "payload": payload or "", "last_error": error[:1000]},
+        maxlen=REDIS_OUTBOX_DEAD_MAXLEN,
+        approximate=True,
+    )
+    await ack_redis_events(client, [entry_id])
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
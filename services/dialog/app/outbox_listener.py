@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+
+import asyncpg
+
+from packages.common.database import DB_HOST, DB_NAME, DB_PASSWORD, DB_PORT, DB_USER
+from .outbox import OUTBOX_NOTIFY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_LISTEN_RECONNECT_SEC = float(os.getenv("OUTBOX_LISTEN_RECONNECT_SEC", "2"))
+
+
+class OutboxWakeups:
+    """
+    Пробуждение воркеров релея по NOTIFY.
+
+    Держит отдельное соединение asyncpg с LISTEN outbox_events (вне пула
+    SQLAlchemy: соединение из пула могло бы вернуться в пул с активной подпиской).
+    Уведомление содержит номер шарда и будит только воркер-владелец шарда.
+    При разрыве соединения будятся все воркеры: уведомления за время разрыва
+    потеряны, и события надо подобрать опросом.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.events: List[asyncio.Event] = [asyncio.Event() for _ in range(workers)]
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.notifications = 0
+
+    def worker_of(self, shard: int) -> int:
+        return shard % self.workers
+
+    def wake_all(self):
+        for event in self.events:
+            event.set()
+
+    async def wait(self, worker: int, timeout: float):
+        """Ждать уведомления для воркера не дольше timeout (опрос как страховка)"""
+        event = self.events[worker]
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.notifications += 1
+        try:
+            self.events[self.worker_of(int(payload))].set()
+        except (ValueError, TypeError):
+            self.wake_all()
+
+    def _on_termination(self, connection):
+        logger.warning("Outbox LISTEN connection terminated")
+        self.wake_all()
+
+    async def _connect(self):
+        conn = await asyncpg.connect(
+            host=DB_HOST, port=int(DB_PORT), user=DB_USER, password=DB_PASSWORD, database=DB_NAME
+        )
+        conn.add_termination_listener(self._on_termination)
+        await conn.add_listener(OUTBOX_NOTIFY_CHANNEL, self._on_notify)
+        return conn
+
+    async def _run(self):
+        while True:
+            try:
+                self._conn = await self._connect()
+                logger.info(f"Listening for outbox notifications on '{OUTBOX_NOTIFY_CHANNEL}'")
+                # Все, что пришло до подписки, подбираем сразу
+                self.wake_all()
+                while not self._conn.is_closed():
+                    await asyncio.sleep(OUTBOX_LISTEN_RECONNECT_SEC)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox LISTEN connection failed: {e}")
+            finally:
+                await self._close_conn()
+            self.wake_all()
+            await asyncio.sleep(OUTBOX_LISTEN_RECONNECT_SEC)
+
+    async def _close_conn(self):
+        if self._conn is not None and not self._conn.is_closed():
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._task = None
+        await self._close_conn()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "listening": int(self._conn is not None and not self._conn.is_closed()),
+            "notifications": self.notifications,
+        }
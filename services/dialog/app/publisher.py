@@ -3,16 +3,54 @@ import aiohttp
 import asyncio
 import json
 import logging
-from typing import Dict, Any
-from .outbox import fetch_pending_events, mark_event_done, mark_event_error
+import socket
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from packages.common.database import get_master_session
+from .outbox import (
+    OUTBOX_SHARDS, claim_pending_events, mark_events_done, mark_event_error, maintain_outbox_partitions,
+    ensure_redis_outbox_group, fetch_pending_redis_events, claim_idle_redis_events, ack_redis_events,
+    dead_letter_redis_event,
+)
+from .outbox_listener import OutboxWakeups
 from .rabbitmq_publisher import get_rabbitmq_publisher
+from .redis_streams_publisher import RedisStreamsEventPublisher
 
 logger = logging.getLogger(__name__)
 
+# Параллельные воркеры релея; порядок событий сохраняется внутри диалога (шарда)
+OUTBOX_RELAY_WORKERS = int(os.getenv("OUTBOX_RELAY_WORKERS", "4"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+# Воркеры просыпаются по NOTIFY; опрос остается страховкой на случай потерянных уведомлений
+OUTBOX_LISTEN_ENABLED = os.getenv("OUTBOX_LISTEN_ENABLED", "true").lower() == "true"
+OUTBOX_MAINTENANCE_INTERVAL_SEC = int(os.getenv("OUTBOX_MAINTENANCE_INTERVAL_SEC", "3600"))
+OUTBOX_POLL_INTERVAL_SEC = float(os.getenv("OUTBOX_POLL_INTERVAL_SEC", "5" if OUTBOX_LISTEN_ENABLED else "1"))
+# Пул keep-alive соединений к Counter Service
+COUNTER_HTTP_POOL_SIZE = int(os.getenv("COUNTER_HTTP_POOL_SIZE", "20"))
+COUNTER_HTTP_TIMEOUT_SEC = float(os.getenv("COUNTER_HTTP_TIMEOUT_SEC", "10"))
+# Как часто релей забирает записи Redis outbox, зависшие у пропавших релеев
+REDIS_OUTBOX_CLAIM_INTERVAL_SEC = float(os.getenv("REDIS_OUTBOX_CLAIM_INTERVAL_SEC", "30"))
+
 
 class HttpPublisher:
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, pool_size: int = COUNTER_HTTP_POOL_SIZE):
         self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Одна сессия на процесс: соединения переиспользуются между событиями и воркерами
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=COUNTER_HTTP_TIMEOUT_SEC)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def publish(self, event_type: str, payload: Dict[str, Any]) -> None:
         endpoint = None
@@ -23,15 +61,171 @@ class HttpPublisher:
         else:
             raise ValueError(f"Unknown event type: {event_type}")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self.base_url + endpoint, json=payload) as resp:
-                if resp.status >= 400:
-                    txt = await resp.text()
-                    raise RuntimeError(f"Publish failed: {resp.status} {txt}")
+        async with self._get_session().post(self.base_url + endpoint, json=payload) as resp:
+            if resp.status >= 400:
+                txt = await resp.text()
+                raise RuntimeError(f"Publish failed: {resp.status} {txt}")
+
+    async def publish_batch(self, events: List[Tuple[str, Dict[str, Any]]]) -> List[Optional[str]]:
+        """
+        Deliver events with one request to the counter batch endpoint.
+
+        Returns:
+            Error per event (None - delivered). Transport errors are raised
+            so that the whole batch stays pending and is retried.
+        """
+        body = {"events": [{"event_type": event_type, "payload": payload} for event_type, payload in events]}
+        async with self._get_session().post(self.base_url + '/internal/events/batch', json=body) as resp:
+            if resp.status >= 400:
+                txt = await resp.text()
+                raise RuntimeError(f"Batch publish failed: {resp.status} {txt}")
+            data = await resp.json()
+        results = data.get("results", [])
+        if len(results) != len(events):
+            raise RuntimeError(f"Batch publish returned {len(results)} results for {len(events)} events")
+        return [result.get("error") for result in results]
+
+
+async def _publish_batch(events_transport: str, publisher: "HttpPublisher",
+                         events: List[Tuple[str, Dict[str, Any]]]) -> List[Optional[str]]:
+    """Publish events in order; returns error per event (None - published)."""
+    if not events:
+        return []
+    if events_transport != 'rabbitmq':
+        return await publisher.publish_batch(events)
+    rabbitmq_pub = get_rabbitmq_publisher()
+    if not rabbitmq_pub:
+        # Пачка остается pending и будет отправлена, когда RabbitMQ станет доступен
+        raise RuntimeError("RabbitMQ publisher not available")
+    # Строки outbox помечаются done только для событий, подтвержденных брокером
+    return await rabbitmq_pub.publish_batch(events)
+
+
+def _load_payload(payload):
+    if isinstance(payload, str):
+        try:
+            return json.loads(payload)
+        except Exception:
+            pass
+    return payload
+
+
+async def _relay_redis_outbox(client, consumer: str, events_transport: str, publisher: "HttpPublisher",
+                              claim: bool = False) -> int:
+    """
+    Drain the Redis outbox stream written by the Redis dialog backends.
+    With claim=True, take over entries left pending by other relays instead.
+
+    Returns:
+        Number of entries handled
+    """
+    if claim:
+        events = await claim_idle_redis_events(client, consumer, limit=OUTBOX_BATCH_SIZE)
+    else:
+        events = await fetch_pending_redis_events(client, consumer, limit=OUTBOX_BATCH_SIZE)
+    handled = len(events)
+    # Записи без полей уже удалены из потока: публиковать нечего, снимаем их с учета
+    for entry_id, event_type, _ in events:
+        if event_type is None:
+            logger.error(f"Redis outbox entry {entry_id} has no fields, dead-lettering it")
+            await dead_letter_redis_event(client, entry_id, None, None, "Entry was deleted from the stream")
+    events = [event for event in events if event[1] is not None]
+    errors = await _publish_batch(
+        events_transport, publisher,
+        [(event_type, _load_payload(raw_payload)) for _, event_type, raw_payload in events]
+    )
+    done = []
+    for (entry_id, event_type, raw_payload), error in zip(events, errors):
+        if error is None:
+            done.append(entry_id)
+        else:
+            logger.error(f"Failed to publish Redis outbox entry {entry_id}: {error}")
+            await dead_letter_redis_event(client, entry_id, event_type, raw_payload, error)
+    await ack_redis_events(client, done)
+    return handled
+
+
+def _redis_outbox_client():
+    from . import redis_adapter, redis_stream_adapter
+    adapter = redis_adapter.redis_dialog_adapter or redis_stream_adapter.redis_stream_dialog_adapter
+    return adapter.redis_client if adapter else None
+
+
+async def relay_outbox_batch(shards: List[int], events_transport: str, publisher: "HttpPublisher",
+                             limit: int = OUTBOX_BATCH_SIZE) -> int:
+    """
+    Claim and publish one batch of pending events of the given shards.
+
+    Events are published in created_at order inside the claiming transaction;
+    the whole batch is marked done with one UPDATE and a single commit. If the
+    transport fails as a whole, the transaction rolls back and the batch stays
+    pending.
+
+    Returns:
+        Number of claimed events
+    """
+    async with get_master_session() as session:
+        events = await claim_pending_events(session, shards, limit)
+        errors = await _publish_batch(
+            events_transport, publisher,
+            [(row[1], _load_payload(row[2])) for row in events]
+        )
+        done = []
+        for row, error in zip(events, errors):
+            if error is None:
+                done.append(row[0])
+            else:
+                logger.error(f"Failed to publish event {row[0]}: {error}")
+                await mark_event_error(session, row[0], error)
+        
+        await mark_events_done(session, done)
+        await session.commit()
+    return len(events)
+
+
+async def _outbox_worker(worker: int, workers: int, events_transport: str, publisher: "HttpPublisher",
+                         wakeups: OutboxWakeups):
+    # Воркер владеет шардами worker, worker + workers, ... (shard % workers == worker)
+    shards = list(range(worker, OUTBOX_SHARDS, workers))
+    while True:
+        try:
+            claimed = await relay_outbox_batch(shards, events_transport, publisher)
+            # Полная пачка - вероятно, есть еще события: берем следующую сразу
+            if claimed < OUTBOX_BATCH_SIZE:
+                await wakeups.wait(worker, OUTBOX_POLL_INTERVAL_SEC)
+        except Exception as e:
+            logger.error(f"Error in outbox worker {worker}: {e}")
+            await asyncio.sleep(5)  # Wait longer on errors
+
+
+async def _redis_outbox_worker(client, events_transport: str, publisher: "HttpPublisher"):
+    consumer = f"relay-{socket.gethostname()}"
+    await ensure_redis_outbox_group(client)
+    last_claim = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_claim >= REDIS_OUTBOX_CLAIM_INTERVAL_SEC:
+                last_claim = time.monotonic()
+                while await _relay_redis_outbox(client, consumer, events_transport, publisher, claim=True):
+                    pass
+            await _relay_redis_outbox(client, consumer, events_transport, publisher)
+            await asyncio.sleep(1)
+        except Exception as e:
+            logger.error(f"Error in Redis outbox relay: {e}")
+            await asyncio.sleep(5)
+
+
+async def _partition_maintenance_loop():
+    while True:
+        try:
+            await maintain_outbox_partitions()
+        except Exception as e:
+            logger.error(f"Error maintaining outbox partitions: {e}")
+        await asyncio.sleep(OUTBOX_MAINTENANCE_INTERVAL_SEC)
 
 
 async def run_publisher_loop():
-    """Run event publisher loop with support for both HTTP and RabbitMQ"""
+    """Run event publisher loop with support for HTTP, RabbitMQ and Redis Streams"""
     
     # Determine transport type
     events_transport = os.getenv('EVENTS_TRANSPORT', 'http').lower()
@@ -42,47 +236,37 @@ async def run_publisher_loop():
         # Use RabbitMQ publisher
         publisher = None  # Will use RabbitMQ publisher from global instance
         logger.info("Using RabbitMQ for event publishing")
+    elif events_transport == 'redis_streams':
+        # Публикатор с тем же интерфейсом, что у HttpPublisher: XADD пачкой в поток counter Redis
+        publisher = RedisStreamsEventPublisher()
+        logger.info(f"Using Redis Streams for event publishing: {publisher.stream}:0..{publisher.streams - 1}")
     else:
         # Use HTTP publisher (fallback)
         base_url = os.getenv('COUNTER_SERVICE_URL', 'http://counter-service:8003')
         publisher = HttpPublisher(base_url)
         logger.info(f"Using HTTP for event publishing: {base_url}")
     
-    while True:
-        try:
-            events = await fetch_pending_events(limit=100)
-            for row in events:
-                event_id, event_type, payload = row[0], row[1], row[2]
-                if isinstance(payload, str):
-                    try:
-                        payload = json.loads(payload)
-                    except Exception:
-                        pass
-                
-                try:
-                    if events_transport == 'rabbitmq':
-                        # Use RabbitMQ
-                        rabbitmq_pub = get_rabbitmq_publisher()
-                        if rabbitmq_pub:
-                            await rabbitmq_pub.publish_event(event_type, payload)
-                        else:
-                            logger.error("RabbitMQ publisher not available")
-                            raise RuntimeError("RabbitMQ publisher not available")
-                    else:
-                        # Use HTTP
-                        await publisher.publish(event_type, payload)
-                    
-                    await mark_event_done(event_id)
-                    logger.debug(f"Successfully published event {event_id} ({event_type})")
-                    
-                except Exception as e:
-                    logger.error(f"Failed to publish event {event_id}: {e}")
-                    await mark_event_error(event_id, str(e))
-            
-            await asyncio.sleep(1)
-            
-        except Exception as e:
-            logger.error(f"Error in publisher loop: {e}")
-            await asyncio.sleep(5)  # Wait longer on errors
-
-
+    workers = max(1, min(OUTBOX_RELAY_WORKERS, OUTBOX_SHARDS))
+    wakeups = OutboxWakeups(workers)
+    if OUTBOX_LISTEN_ENABLED:
+        wakeups.start()
+    tasks = [
+        asyncio.create_task(_outbox_worker(i, workers, events_transport, publisher, wakeups))
+        for i in range(workers)
+    ]
+    tasks.append(asyncio.create_task(_partition_maintenance_loop()))
+    redis_client = _redis_outbox_client()
+    if redis_client is not None:
+        tasks.append(asyncio.create_task(_redis_outbox_worker(redis_client, events_transport, publisher)))
+        logger.info("Relaying Redis outbox stream as well")
+    logger.info(f"Outbox relay started with {workers} workers over {OUTBOX_SHARDS} shards")
+    
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await wakeups.stop()
+        if publisher is not None:
+            await publisher.close()
@@ -1,105 +1,148 @@
 """
 RabbitMQ Event Publisher for Dialog Service
+
+asyncio-native (aio-pika): a pool of channels with publisher confirms.
+A publish returns only after the broker confirmed the message, so the relay
+marks outbox rows done only for confirmed events. Messages of one batch are
+published concurrently on one channel, so their confirms are pipelined
+instead of waiting for a round trip per message. Optionally several events
+are packed into one "Batch" envelope message.
 """
-import pika
+import asyncio
 import json
 import logging
 import os
-from typing import Dict, Any, Optional
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import aio_pika
 
 logger = logging.getLogger(__name__)
 
+EXCHANGE_NAME = 'counter_events'
+BATCH_EVENT_TYPE = 'Batch'
+
+# Каналы с подтверждениями; публикации разных воркеров релея идут параллельно
+RABBITMQ_PUBLISH_CHANNELS = int(os.getenv("RABBITMQ_PUBLISH_CHANNELS", "4"))
+# Событий в одном сообщении-конверте; 1 - каждое событие отдельным сообщением
+RABBITMQ_ENVELOPE_SIZE = int(os.getenv("RABBITMQ_ENVELOPE_SIZE", "1"))
+RABBITMQ_CONFIRM_TIMEOUT_SEC = float(os.getenv("RABBITMQ_CONFIRM_TIMEOUT_SEC", "10"))
+
+
+def _event_message(event_type: str, event_data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "event_type": event_type,
+        "event_id": event_data.get("event_id"),
+        "timestamp": event_data.get("timestamp"),
+        "data": event_data
+    }
+
+
 class RabbitMQEventPublisher:
-    def __init__(self, rabbitmq_url: str):
+    def __init__(self, rabbitmq_url: str, channels: int = RABBITMQ_PUBLISH_CHANNELS,
+                 envelope_size: int = RABBITMQ_ENVELOPE_SIZE):
         self.rabbitmq_url = rabbitmq_url
-        self.connection: Optional[pika.BlockingConnection] = None
-        self.channel: Optional[pika.channel.Channel] = None
-        self.executor = ThreadPoolExecutor(max_workers=2)
-        
-    def connect(self):
-        """Establish connection to RabbitMQ"""
+        self.channels = max(1, channels)
+        self.envelope_size = max(1, envelope_size)
+        self.connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self._pool: Optional[asyncio.Queue] = None
+
+    async def connect(self):
+        """Establish connection to RabbitMQ and open the channel pool"""
         try:
             logger.info(f"Connecting to RabbitMQ: {self.rabbitmq_url}")
-            
-            # Parse connection parameters
-            params = pika.URLParameters(self.rabbitmq_url)
-            self.connection = pika.BlockingConnection(params)
-            self.channel = self.connection.channel()
-            
-            # Declare exchange for events
-            self.channel.exchange_declare(
-                exchange='counter_events',
-                exchange_type='topic',
-                durable=True
-            )
-            
-            logger.info("Successfully connected to RabbitMQ")
-            
+            # Robust-соединение само восстанавливает соединение, каналы и exchange после разрыва
+            self.connection = await aio_pika.connect_robust(self.rabbitmq_url)
+            self._pool = asyncio.Queue()
+            for _ in range(self.channels):
+                channel = await self.connection.channel(publisher_confirms=True)
+                exchange = await channel.declare_exchange(
+                    EXCHANGE_NAME, aio_pika.ExchangeType.TOPIC, durable=True
+                )
+                self._pool.put_nowait(exchange)
+            logger.info(f"Successfully connected to RabbitMQ ({self.channels} confirm channels)")
         except Exception as e:
             logger.error(f"Failed to connect to RabbitMQ: {e}")
             raise
-    
-    def disconnect(self):
+
+    async def disconnect(self):
         """Close RabbitMQ connection"""
         try:
-            if self.channel and not self.channel.is_closed:
-                self.channel.close()
             if self.connection and not self.connection.is_closed:
-                self.connection.close()
+                await self.connection.close()
             logger.info("Disconnected from RabbitMQ")
         except Exception as e:
             logger.error(f"Error disconnecting from RabbitMQ: {e}")
-    
-    def _publish_sync(self, routing_key: str, message: Dict[str, Any]):
-        """Synchronous publish for use in thread executor"""
+        finally:
+            self.connection = None
+            self._pool = None
+
+    @asynccontextmanager
+    async def _exchange(self):
+        if self._pool is None:
+            raise RuntimeError("RabbitMQ publisher is not connected")
+        exchange = await self._pool.get()
         try:
-            if not self.channel or self.channel.is_closed:
-                self.connect()
-            
-            # Publish message
-            self.channel.basic_publish(
-                exchange='counter_events',
-                routing_key=routing_key,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Make message persistent
-                    content_type='application/json'
-                )
-            )
-            
-            logger.debug(f"Published event: {routing_key} -> {message}")
-            
-        except Exception as e:
-            logger.error(f"Failed to publish event {routing_key}: {e}")
-            # Try to reconnect for next time
-            try:
-                self.disconnect()
-            except:
-                pass
-            raise
-    
-    async def publish_event(self, event_type: str, event_data: Dict[str, Any]):
-        """Publish event asynchronously"""
-        routing_key = f"counter.{event_type}"
-        
-        # Add metadata
-        message = {
-            "event_type": event_type,
-            "event_id": event_data.get("event_id"),
-            "timestamp": event_data.get("timestamp"),
-            "data": event_data
-        }
-        
-        # Run synchronous publish in thread executor
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            self.executor,
-            self._publish_sync,
-            routing_key,
-            message
+            yield exchange
+        finally:
+            self._pool.put_nowait(exchange)
+
+    async def _publish_message(self, exchange, routing_key: str, message: Dict[str, Any]):
+        await exchange.publish(
+            aio_pika.Message(
+                body=json.dumps(message).encode(),
+                content_type='application/json',
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            ),
+            routing_key=routing_key,
+            timeout=RABBITMQ_CONFIRM_TIMEOUT_SEC
         )
+        logger.debug(f"Published event: {routing_key} -> {message}")
+
+    async def publish_event(self, event_type: str, event_data: Dict[str, Any]):
+        """Publish one event and wait for the broker confirm"""
+        async with self._exchange() as exchange:
+            await self._publish_message(exchange, f"counter.{event_type}", _event_message(event_type, event_data))
+
+    async def publish_batch(self, events: List[Tuple[str, Dict[str, Any]]]) -> List[Optional[str]]:
+        """
+        Publish events in order on one channel with pipelined confirms
+
+        Returns:
+            Error per event (None - confirmed by the broker)
+        """
+        if self.envelope_size > 1:
+            groups = [events[i:i + self.envelope_size] for i in range(0, len(events), self.envelope_size)]
+        else:
+            groups = [[event] for event in events]
+
+        def _routed(group):
+            if len(group) == 1:
+                event_type, event_data = group[0]
+                return f"counter.{event_type}", _event_message(event_type, event_data)
+            return f"counter.{BATCH_EVENT_TYPE}", {
+                "event_type": BATCH_EVENT_TYPE,
+                "event_id": None,
+                "timestamp": None,
+                "data": {"events": [_event_message(event_type, event_data) for event_type, event_data in group]}
+            }
+
+        async with self._exchange() as exchange:
+            # Задачи создаются по порядку, поэтому кадры публикаций уходят в исходном порядке,
+            # а подтверждения ожидаются одновременно
+            outcomes = await asyncio.gather(
+                *(self._publish_message(exchange, *_routed(group)) for group in groups),
+                return_exceptions=True
+            )
+
+        errors: List[Optional[str]] = []
+        for group, outcome in zip(groups, outcomes):
+            error = None
+            if isinstance(outcome, BaseException):
+                error = f"{type(outcome).__name__}: {outcome}"
+                logger.error(f"Failed to publish {len(group)} event(s): {error}")
+            errors.extend([error] * len(group))
+        return errors
 
 # Global publisher instance
 rabbitmq_publisher: Optional[RabbitMQEventPublisher] = None
@@ -111,17 +154,15 @@ def get_rabbitmq_publisher() -> Optional[RabbitMQEventPublisher]:
 async def init_rabbitmq_publisher():
     """Initialize RabbitMQ publisher"""
     global rabbitmq_publisher
-    
+
     rabbitmq_url = os.getenv("RABBITMQ_URL")
     if not rabbitmq_url:
         logger.warning("RABBITMQ_URL not configured, skipping RabbitMQ publisher initialization")
         return
-    
+
     try:
         rabbitmq_publisher = RabbitMQEventPublisher(rabbitmq_url)
-        # Connect in thread executor to avoid blocking
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, rabbitmq_publisher.connect)
+        await rabbitmq_publisher.connect()
         logger.info("RabbitMQ publisher initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize RabbitMQ publisher: {e}")
@@ -130,13 +171,10 @@ async def init_rabbitmq_publisher():
 async def close_rabbitmq_publisher():
     """Close RabbitMQ publisher"""
     global rabbitmq_publisher
-    
+
     if rabbitmq_publisher:
         try:
-            # Disconnect in thread executor
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, rabbitmq_publisher.disconnect)
-            rabbitmq_publisher.executor.shutdown(wait=True)
+            await rabbitmq_publisher.disconnect()
             logger.info("RabbitMQ publisher closed successfully")
         except Exception as e:
             logger.error(f"Error closing RabbitMQ publisher: {e}")
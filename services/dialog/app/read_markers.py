@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+from typing import Tuple
+
+from sqlalchemy import text
+
+from packages.common.db import get_master_session
+
+
+# Маркер прочтения диалога: до какого времени пользователь прочитал сообщения собеседника
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS dialog_read_markers (
+  user_id UUID NOT NULL,
+  peer_user_id UUID NOT NULL,
+  last_read_at TIMESTAMP NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (user_id, peer_user_id)
+);
+"""
+
+# Индекс входящих получателя по отправителю и времени: число прочитанных
+# считается диапазонным сканом индекса между старым и новым маркером
+CREATE_INBOX_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_dialog_messages_inbox ON dialog_messages (to_user_id, from_user_id, created_at)"
+)
+
+# Строка маркера создается заранее, чтобы ее можно было заблокировать FOR UPDATE:
+# конкурентные mark_read одной пары выполняются по очереди и не считают сообщения дважды
+INIT_MARKER_SQL = """
+INSERT INTO dialog_read_markers (user_id, peer_user_id, last_read_at)
+VALUES (:user_id, :peer_user_id, '-infinity')
+ON CONFLICT (user_id, peer_user_id) DO NOTHING
+"""
+
+LOCK_MARKER_SQL = """
+SELECT last_read_at FROM dialog_read_markers
+WHERE user_id = :user_id AND peer_user_id = :peer_user_id
+FOR UPDATE
+"""
+
+COUNT_READ_SQL = """
+SELECT count(*) FROM dialog_messages
+WHERE to_user_id = :user_id AND from_user_id = :peer_user_id
+  AND created_at > :previous AND created_at <= :up_to
+"""
+
+UPDATE_MARKER_SQL = """
+UPDATE dialog_read_markers SET last_read_at = :up_to, updated_at = NOW()
+WHERE user_id = :user_id AND peer_user_id = :peer_user_id
+"""
+
+
+async def ensure_read_markers_table():
+    async with get_master_session() as session:
+        await session.execute(text(CREATE_TABLE_SQL))
+        await session.execute(text(CREATE_INBOX_INDEX_SQL))
+        await session.commit()
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # dialog_messages.created_at хранится как naive UTC
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+async def advance_read_marker(session, user_id: str, peer_user_id: str, up_to: datetime) -> Tuple[int, bool]:
+    """
+    Сдвинуть маркер прочтения вперед в транзакции вызывающего
+
+    Returns:
+        (число сообщений от peer_user_id, прочитанных этим сдвигом; сдвинут ли маркер).
+        Маркер только двигается вперед: для более раннего времени возвращается (0, False)
+    """
+    params = {"user_id": user_id, "peer_user_id": peer_user_id}
+    up_to = _naive_utc(up_to)
+    await session.execute(text(INIT_MARKER_SQL), params)
+    res = await session.execute(text(LOCK_MARKER_SQL), params)
+    previous = res.scalar_one()
+    if previous is not None and previous >= up_to:
+        return 0, False
+    res = await session.execute(text(COUNT_READ_SQL), {**params, "previous": previous, "up_to": up_to})
+    delta = int(res.scalar_one())
+    await session.execute(text(UPDATE_MARKER_SQL), {**params, "up_to": up_to})
+    return delta, True
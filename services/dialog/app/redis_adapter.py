@@ -12,6 +12,41 @@ import redis.asyncio as redis
 from packages.common.models import DialogMessage, DialogMessageResponse
 
 
+DIALOG_TTL_SEC = 30 * 24 * 60 * 60
+# Флаг: индекс входящих заполнен для диалогов, записанных до его появления.
+# Пока его нет, Counter Service сверяет неполный индекс с самим диалогом.
+INBOX_BACKFILLED_KEY = "dialogs:inbox_backfilled"
+
+# Сдвиг маркера прочтения, подсчет прочитанных ZCOUNT по индексу входящих
+# и событие MessagesRead в потоке outbox - одна атомарная операция.
+# Маркер только двигается вперед; если он не сдвинулся, delta = 0.
+# TTL маркера продлевается при каждом чтении и каждом входящем сообщении вместе
+# с TTL индекса входящих: маркер не истекает раньше индекса, иначе все
+# сообщения индекса снова посчитались бы непрочитанными.
+# Payload приходит JSON-объектом без delta: delta дописывается перед закрывающей
+# скобкой, чтобы не перекодировать payload через cjson (он округляет timestamp).
+# KEYS: read_marker, inbox, outbox_stream
+# ARGV: up_to_ts, marker_ttl, payload_json, created_at
+MARK_READ_LUA = """
+local previous = redis.call('GET', KEYS[1])
+local delta = 0
+if previous == false or tonumber(ARGV[1]) > tonumber(previous) then
+    local low = '-inf'
+    if previous ~= false then
+        low = '(' .. previous
+    end
+    delta = redis.call('ZCOUNT', KEYS[2], low, ARGV[1])
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+local payload = string.sub(ARGV[3], 1, -2) .. ', "delta": ' .. delta .. '}'
+redis.call('XADD', KEYS[3], '*',
+    'event_type', 'MessagesRead', 'payload', payload, 'created_at', ARGV[4])
+return delta
+"""
+
+
 class RedisDialogAdapter:
     """
     Адаптер для работы с диалогами через Redis
@@ -23,6 +58,7 @@ class RedisDialogAdapter:
         
         self.redis_url = redis_url
         self.redis_client = redis.from_url(redis_url)
+        self._mark_read_script = self.redis_client.register_script(MARK_READ_LUA)
         
         print(f"🔍 RedisDialogAdapter инициализирован с URL: {redis_url}")
         print(f"🔍 Отладка: redis_dialog_adapter.redis_url = {self.redis_url}")
@@ -60,6 +96,19 @@ class RedisDialogAdapter:
         ids = sorted([user_id1, user_id2])
         return f"dialog:{ids[0]}:{ids[1]}"
     
+    def _get_inbox_key(self, to_user_id: str, from_user_id: str) -> str:
+        """
+        Ключ индекса входящих получателя от одного отправителя.
+        
+        Sorted set message_id -> timestamp: непрочитанные считаются ZCOUNT
+        после маркера прочтения без разбора JSON сообщений диалога.
+        """
+        return f"inbox:{to_user_id}:{from_user_id}"
+    
+    def _get_read_marker_key(self, user_id: str, peer_user_id: str) -> str:
+        """Ключ маркера прочтения: timestamp, до которого прочитаны сообщения собеседника"""
+        return f"read:{user_id}:{peer_user_id}"
+    
     def _message_to_dict(self, message_id: str, from_user_id: str, to_user_id: str, 
                         text: str, created_at: datetime) -> Dict:
         """Преобразование сообщения в словарь для хранения в Redis"""
@@ -74,13 +123,16 @@ class RedisDialogAdapter:
     def _dict_to_message_response(self, message_dict: Dict) -> DialogMessageResponse:
         """Преобразование словаря из Redis в объект ответа"""
         return DialogMessageResponse(
+            id=message_dict.get("id"),
             from_user_id=message_dict["from_user_id"],
             to_user_id=message_dict["to_user_id"],
             text=message_dict["text"],
             created_at=datetime.fromisoformat(message_dict["created_at"])
         )
     
-    async def save_dialog_message(self, from_user_id: str, to_user_id: str, text: str) -> str:
+    async def save_dialog_message(self, from_user_id: str, to_user_id: str, text: str,
+                                  message_id: Optional[str] = None,
+                                  outbox_event: Optional[Tuple[str, Dict]] = None) -> str:
         """
         Сохранение сообщения в Redis
         
@@ -88,11 +140,16 @@ class RedisDialogAdapter:
             from_user_id: ID отправителя
             to_user_id: ID получателя
             text: Текст сообщения
+            message_id: ID сообщения (генерируется, если не передан)
+            outbox_event: Событие (тип, payload) для потока outbox; записывается
+                атомарно вместе с сообщением в одной MULTI/EXEC
             
         Returns:
             ID созданного сообщения
         """
-        message_id = str(uuid.uuid4())
+        from .outbox import REDIS_OUTBOX_STREAM, redis_outbox_fields
+        
+        message_id = message_id or str(uuid.uuid4())
         created_at = datetime.utcnow()
         
         # Создаем объект сообщения
@@ -106,17 +163,64 @@ class RedisDialogAdapter:
         # Используем timestamp как score для автоматической сортировки
         timestamp_score = created_at.timestamp()
         
+        # Сообщение, TTL и событие outbox - одна транзакция MULTI/EXEC и один round trip
+        pipe = self.redis_client.pipeline(transaction=True)
+        
         # Сохраняем в Sorted Set
-        await self.redis_client.zadd(
+        pipe.zadd(
             dialog_key, 
             {json.dumps(message_data): timestamp_score}
         )
         
         # Устанавливаем TTL для диалога (опционально, например 30 дней)
-        await self.redis_client.expire(dialog_key, 30 * 24 * 60 * 60)
+        pipe.expire(dialog_key, DIALOG_TTL_SEC)
+        
+        # Индекс входящих получателя живет столько же, сколько диалог
+        inbox_key = self._get_inbox_key(to_user_id, from_user_id)
+        pipe.zadd(inbox_key, {message_id: timestamp_score})
+        pipe.expire(inbox_key, DIALOG_TTL_SEC)
+        # Маркер прочтения получателя - не короче индекса (EXPIRE без маркера ничего не делает)
+        pipe.expire(self._get_read_marker_key(to_user_id, from_user_id), DIALOG_TTL_SEC)
+        
+        if outbox_event is not None:
+            event_type, payload = outbox_event
+            pipe.xadd(REDIS_OUTBOX_STREAM, redis_outbox_fields(event_type, payload))
+        
+        await pipe.execute()
         
         return message_id
     
+    async def mark_read(self, user_id: str, peer_user_id: str, up_to_ts: float,
+                        outbox_payload: Dict) -> int:
+        """
+        Сдвиг маркера прочтения и событие MessagesRead с точным delta
+        
+        Args:
+            user_id: ID читающего пользователя
+            peer_user_id: ID собеседника
+            up_to_ts: Timestamp, до которого (включительно) сообщения прочитаны
+            outbox_payload: Payload события MessagesRead без delta
+            
+        Returns:
+            Число сообщений собеседника, прочитанных этим сдвигом маркера
+        """
+        from .outbox import REDIS_OUTBOX_STREAM
+        
+        delta = await self._mark_read_script(
+            keys=[
+                self._get_read_marker_key(user_id, peer_user_id),
+                self._get_inbox_key(user_id, peer_user_id),
+                REDIS_OUTBOX_STREAM,
+            ],
+            args=[
+                repr(float(up_to_ts)),
+                DIALOG_TTL_SEC,
+                json.dumps(outbox_payload),
+                datetime.utcnow().isoformat(),
+            ]
+        )
+        return int(delta)
+    
     async def get_dialog_messages(self, user_id1: str, user_id2: str, 
                                  limit: int = 100, offset: int = 0) -> List[DialogMessageResponse]:
         """
@@ -217,8 +321,58 @@ class RedisDialogAdapter:
         """
         dialog_key = self._get_dialog_key(user_id1, user_id2)
         deleted_count = await self.redis_client.delete(dialog_key)
+        await self.redis_client.delete(
+            self._get_inbox_key(user_id1, user_id2),
+            self._get_inbox_key(user_id2, user_id1),
+            self._get_read_marker_key(user_id1, user_id2),
+            self._get_read_marker_key(user_id2, user_id1)
+        )
         return deleted_count > 0
     
+    async def backfill_inbox_index(self, batch_size: int = 1000) -> Dict[str, int]:
+        """
+        Заполнение индекса входящих по сообщениям существующих диалогов
+        
+        ZADD NX не трогает уже проиндексированные сообщения, поэтому запуск
+        безопасен параллельно с записью и повторно. По окончании ставится
+        флаг INBOX_BACKFILLED_KEY.
+        
+        Returns:
+            Число просмотренных диалогов и сообщений
+        """
+        stats = {"dialogs": 0, "messages": 0}
+        async for dialog_key in self.redis_client.scan_iter(match="dialog:*", count=batch_size):
+            start = 0
+            while True:
+                chunk = await self.redis_client.zrange(
+                    dialog_key, start, start + batch_size - 1, withscores=True
+                )
+                if not chunk:
+                    break
+                start += len(chunk)
+                inbox_keys = set()
+                pipe = self.redis_client.pipeline(transaction=False)
+                for message_json, score in chunk:
+                    try:
+                        message_dict = json.loads(message_json)
+                        message_id = message_dict["id"]
+                        inbox_key = self._get_inbox_key(
+                            str(message_dict["to_user_id"]), str(message_dict["from_user_id"])
+                        )
+                    except (json.JSONDecodeError, KeyError) as e:
+                        print(f"Ошибка парсинга сообщения: {e}")
+                        continue
+                    pipe.zadd(inbox_key, {message_id: score}, nx=True)
+                    inbox_keys.add(inbox_key)
+                # Новый индекс живет столько же, сколько диалог; TTL существующего не трогаем
+                for inbox_key in inbox_keys:
+                    pipe.expire(inbox_key, DIALOG_TTL_SEC, nx=True)
+                await pipe.execute()
+                stats["messages"] += len(chunk)
+            stats["dialogs"] += 1
+        await self.redis_client.set(INBOX_BACKFILLED_KEY, datetime.utcnow().isoformat())
+        return stats
+    
     async def get_dialog_stats(self) -> Dict:
         """
         Получение статистики по диалогам в Redis
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+import redis.asyncio as redis
+from packages.common.models import DialogMessageResponse
+from .redis_adapter import DIALOG_TTL_SEC, MARK_READ_LUA
+
+
+# Поток диалога обрезается примерно до этой длины (XADD MAXLEN ~)
+DIALOG_STREAM_MAXLEN = int(os.getenv("DIALOG_STREAM_MAXLEN", "10000"))
+
+STREAM_ID_RE = re.compile(r"^\d+(-\d+)?$")
+
+# Сообщение, индекс входящих и событие outbox - одна атомарная операция.
+# ID сообщения - ID записи потока: он монотонен внутри диалога и несет время
+# создания в миллисекундах, поэтому created_at отдельно не хранится.
+# Score индекса входящих - время из ID в секундах, как у маркера прочтения.
+# message_id дописывается в payload события перед закрывающей скобкой
+# (ID известен только после XADD).
+# TTL маркера прочтения получателя продлевается вместе с TTL индекса входящих.
+# KEYS: dialog_stream, inbox, outbox_stream, read_marker
+# ARGV: from_user_id, to_user_id, text, stream_maxlen, ttl, payload_json ('' - без события),
+#       created_at
+SAVE_MESSAGE_LUA = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[4], '*',
+    'from_user_id', ARGV[1], 'to_user_id', ARGV[2], 'text', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+local ms = string.match(id, '^(%d+)')
+redis.call('ZADD', KEYS[2], string.sub(ms, 1, -4) .. '.' .. string.sub(ms, -3), id)
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('EXPIRE', KEYS[4], ARGV[5])
+if ARGV[6] ~= '' then
+    local payload = string.sub(ARGV[6], 1, -2) .. ', "message_id": "' .. id .. '"}'
+    redis.call('XADD', KEYS[3], '*',
+        'event_type', 'MessageSent', 'payload', payload, 'created_at', ARGV[7])
+end
+return id
+"""
+
+
+class RedisStreamDialogAdapter:
+    """
+    Адаптер для хранения диалогов в Redis Streams: один поток на диалог.
+
+    В отличие от RedisDialogAdapter (sorted set JSON-строк со score-временем)
+    порядок сообщений задает ID записи потока: он строго возрастает, сообщения
+    с одинаковым временем не перемешиваются. Пагинация - курсором по ID
+    (XRANGE/XREVRANGE), без смещения. Длина потока ограничена MAXLEN.
+    Индекс входящих и маркеры прочтения те же, что у RedisDialogAdapter,
+    поэтому Counter Service сверяет и пересобирает счетчики без изменений.
+    """
+
+    def __init__(self, redis_url: str):
+        self.redis_url = redis_url
+        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        self._save_message_script = self.redis_client.register_script(SAVE_MESSAGE_LUA)
+        self._mark_read_script = self.redis_client.register_script(MARK_READ_LUA)
+
+    async def connect(self):
+        """Подключение к Redis"""
+        try:
+            await self.redis_client.ping()
+            print(f"✅ Успешное подключение к Redis (streams): {self.redis_url}")
+        except Exception as e:
+            print(f"❌ Ошибка подключения к Redis (streams): {e}")
+            raise
+
+    async def disconnect(self):
+        """Отключение от Redis"""
+        if self.redis_client:
+            await self.redis_client.close()
+
+    def _get_stream_key(self, user_id1: str, user_id2: str) -> str:
+        """Ключ потока диалога: dialog_stream:{smaller_id}:{larger_id}"""
+        ids = sorted([user_id1, user_id2])
+        return f"dialog_stream:{ids[0]}:{ids[1]}"
+
+    def _get_inbox_key(self, to_user_id: str, from_user_id: str) -> str:
+        """Ключ индекса входящих (ID сообщения -> timestamp), как у RedisDialogAdapter"""
+        return f"inbox:{to_user_id}:{from_user_id}"
+
+    def _get_read_marker_key(self, user_id: str, peer_user_id: str) -> str:
+        """Ключ маркера прочтения, как у RedisDialogAdapter"""
+        return f"read:{user_id}:{peer_user_id}"
+
+    def _entry_to_message_response(self, entry_id: str, fields: Dict[str, str]) -> DialogMessageResponse:
+        """Преобразование записи потока в объект ответа"""
+        created_ms = int(entry_id.split("-", 1)[0])
+        return DialogMessageResponse(
+            id=entry_id,
+            from_user_id=fields["from_user_id"],
+            to_user_id=fields["to_user_id"],
+            text=fields["text"],
+            created_at=datetime.utcfromtimestamp(created_ms / 1000)
+        )
+
+    def _entries_to_messages(self, entries: List[Tuple[str, Dict[str, str]]]) -> List[DialogMessageResponse]:
+        messages = []
+        for entry_id, fields in entries:
+            try:
+                messages.append(self._entry_to_message_response(entry_id, fields))
+            except (KeyError, ValueError) as e:
+                print(f"Ошибка разбора записи потока {entry_id}: {e}")
+        return messages
+
+    @staticmethod
+    def _check_cursor(cursor: str) -> str:
+        if not STREAM_ID_RE.match(cursor):
+            raise ValueError(f"Некорректный курсор сообщения: {cursor}")
+        return cursor
+
+    async def save_dialog_message(self, from_user_id: str, to_user_id: str, text: str,
+                                  outbox_event: Optional[Tuple[str, Dict]] = None) -> str:
+        """
+        Сохранение сообщения в поток диалога
+
+        Args:
+            from_user_id: ID отправителя
+            to_user_id: ID получателя
+            text: Текст сообщения
+            outbox_event: Событие (тип, payload без message_id) для потока outbox;
+                записывается атомарно вместе с сообщением
+
+        Returns:
+            ID сообщения - ID записи потока
+        """
+        from .outbox import REDIS_OUTBOX_STREAM
+
+        payload_json = ""
+        if outbox_event is not None:
+            event_type, payload = outbox_event
+            if event_type != "MessageSent":
+                raise ValueError(f"Неподдерживаемое событие сообщения: {event_type}")
+            payload_json = json.dumps(payload)
+
+        return await self._save_message_script(
+            keys=[
+                self._get_stream_key(from_user_id, to_user_id),
+                self._get_inbox_key(to_user_id, from_user_id),
+                REDIS_OUTBOX_STREAM,
+                self._get_read_marker_key(to_user_id, from_user_id),
+            ],
+            args=[
+                from_user_id,
+                to_user_id,
+                text,
+                DIALOG_STREAM_MAXLEN,
+                DIALOG_TTL_SEC,
+                payload_json,
+                datetime.utcnow().isoformat(),
+            ]
+        )
+
+    async def mark_read(self, user_id: str, peer_user_id: str, up_to_ts: float,
+                        outbox_payload: Dict) -> int:
+        """
+        Сдвиг маркера прочтения и событие MessagesRead с точным delta
+        (тот же скрипт, что у RedisDialogAdapter)
+
+        Returns:
+            Число сообщений собеседника, прочитанных этим сдвигом маркера
+        """
+        from .outbox import REDIS_OUTBOX_STREAM
+
+        delta = await self._mark_read_script(
+            keys=[
+                self._get_read_marker_key(user_id, peer_user_id),
+                self._get_inbox_key(user_id, peer_user_id),
+                REDIS_OUTBOX_STREAM,
+            ],
+            args=[
+                repr(float(up_to_ts)),
+                DIALOG_TTL_SEC,
+                json.dumps(outbox_payload),
+                datetime.utcnow().isoformat(),
+            ]
+        )
+        return int(delta)
+
+    async def get_dialog_messages(self, user_id1: str, user_id2: str, limit: int = 100,
+                                  after_id: Optional[str] = None) -> List[DialogMessageResponse]:
+        """
+        Сообщения диалога от старых к новым
+
+        Args:
+            user_id1: ID первого пользователя
+            user_id2: ID второго пользователя
+            limit: Максимальное количество сообщений
+            after_id: Курсор - ID сообщения, после которого читать (None - с начала)
+
+        Returns:
+            Список сообщений диалога
+        """
+        start = f"({self._check_cursor(after_id)}" if after_id else "-"
+        entries = await self.redis_client.xrange(
+            self._get_stream_key(user_id1, user_id2), min=start, max="+", count=limit
+        )
+        return self._entries_to_messages(entries)
+
+    async def get_recent_dialog_messages(self, user_id1: str, user_id2: str, limit: int = 50,
+                                         before_id: Optional[str] = None) -> List[DialogMessageResponse]:
+        """
+        Последние сообщения диалога в хронологическом порядке
+
+        Args:
+            user_id1: ID первого пользователя
+            user_id2: ID второго пользователя
+            limit: Количество сообщений
+            before_id: Курсор - ID сообщения, до которого читать (None - с конца)
+
+        Returns:
+            Список последних сообщений
+        """
+        end = f"({self._check_cursor(before_id)}" if before_id else "+"
+        entries = await self.redis_client.xrevrange(
+            self._get_stream_key(user_id1, user_id2), max=end, min="-", count=limit
+        )
+        entries.reverse()
+        return self._entries_to_messages(entries)
+
+    async def get_dialog_messages_count(self, user_id1: str, user_id2: str) -> int:
+        """Количество сообщений в диалоге (после обрезки MAXLEN)"""
+        return await self.redis_client.xlen(self._get_stream_key(user_id1, user_id2))
+
+    async def delete_dialog(self, user_id1: str, user_id2: str) -> bool:
+        """
+        Удаление всего диалога
+
+        Returns:
+            True если диалог был удален, False если диалога не было
+        """
+        deleted_count = await self.redis_client.delete(self._get_stream_key(user_id1, user_id2))
+        await self.redis_client.delete(
+            self._get_inbox_key(user_id1, user_id2),
+            self._get_inbox_key(user_id2, user_id1),
+            self._get_read_marker_key(user_id1, user_id2),
+            self._get_read_marker_key(user_id2, user_id1)
+        )
+        return deleted_count > 0
+
+    async def get_dialog_stats(self) -> Dict:
+        """
+        Получение статистики по диалогам: SCAN по потокам и XLEN пачкой
+
+        Returns:
+            Словарь со статистикой
+        """
+        total_dialogs = 0
+        total_messages = 0
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis_client.scan(cursor=cursor, match="dialog_stream:*", count=1000)
+            if keys:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.xlen(key)
+                total_messages += sum(await pipe.execute())
+                total_dialogs += len(keys)
+            if cursor == 0:
+                break
+
+        return {
+            "total_dialogs": total_dialogs,
+            "total_messages": total_messages,
+            "avg_messages_per_dialog": total_messages / total_dialogs if total_dialogs > 0 else 0,
+            "stream_maxlen": DIALOG_STREAM_MAXLEN
+        }
+
+
+# Глобальный экземпляр адаптера
+redis_stream_dialog_adapter = None
+
+
+async def init_redis_stream_adapter(redis_url: str):
+    """Инициализация адаптера Redis Streams"""
+    global redis_stream_dialog_adapter
+    redis_stream_dialog_adapter = RedisStreamDialogAdapter(redis_url)
+    await redis_stream_dialog_adapter.connect()
+
+
+async def close_redis_stream_adapter():
+    """Закрытие соединения с Redis"""
+    global redis_stream_dialog_adapter
+    if redis_stream_dialog_adapter:
+        await redis_stream_dialog_adapter.disconnect()
+        redis_stream_dialog_adapter = None
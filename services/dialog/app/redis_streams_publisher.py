@@ -0,0 +1,83 @@
+"""
+Redis Streams Event Publisher for Dialog Service
+
+Events are appended with XADD to streams in the counter Redis; the counter
+service reads them through a consumer group. Events of one dialog always go
+to the same of COUNTER_EVENTS_STREAMS streams (counter:events:{n}), and each
+stream has a single reader, so they are applied in order. A batch is one
+pipeline, so the relay pays one round trip per batch and marks outbox rows
+done only for entries Redis accepted.
+"""
+import json
+import logging
+import os
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from .outbox import event_dialog
+
+logger = logging.getLogger(__name__)
+
+COUNTER_EVENTS_STREAM = os.getenv("COUNTER_EVENTS_STREAM", "counter:events")
+# Должно совпадать с COUNTER_EVENTS_STREAMS counter-service
+COUNTER_EVENTS_STREAMS = int(os.getenv("COUNTER_EVENTS_STREAMS", "16"))
+COUNTER_EVENTS_REDIS_URL = os.getenv("COUNTER_EVENTS_REDIS_URL", "redis://redis:6379/2")
+# Страховочная обрезка потока; подтвержденные записи потребитель удаляет сам
+COUNTER_EVENTS_MAXLEN = int(os.getenv("COUNTER_EVENTS_MAXLEN", "1000000"))
+
+
+class RedisStreamsEventPublisher:
+    def __init__(self, redis_url: str = COUNTER_EVENTS_REDIS_URL, stream: str = COUNTER_EVENTS_STREAM,
+                 streams: int = COUNTER_EVENTS_STREAMS):
+        self.redis_url = redis_url
+        self.stream = stream
+        self.streams = max(1, streams)
+        self._client: Optional[redis.Redis] = None
+
+    def _get_client(self) -> redis.Redis:
+        if self._client is None:
+            self._client = redis.from_url(self.redis_url, decode_responses=True)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+
+    def _fields(self, event_type: str, payload: Dict[str, Any]) -> Dict[str, str]:
+        return {"event_type": event_type, "payload": json.dumps(payload)}
+
+    def _stream_of(self, payload: Dict[str, Any]) -> str:
+        return f"{self.stream}:{zlib.crc32(event_dialog(payload).encode()) % self.streams}"
+
+    async def publish(self, event_type: str, payload: Dict[str, Any]) -> None:
+        await self._get_client().xadd(
+            self._stream_of(payload), self._fields(event_type, payload),
+            maxlen=COUNTER_EVENTS_MAXLEN, approximate=True
+        )
+
+    async def publish_batch(self, events: List[Tuple[str, Dict[str, Any]]]) -> List[Optional[str]]:
+        """
+        Append events in order with one pipeline
+
+        Returns:
+            Error per event (None - appended). XADD errors (OOM, READONLY during
+            failover, LOADING) are transient, so any failed reply is raised like a
+            connection error: the whole batch stays pending and is retried.
+            Events appended before the failure are appended again on retry;
+            the counter service drops them by event_id.
+        """
+        pipe = self._get_client().pipeline(transaction=False)
+        for event_type, payload in events:
+            pipe.xadd(
+                self._stream_of(payload), self._fields(event_type, payload),
+                maxlen=COUNTER_EVENTS_MAXLEN, approximate=True
+            )
+        replies = await pipe.execute(raise_on_error=False)
+        failed = [reply for reply in replies if isinstance(reply, Exception)]
+        if failed:
+            logger.error(f"Failed to append {len(failed)} of {len(replies)} events to {self.stream}: {failed[0]}")
+            raise failed[0]
+        return [None] * len(replies)
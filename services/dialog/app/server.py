@@ -9,6 +9,7 @@ from packages.common.db import get_user_by_token
 from packages.common.database import get_master_session
 from .dialog_service import dialog_service
 from .worker import start_background_publisher, stop_background_publisher
+from .outbox import get_outbox_stats
 
 
 app = FastAPI(title="Dialog Service", version="0.1.0")
@@ -55,15 +56,33 @@ async def send_message(body: SendMessageRequest, current_user_id: str = Depends(
     return {"id": msg_id}
 
 
+async def _get_page(current_user_id: str, user_id: str, after_id: Optional[str], before_id: Optional[str],
+                    limit: int) -> List[DialogMessageResponse]:
+    # cursor pagination over stream IDs (redis_streams backend only)
+    try:
+        return await dialog_service.get_dialog_messages(
+            current_user_id, user_id, after_id=after_id, before_id=before_id, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/api/v1/dialogs/{user_id}/messages", response_model=List[DialogMessageResponse])
-async def get_messages(user_id: str, limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0), current_user_id: str = Depends(verify_token)):
+async def get_messages(user_id: str, limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0),
+                       after_id: Optional[str] = Query(None), before_id: Optional[str] = Query(None),
+                       current_user_id: str = Depends(verify_token)):
+    if after_id or before_id:
+        return await _get_page(current_user_id, user_id, after_id, before_id, limit)
     messages = await dialog_service.get_dialog_messages(current_user_id, user_id)
     # simple slicing for offset/limit when backend is postgres
     return messages[offset:offset+limit]
 
 
 @app.get("/api/v1/dialogs/{user_id}/recent", response_model=List[DialogMessageResponse])
-async def get_recent(user_id: str, limit: int = Query(50, ge=1, le=100), current_user_id: str = Depends(verify_token)):
+async def get_recent(user_id: str, limit: int = Query(50, ge=1, le=100), before_id: Optional[str] = Query(None),
+                     current_user_id: str = Depends(verify_token)):
+    if before_id:
+        return await _get_page(current_user_id, user_id, None, before_id, limit)
     messages = await dialog_service.get_dialog_messages(current_user_id, user_id)
     return messages[-limit:]
 
@@ -73,3 +92,9 @@ async def stats(_: str = Depends(verify_token)):
     return await dialog_service.get_dialog_stats()
 
 
+@app.get("/internal/outbox/stats")
+async def outbox_stats():
+    """Backlog of the outbox: pending events, oldest pending age, partitions."""
+    return await get_outbox_stats()
+
+